@@ -0,0 +1,551 @@
+import glob
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from stub_server import start_stub_server, STOCK_API_PATH
+
+# ロギングの設定
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    handlers=[
+        logging.StreamHandler(),
+    ],
+)
+logger = logging.getLogger("mineo-stock-checker-bench")
+
+# スタブサーバーが返す保存済みページ
+STUB_PATHS = [
+    "/device/smartphone/motorola-edge-40-neo/",
+    "/device/smartphone/aquos-sense9-8gb-256gb/",
+]
+
+
+def bench_concurrency(url_count=20, concurrency=5, latency=0.3):
+    """スタブサーバーを相手に、逐次チェックと並行チェックの所要時間を比較"""
+    import stock_checker
+
+    # 在庫セルごとのログは計測の邪魔になるので抑える
+    logging.getLogger("mineo-stock-checker").setLevel(logging.WARNING)
+
+    server, base_url = start_stub_server()
+    server.state.latency = latency
+    # 続けて実行するほかのベンチマークに影響しないよう、元の設定を終了時に戻す
+    saved_env = {name: os.environ.get(name) for name in ("FETCH_MODE", "STOCK_API_URL")}
+    os.environ["FETCH_MODE"] = "http-only"
+    os.environ["STOCK_API_URL"] = base_url + STOCK_API_PATH + "?modelnums={modelnums}"
+    urls = [base_url + STUB_PATHS[i % len(STUB_PATHS)] + f"?n={i}" for i in range(url_count)]
+    try:
+        timings = {}
+        results = {}
+        for workers in (1, concurrency):
+            # 計測対象は並行度だけにするため、ホストごとの間隔制限は外す
+            limiter = stock_checker.HostRateLimiter(interval=0)
+            started = time.perf_counter()
+            results[workers] = stock_checker.check_urls(urls, concurrency=workers, rate_limiter=limiter)
+            timings[workers] = time.perf_counter() - started
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        server.shutdown()
+
+    same = [r["details"] for r in results[1]] == [r["details"] for r in results[concurrency]]
+    logger.info(f"URL数: {url_count}, 応答遅延: {latency}秒")
+    logger.info(f"逐次 (1並列): {timings[1]:.2f}秒")
+    logger.info(f"並行 ({concurrency}並列): {timings[concurrency]:.2f}秒 ({timings[1] / timings[concurrency]:.1f}倍)")
+    logger.info(f"結果の順序と内容が一致: {same}")
+    return timings
+
+
+def bench_resources(repeat=3, resource_latency=0.3):
+    """スタブの重いページをChromeで読み込み、リソース制限ごとの読み込み時間とレンダラーのメモリを比較
+
+    Chromeがインストールされている環境でのみ実行できる
+    """
+    import stock_checker
+    from stub_server import THIRD_PARTY_PATH, resource_heavy_page
+
+    if stock_checker.find_chrome_executable() is None:
+        logger.warning("Chromeが見つからないため、resourcesのベンチマークを省略します")
+        return None
+    logging.getLogger("mineo-stock-checker").setLevel(logging.WARNING)
+
+    server, base_url = start_stub_server()
+    server.state.resource_latency = resource_latency
+    path = "/device/smartphone/resource-heavy/"
+    # 外部リソースはページと別のホスト名（localhost）から読み込ませる
+    resource_base = base_url.replace("127.0.0.1", "localhost")
+    server.state.pages[path] = resource_heavy_page(resource_base, "リソースの多いページ", ["1", "2", "2", "1"])
+    url = base_url + path
+    results = {}
+    try:
+        for resource_filter in stock_checker.RESOURCE_FILTERS:
+            with stock_checker.BrowserPool(size=1, resource_filter=resource_filter) as pool:
+                # 1回目はChromeの起動とキャッシュの影響を受けるので計測から外す
+                stock_checker.fetch_rendered_html(url, pool)
+                del server.state.requests[:]
+                load_times = []
+                details = None
+                for _ in range(repeat):
+                    html, timings = stock_checker.fetch_rendered_html(url, pool)
+                    load_times.append(timings["load"] + timings["ready"])
+                    details = stock_checker.extract_from_soup(stock_checker.parse_stock_html(html))["details"]
+                with pool.session() as driver:
+                    driver.get(url)
+                    stock_checker.wait_for_stock_ready(driver)
+                    driver.execute_cdp_cmd("Performance.enable", {})
+                    metrics = {
+                        metric["name"]: metric["value"]
+                        for metric in driver.execute_cdp_cmd("Performance.getMetrics", {})["metrics"]
+                    }
+            third_party = sum(1 for requested in server.state.requests if requested.startswith(THIRD_PARTY_PATH))
+            results[resource_filter] = sum(load_times) / len(load_times)
+            logger.info(
+                f"{resource_filter}: 読み込み {results[resource_filter]:.2f}秒, "
+                f"JSヒープ {metrics.get('JSHeapUsedSize', 0) / 1024 / 1024:.1f}MB, "
+                f"DOMノード {metrics.get('Nodes', 0):.0f}, "
+                f"外部リソースへのリクエスト {third_party // (repeat + 1)}件/回, 判定結果 {details}"
+            )
+    finally:
+        server.shutdown()
+    logger.info(f"block: {results['off'] / results['block']:.1f}倍, allow: {results['off'] / results['allow']:.1f}倍")
+    return results
+
+
+def bench_logging(url_counts=(100, 1000, 5000)):
+    """在庫判定のログ出力について、従来の方法（セルごとにf文字列で組み立て、同期でファイルに書き込む）と
+    キュー経由のログ出力（商品ごとに1件、遅延評価、バックグラウンドで書き込み）の1URLあたりの負荷を比較
+    """
+    import queue
+    import tempfile
+    from logging.handlers import QueueListener, RotatingFileHandler
+
+    import stock_extractor
+    from log_config import LOG_FORMAT, DeferredQueueHandler
+
+    def legacy_log_extraction(log, extraction, source):
+        # 変更前のlog_extractionと同じ出力
+        log.info(f"商品名: {extraction['product_name']}")
+        log.info(f"在庫情報セルを {len(extraction['cells'])} 個見つけました")
+        for cell in extraction["cells"]:
+            log.info(f"セル内容 ({cell['color']}): {cell['text']}")
+            if cell["icon_class"]:
+                log.info(f"  - アイコンクラス: {cell['icon_class']}")
+            if cell["data_stock_status"]:
+                log.info(f"  - data-stock-status: {cell['data_stock_status']}")
+            log.info(f"  - 判断根拠: {cell['reason']}")
+
+    extractions = [stock_extractor.extract_stock(html) for _, html in replay_pages()[:3]]
+    formatter = logging.Formatter(LOG_FORMAT)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for url_count in url_counts:
+            for name in ("legacy", "queue"):
+                log = logging.getLogger(f"mineo-stock-checker-bench-logging-{name}-{url_count}")
+                log.propagate = False
+                log.setLevel(logging.INFO)
+                path = os.path.join(tmp_dir, f"{name}-{url_count}.log")
+                listener = None
+                if name == "legacy":
+                    handler = logging.FileHandler(path, encoding="utf-8")
+                    handler.setFormatter(formatter)
+                    log.addHandler(handler)
+                    log_extraction = legacy_log_extraction
+                else:
+                    handler = RotatingFileHandler(path, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8")
+                    handler.setFormatter(formatter)
+                    log_queue = queue.Queue()
+                    log.addHandler(DeferredQueueHandler(log_queue))
+                    listener = QueueListener(log_queue, handler)
+                    listener.start()
+                    log_extraction = stock_extractor.log_extraction
+
+                started = time.perf_counter()
+                for index in range(url_count):
+                    log_extraction(log, extractions[index % len(extractions)], f"https://mineo.jp/device/{index}/")
+                caller = time.perf_counter() - started
+                if listener is not None:
+                    listener.stop()
+                total = time.perf_counter() - started
+                handler.close()
+                log.handlers.clear()
+
+                log_bytes = sum(
+                    os.path.getsize(os.path.join(tmp_dir, file_name))
+                    for file_name in os.listdir(tmp_dir)
+                    if file_name.startswith(f"{name}-{url_count}.log")
+                )
+                results[f"{name}-{url_count}"] = caller / url_count * 1e6
+                logger.info(
+                    f"{name} ({url_count}URL): 呼び出し元 {caller / url_count * 1e6:.0f}µs/URL, "
+                    f"書き込み完了まで {total / url_count * 1e6:.0f}µs/URL, ログ {log_bytes / 1024:.0f}KB"
+                )
+            logger.info(f"  呼び出し元の負荷: {results[f'legacy-{url_count}'] / results[f'queue-{url_count}']:.1f}倍削減")
+    return results
+
+
+def bench_streaming(bytes_per_second=200 * 1024, repeat=3):
+    """保存済みHTMLを遅い回線の速度で返すスタブを相手に、ページ全体を受信する方法と
+    在庫状況テーブルを受信した時点で打ち切る方法の、判定までの時間と受信量を比較
+    """
+    import stock_checker
+
+    logging.getLogger("mineo-stock-checker").setLevel(logging.WARNING)
+
+    server, base_url = start_stub_server()
+    server.state.bytes_per_second = bytes_per_second
+    paths = list(STUB_PATHS)
+    # latest_html.htmlと同じくらいの大きさ（在庫状況テーブルの後ろにスクリプトが続く）のページ
+    server.state.pages["/device/smartphone/large-page/"] = synthetic_product_page_for_bench()
+    paths.append("/device/smartphone/large-page/")
+    results = {}
+    try:
+        for path in paths:
+            url = base_url + path
+            measured = {}
+            for stream in (False, True):
+                times = []
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    html, soup, timings, validators, transfer = stock_checker.fetch_stock_http(url, stream=stream)
+                    details = stock_checker.extract_from_soup(soup)["details"]
+                    times.append(time.perf_counter() - started)
+                measured[stream] = (sum(times) / len(times), transfer, details)
+            (full_time, full_transfer, full_details), (stream_time, stream_transfer, stream_details) = measured[False], measured[True]
+            results[path] = full_time / stream_time
+            logger.info(f"{path}")
+            logger.info(f"  全体を受信: {full_time:.2f}秒, {full_transfer['bytes'] / 1024:.0f}KB")
+            logger.info(
+                f"  打ち切り: {stream_time:.2f}秒, {stream_transfer['bytes'] / 1024:.0f}KB "
+                f"({full_time / stream_time:.1f}倍, 受信量 {stream_transfer['bytes'] / full_transfer['bytes']:.0%})"
+            )
+            logger.info(f"  判定結果が一致: {full_details == stream_details}")
+    finally:
+        server.shutdown()
+    return results
+
+
+def synthetic_product_page_for_bench():
+    """在庫状況テーブルが先頭から約120KB、全体が約330KBの合成ページ（latest_html.htmlと同程度）"""
+    from stub_server import synthetic_product_page
+
+    html = synthetic_product_page("大きな商品ページ", ["1", "2", "2", "1", "2"], padding_kb=210)
+    head_padding = "<script>window.dataLayer=window.dataLayer||[];</script>\n" * (120 * 1024 // 55)
+    return html.replace("<body>", "<body>\n" + head_padding, 1)
+
+
+def fixture_files():
+    """リポジトリに保存されているHTMLファイル"""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return sorted(glob.glob(os.path.join(base_dir, "*.html")))
+
+
+def measure(func, repeat):
+    """funcを繰り返し実行し、(1回あたりの秒数, ピークメモリ(バイト), 最後の戻り値) を返す"""
+    result = func()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    elapsed = (time.perf_counter() - started) / repeat
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def bench_parse(repeat=20):
+    """保存済みHTMLで、全体をhtml.parserでパースする従来の方法と範囲を絞ったパースを比較"""
+    import stock_extractor
+
+    def legacy(html):
+        soup = stock_extractor.parse_stock_html(html, parser="html.parser", scoped=False)
+        colors = [cell.find_previous("th").text.strip() for cell in soup.select(".replace-stock-color")]
+        return stock_extractor.extract_from_soup(soup)["details"], colors
+
+    def scoped(html):
+        details = stock_extractor.extract_stock(html)["details"]
+        return details, [detail["color"] for detail in details]
+
+    logger.info(f"パーサー: {stock_extractor.HTML_PARSER}")
+    all_same = True
+    for file_path in fixture_files():
+        with open(file_path, "r", encoding="utf-8") as f:
+            html = f.read()
+        old_time, old_peak, old_result = measure(lambda: legacy(html), repeat)
+        new_time, new_peak, new_result = measure(lambda: scoped(html), repeat)
+        same = old_result == new_result
+        all_same = all_same and same
+        logger.info(f"{os.path.basename(file_path)} ({len(html.encode('utf-8')) // 1024}KB)")
+        logger.info(f"  従来: {old_time * 1000:.1f}ms, ピークメモリ {old_peak / 1024:.0f}KB")
+        logger.info(f"  新方式: {new_time * 1000:.1f}ms, ピークメモリ {new_peak / 1024:.0f}KB ({old_time / new_time:.1f}倍)")
+        logger.info(f"  抽出結果が一致: {same}")
+    return all_same
+
+
+def replay_pages():
+    """リプレイに使うページ（保存済みHTMLと、色数・ページサイズを増やした合成ページ）"""
+    from stub_server import synthetic_product_page
+
+    pages = []
+    for file_path in fixture_files():
+        with open(file_path, "r", encoding="utf-8") as f:
+            pages.append((os.path.basename(file_path), f.read()))
+    for colors, padding_kb in ((10, 300), (50, 1000), (200, 3000)):
+        statuses = ["1" if i % 3 == 0 else "2" for i in range(colors)]
+        html = synthetic_product_page(f"合成ページ {colors}色", statuses, padding_kb=padding_kb)
+        pages.append((f"synthetic-{colors}colors-{padding_kb}KB", html))
+    return pages
+
+
+def bench_extract(duration=1.0):
+    """抽出処理（stock_extractor.extract_stock）を各ページで繰り返し、ページ/秒とメモリ確保量を計測"""
+    import stock_extractor
+
+    logger.info(f"パーサー: {stock_extractor.HTML_PARSER}")
+    results = {}
+    for name, html in replay_pages():
+        expected = stock_extractor.extract_stock(html)
+        count = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < duration:
+            stock_extractor.extract_stock(html)
+            count += 1
+        pages_per_second = count / (time.perf_counter() - started)
+
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        result = stock_extractor.extract_stock(html)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats = after.compare_to(before, "filename")
+        blocks = sum(max(0, stat.count_diff) for stat in stats)
+
+        assert result["details"] == expected["details"]
+        results[name] = pages_per_second
+        logger.info(
+            f"{name} ({len(html.encode('utf-8')) // 1024}KB, {len(result['details'])}色): "
+            f"{pages_per_second:.1f}ページ/秒, ピークメモリ {peak / 1024:.0f}KB, 確保ブロック数 {blocks}"
+        )
+    compare_with_baseline("extract", results)
+    return results
+
+
+def compare_with_baseline(name, results, tolerance=0.2):
+    """BENCH_BASELINEのJSONと比べて、スループットがtolerance以上落ちたページを報告
+
+    BENCH_SAVE_BASELINE=1 のときは今回の結果を基準として保存する
+    """
+    path = os.getenv("BENCH_BASELINE")
+    if not path:
+        return True
+    baseline = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    ok = True
+    for page, value in results.items():
+        previous = baseline.get(name, {}).get(page)
+        if previous and value < previous * (1 - tolerance):
+            ok = False
+            logger.warning(f"性能が低下しています: {page} {previous:.1f} → {value:.1f}")
+    if os.getenv("BENCH_SAVE_BASELINE") == "1":
+        baseline[name] = results
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        logger.info(f"基準値を保存しました: {path}")
+    elif not ok:
+        sys.exit(1)
+    return ok
+
+
+# ブラウザを使わないコマンドの起動にかける時間の目標（インタープリタ自体の起動を除く、ミリ秒）
+IMPORT_TIME_TARGET_MS = 100
+
+# ブラウザを使わないコマンドで読み込まれてはいけないモジュール
+HEAVY_MODULES = ("selenium", "requests", "bs4", "smtplib", "ssl", "asyncio", "sqlite3")
+
+
+def import_time_profile(args, env=None):
+    """python -X importtime で実行し、(モジュールの読み込み時間の合計（ミリ秒）, 読み込んだモジュール, 実行時間（ミリ秒）)"""
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", *args], capture_output=True, text=True, env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    wall = (time.perf_counter() - started) * 1000
+    total = 0
+    modules = set()
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        modules.add(name.strip())
+        # 字下げが1つの行がトップレベルの読み込み（累積時間に下位の読み込みを含む）
+        if not name.startswith("  "):
+            total += int(cumulative)
+    return total / 1000, modules, wall
+
+
+def bench_importtime(target_ms=None):
+    """ブラウザを使わないコマンドの起動時間と、重いモジュールが読み込まれていないかを計測
+
+    インタープリタだけを起動したときとの差を、そのコマンドの起動時間とする
+    """
+    if target_ms is None:
+        target_ms = float(os.getenv("BENCH_IMPORT_TARGET_MS", str(IMPORT_TIME_TARGET_MS)))
+    server, base_url = start_stub_server()
+    ok = True
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = dict(
+                os.environ,
+                PRODUCT_URLS=base_url + STUB_PATHS[0],
+                FETCH_MODE="http-only",
+                LOG_FILE="",
+                STATE_DB_FILE=os.path.join(tmp_dir, "state.db"),
+                PAGE_CACHE_FILE=os.path.join(tmp_dir, "page_cache.json"),
+                URL_HEALTH_FILE=os.path.join(tmp_dir, "url_health.json"),
+                ARCHIVE_DB_FILE=os.path.join(tmp_dir, "archive.db"),
+                NOTIFY_DEDUPE_FILE=os.path.join(tmp_dir, "notify_dedupe.json"),
+                SNAPSHOT_DIR=os.path.join(tmp_dir, "snapshots"),
+                RUN_REPORT_FILE=os.path.join(tmp_dir, "run_report.jsonl"),
+            )
+            # (名前, 引数, 読み込まれてはいけないモジュール, 目標の対象か)
+            cases = [
+                ("import stock_checker", ["-c", "import stock_checker"], HEAVY_MODULES, True),
+                ("stock_checker.py --help", ["stock_checker.py", "--help"], HEAVY_MODULES, True),
+                ("stock_checker.py replay", ["stock_checker.py", "replay", "latest_html.html"],
+                 ("selenium", "requests", "smtplib", "ssl", "asyncio", "sqlite3"), False),
+                ("stock_checker.py check (http-only)", ["stock_checker.py", "check"], ("selenium",), False),
+            ]
+            baseline, baseline_modules, baseline_wall = import_time_profile(["-c", "pass"], env)
+            logger.info(f"インタープリタのみ: 読み込み {baseline:.1f}ms, 実行 {baseline_wall:.0f}ms")
+            for name, args, forbidden, targeted in cases:
+                total, modules, wall = import_time_profile(args, env)
+                startup = total - baseline
+                loaded = [module for module in forbidden if module in modules - baseline_modules]
+                logger.info(
+                    f"{name}: 読み込み {startup:.1f}ms, 実行 {wall:.0f}ms"
+                    + (f"（目標 {target_ms:.0f}ms）" if targeted else "")
+                )
+                if loaded:
+                    ok = False
+                    logger.error(f"{name} で不要なモジュールが読み込まれています: {', '.join(loaded)}")
+                if targeted and startup > target_ms:
+                    ok = False
+                    logger.error(f"{name} の起動時間が目標を超えています: {startup:.1f}ms > {target_ms:.0f}ms")
+    finally:
+        server.shutdown()
+    logger.info(f"起動時間: {'成功' if ok else '失敗'}")
+    return ok
+
+
+def bench_archive(days=90, url_count=5, colors=4, interval=300, repeat=20, target_ms=10):
+    """数か月分の5分ごとの観測をアーカイブに入れ、まとめる前後の問い合わせの時間と行数を計測"""
+    from stock_archive import StockArchive
+
+    logging.getLogger("mineo-stock-checker").setLevel(logging.WARNING)
+    start = time.time() - days * 24 * 3600
+    samples = int(days * 24 * 3600 / interval)
+    urls = [f"https://mineo.jp/device/smartphone/bench-{n}/" for n in range(url_count)]
+
+    def results_at(now):
+        # 色ごとに数日おきに在庫が切り替わり、たまに値下げされる
+        day = int((now - start) // (24 * 3600))
+        return [
+            {"url": url, "error": None, "details": [
+                {"color": f"色{c}", "status": "在庫あり" if (day + c + u) % 7 == 0 else "在庫なし",
+                 "full_price": 64416 - 1000 * ((day + u) // 30), "installment_price": 2684, "fraction_off": None}
+                for c in range(colors)
+            ]}
+            for u, url in enumerate(urls)
+        ]
+
+    def query_ms(archive):
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            archive.history(urls[0], "色0")
+            times.append(time.perf_counter() - started)
+        return sum(times) / len(times) * 1000
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "archive.db")
+        with StockArchive(path=path, compact_after=float("inf")) as archive:
+            # 常駐モードと同じく、1回のチェックごとに1トランザクションで追記する
+            started = time.perf_counter()
+            for n in range(samples):
+                now = start + n * interval
+                archive.append(results_at(now), now=now)
+            append_seconds = time.perf_counter() - started
+            raw_counts = archive.counts()
+            raw_ms = query_ms(archive)
+
+            # 直近1日分だけをまとめずに残した状態（ARCHIVE_COMPACT_HOURS=24で運用したとき）
+            started = time.perf_counter()
+            archive.compact(before=now - 24 * 3600)
+            compact_seconds = time.perf_counter() - started
+            compacted_counts = archive.counts()
+            compacted_ms = query_ms(archive)
+
+    observations = samples * url_count * colors
+    logger.info(
+        f"{days}日分・{interval // 60}分ごと・{url_count}URL×{colors}色（観測{observations}件）: "
+        f"追記 {append_seconds / samples * 1000:.2f}ms/回"
+    )
+    logger.info(f"まとめる前: 観測{raw_counts['observations']}行, 問い合わせ {raw_ms:.1f}ms")
+    logger.info(
+        f"まとめた後: 観測{compacted_counts['observations']}行 + 期間{compacted_counts['spans']}行, "
+        f"問い合わせ {compacted_ms:.2f}ms "
+        f"（まとめる処理 {compact_seconds:.1f}秒）"
+    )
+    if compacted_ms > target_ms:
+        logger.warning(f"まとめた後の問い合わせが目標を超えています: {compacted_ms:.2f}ms > {target_ms}ms")
+    return compacted_ms
+
+
+BENCHMARKS = {
+    "concurrency": bench_concurrency,
+    "parse": bench_parse,
+    "extract": bench_extract,
+    "resources": bench_resources,
+    "logging": bench_logging,
+    "streaming": bench_streaming,
+    "importtime": bench_importtime,
+    "archive": bench_archive,
+}
+
+
+def run_benchmarks(names=None):
+    """ベンチマークを順に実行し、終了コードを返す（python stock_checker.py bench からも使う）"""
+    names = names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            logger.error(f"不明なベンチマークです: {name}（{', '.join(BENCHMARKS)}）")
+            return 1
+    failed = []
+    for name in names:
+        logger.info(f"===== {name} =====")
+        # 目標を判定するベンチマークはFalseを返す（ほかのベンチマークは続けて実行する）
+        if BENCHMARKS[name]() is False:
+            failed.append(name)
+    if failed:
+        logger.error(f"目標を満たさなかったベンチマーク: {', '.join(failed)}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run_benchmarks(sys.argv[1:]))
@@ -0,0 +1,314 @@
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+from stock_extractor import HTML_PARSER, parse_stock_html
+from watch_list import normalize_url, subscription_from_entry
+
+# bs4・requestsは一覧ページを実際に取得するときに読み込む
+
+logger = logging.getLogger("mineo-stock-checker")
+
+DEFAULT_LISTING_URL = "https://mineo.jp/device/smartphone/"
+
+# サイトマップのXML名前空間（タグ名の比較では無視する）
+SITEMAP_TAG = re.compile(r"^\{[^}]*\}")
+
+
+def split_patterns(value):
+    """カンマ・改行区切りのパターンをリストにする"""
+    return [item.strip() for item in (value or "").replace("\n", ",").split(",") if item.strip()]
+
+
+def matches_any(patterns, values):
+    """値のどれかがパターン（*や?を使えるワイルドカード、大文字小文字は区別しない）のどれかに合うか"""
+    return any(fnmatch.fnmatch((value or "").lower(), pattern.lower()) for pattern in patterns for value in values)
+
+
+def card_fingerprint(text, images):
+    """一覧の商品の表示内容（商品名・価格・「在庫なし」などの表示と画像）のハッシュ"""
+    data = json.dumps([" ".join(text.split()), sorted(images)], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def is_sitemap(url, text):
+    return urlsplit(url).path.endswith(".xml") or text.lstrip().startswith("<?xml")
+
+
+class DeviceDiscovery:
+    """mineoの一覧ページ（またはサイトマップ）から商品ページを見つけ、監視リストに加える
+
+    商品ごとに一覧での表示内容のハッシュ（フィンガープリント）を記録しておき、2回目以降は
+    一覧を1回取得するだけで、新しく載った商品と表示が変わった商品の商品ページだけを取得する。
+    一覧は前回のETag・Last-Modifiedで取得し、変わっていなければ（304）商品ページも取得しない。
+    商品ページに在庫状況テーブルがある商品だけを、include・excludeで絞って監視する
+    """
+
+    def __init__(self, listing_urls=None, path=None, include=None, exclude=None, path_prefix=None,
+                 concurrency=None, timeout=None):
+        if listing_urls is None:
+            listing_urls = split_patterns(os.getenv("DISCOVERY_URLS", ""))
+        if path is None:
+            path = os.getenv("DISCOVERY_FILE", os.path.join(".cache", "discovery.json"))
+        if include is None:
+            include = split_patterns(os.getenv("DISCOVERY_INCLUDE", ""))
+        if exclude is None:
+            exclude = split_patterns(os.getenv("DISCOVERY_EXCLUDE", ""))
+        if path_prefix is None:
+            path_prefix = os.getenv("DISCOVERY_PATH_PREFIX", urlsplit(DEFAULT_LISTING_URL).path)
+        if concurrency is None:
+            concurrency = int(os.getenv("DISCOVERY_CONCURRENCY", "4"))
+        if timeout is None:
+            timeout = float(os.getenv("DISCOVERY_TIMEOUT", "20"))
+        # DISCOVERY_URLSが空なら商品を探さない（監視リストにも加えない）
+        self.listing_urls = listing_urls
+        self.enabled = bool(listing_urls)
+        self.path = path
+        self.include = include
+        self.exclude = exclude
+        # 商品ページとみなすURLのパス（この下の1階層、/device/smartphone/<商品>/）
+        self.path_prefix = "/" + path_prefix.strip("/") + "/"
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.listings = {}
+        self.devices = {}
+
+    def load(self):
+        """前回の一覧と商品のフィンガープリントを読み込む"""
+        if not self.enabled or not self.path or not os.path.exists(self.path):
+            return self
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.listings = data.get("listings", {})
+            self.devices = data.get("devices", {})
+        except (OSError, ValueError) as e:
+            logger.warning("商品の検出結果を読み込めませんでした: %s", e)
+        return self
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"listings": self.listings, "devices": self.devices}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("商品の検出結果を保存できませんでした: %s", e)
+
+    def is_device_url(self, url, base_url):
+        """一覧と同じホストの、path_prefixの下の1階層のページか"""
+        parts = urlsplit(url)
+        if parts.netloc.lower() != urlsplit(base_url).netloc.lower():
+            return False
+        if not parts.path.startswith(self.path_prefix):
+            return False
+        slug = parts.path[len(self.path_prefix):].strip("/")
+        return bool(slug) and "/" not in slug and "." not in slug
+
+    def included(self, url, name=None):
+        """include（指定があればどれかに合う）とexclude（どれにも合わない）で監視するか決める"""
+        values = [url, urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1], name]
+        if self.include and not matches_any(self.include, values):
+            return False
+        return not matches_any(self.exclude, values)
+
+    def parse_listing(self, html, base_url):
+        """一覧ページから {商品ページのURL: {"name", "fingerprint"}} を取り出す
+
+        商品ごとのカード（その商品だけへのリンクを含む最も外側の要素）の表示内容をフィンガープリントにする
+        """
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(html, HTML_PARSER)
+        cards = {}
+        for link in soup.find_all("a", href=True):
+            url = normalize_url(urljoin(base_url, link["href"]))
+            if not self.is_device_url(url, base_url):
+                continue
+            card = link
+            while card.parent is not None and card.parent.name not in ("body", "html", "[document]"):
+                targets = {
+                    normalize_url(urljoin(base_url, a["href"])) for a in card.parent.find_all("a", href=True)
+                }
+                targets = {target for target in targets if self.is_device_url(target, base_url)}
+                if targets != {url}:
+                    break
+                card = card.parent
+            if any(card is seen for seen in cards.get(url, [])):
+                continue
+            cards.setdefault(url, []).append(card)
+
+        entries = {}
+        for url, elements in cards.items():
+            texts = [element.get_text(" ", strip=True) for element in elements]
+            images = [img.get("src", "") for element in elements for img in element.find_all("img")]
+            names = [img.get("alt", "").strip() for element in elements for img in element.find_all("img")]
+            names += [text for element in elements for text in element.stripped_strings]
+            entries[url] = {
+                "name": next((name for name in names if name), None),
+                "fingerprint": card_fingerprint(" ".join(texts), images),
+            }
+        return entries
+
+    def parse_sitemap(self, text, base_url):
+        """サイトマップから商品ページのURLと更新日時（フィンガープリントにする）、子のサイトマップを取り出す"""
+        import xml.etree.ElementTree as ElementTree
+
+        root = ElementTree.fromstring(text.encode("utf-8"))
+        entries = {}
+        children = []
+        for node in root:
+            fields = {SITEMAP_TAG.sub("", child.tag): (child.text or "").strip() for child in node}
+            if not fields.get("loc"):
+                continue
+            if SITEMAP_TAG.sub("", root.tag) == "sitemapindex":
+                children.append(fields["loc"])
+                continue
+            url = normalize_url(fields["loc"])
+            if self.is_device_url(url, base_url):
+                entries[url] = {"name": None, "fingerprint": fields.get("lastmod") or None}
+        return entries, children
+
+    def fetch_listing(self, session, url, depth=0):
+        """一覧（サイトマップ）を前回のETag・Last-Modifiedで取得し、商品の一覧を返す（変わっていなければ前回の一覧）"""
+        previous = self.listings.get(url, {})
+        headers = {}
+        if previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+        response = session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304 and "entries" in previous:
+            logger.info("一覧は前回から変わっていません: %s", url)
+            return previous["entries"], False
+        response.raise_for_status()
+        text = response.content.decode(response.encoding or "utf-8", "replace")
+        if is_sitemap(url, text):
+            entries, children = self.parse_sitemap(text, url)
+            if depth == 0:
+                # サイトマップのインデックスは1階層だけたどる
+                for child in children:
+                    child_entries, _ = self.fetch_listing(session, child, depth + 1)
+                    entries.update(child_entries)
+        else:
+            entries = self.parse_listing(text, url)
+        if not entries:
+            # ページの構成が変わった可能性がある（監視している商品を一度に外さないように前回の一覧を使う）
+            raise ValueError("商品ページへのリンクが見つかりませんでした")
+        self.listings[url] = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "entries": entries,
+        }
+        return entries, True
+
+    def fetch_device(self, session, url):
+        """商品ページを取得し、在庫状況テーブルがあるかと商品名・色の数を調べる"""
+        try:
+            response = session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            soup = parse_stock_html(response.content)
+        except Exception as e:
+            return {"error": str(e)}
+        title = soup.select_one(".page-title h1")
+        return {
+            "error": None,
+            "has_stock": bool(soup.select(".replace-stock-color")),
+            "page_name": title.text.strip() if title else None,
+            "colors": len(soup.select(".replace-stock-color")),
+        }
+
+    def crawl(self, session=None, now=None):
+        """一覧を取得し、新しい商品・表示が変わった商品の商品ページだけを取得して記録する
+
+        戻り値は {"new", "changed", "removed", "fetched", "listed", "watched", "errors"}（商品はURLのリスト）
+        """
+        if now is None:
+            now = time.time()
+        if session is None:
+            import requests
+
+            session = requests.Session()
+        started = time.perf_counter()
+        listed = {}
+        complete = True
+        errors = []
+        for url in self.listing_urls:
+            try:
+                entries, _ = self.fetch_listing(session, url)
+            except Exception as e:
+                # 取得できなかった一覧の商品は前回のまま残す（一覧から消えたとはみなさない）
+                logger.warning("一覧を取得できませんでした: %s - %s", url, e)
+                errors.append(url)
+                complete = False
+                entries = self.listings.get(url, {}).get("entries", {})
+            listed.update(entries)
+
+        summary = {"new": [], "changed": [], "removed": [], "fetched": 0, "listed": len(listed), "errors": errors}
+        for url, entry in listed.items():
+            device = self.devices.get(url)
+            if device is None:
+                summary["new"].append(url)
+                device = self.devices[url] = {"first_seen": now, "checked_at": None}
+            elif device["fingerprint"] != entry["fingerprint"] or not device["listed"]:
+                summary["changed"].append(url)
+                device["checked_at"] = None
+            device.update(name=entry["name"] or device.get("name"), fingerprint=entry["fingerprint"], listed=True, last_seen=now)
+        if complete:
+            for url, device in self.devices.items():
+                if device["listed"] and url not in listed:
+                    device["listed"] = False
+                    summary["removed"].append(url)
+
+        # 新しい商品・変わった商品と、前回取得できなかった商品だけ商品ページを取得する（監視しない商品は取得しない）
+        pending = [
+            url for url, device in self.devices.items()
+            if device["listed"] and (device["checked_at"] is None or device.get("error"))
+            and self.included(url, device.get("name"))
+        ]
+        if pending:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(pending)), thread_name_prefix="discovery") as executor:
+                for url, page in zip(pending, executor.map(lambda url: self.fetch_device(session, url), pending)):
+                    device = self.devices[url]
+                    device.update(page, checked_at=now)
+                    if page["error"]:
+                        logger.warning("商品ページを取得できませんでした: %s - %s", url, page["error"])
+        summary["fetched"] = len(pending)
+        summary["watched"] = len(self.subscriptions())
+        self.save()
+        logger.info(
+            "商品の検出: 一覧%s件 (新規%s件, 変更%s件, 掲載終了%s件), 商品ページ%s件を取得, 監視%s件 %.2f秒",
+            summary["listed"], len(summary["new"]), len(summary["changed"]), len(summary["removed"]),
+            summary["fetched"], summary["watched"], time.perf_counter() - started,
+        )
+        return summary
+
+    def watched_devices(self):
+        """監視する商品（一覧に載っていて、在庫状況テーブルがあり、include・excludeに合うもの）"""
+        return [
+            (url, device) for url, device in sorted(self.devices.items())
+            if device["listed"] and device.get("has_stock") and self.included(url, device.get("name"))
+        ]
+
+    def subscriptions(self):
+        """監視する商品の購読（すべての色を監視する）"""
+        return [subscription_from_entry({"url": url}, index) for index, (url, _) in enumerate(self.watched_devices())]
+
+
+def merge_discovered(subscriptions, discovered):
+    """監視リストに、見つけた商品のうちまだ監視していないページの購読を加える"""
+    pages = {subscription["page"] for subscription in subscriptions}
+    pages.update(normalize_url(subscription["url"]) for subscription in subscriptions)
+    added = [subscription for subscription in discovered if subscription["page"] not in pages]
+    return subscriptions + added
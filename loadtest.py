@@ -0,0 +1,163 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from stub_server import add_catalog_arguments, catalog_from_args, start_smtp_stub, start_stub_server
+
+# ロギングの設定
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    handlers=[
+        logging.StreamHandler(),
+    ],
+)
+logger = logging.getLogger("mineo-stock-checker-loadtest")
+
+
+def percentile(values, ratio):
+    """valuesのratio（0〜1）の位置の値（最も近い順位）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(ratio * len(ordered))) - 1))]
+
+
+def detection_delays(archive_path, catalog, urls):
+    """在庫が切り替わってから、その変化がアーカイブに記録されるまでの秒数の一覧"""
+    from stock_archive import StockArchive
+
+    delays = []
+    with StockArchive(path=archive_path) as archive:
+        for url in urls:
+            for spans in archive.timeline(url).values():
+                # 最初の期間は初回のチェックなので変化ではない
+                for previous, span in zip(spans, spans[1:]):
+                    if span["status"] != previous["status"]:
+                        delays.append(span["first_seen"] - catalog.flip_time(catalog.epoch(span["first_seen"])))
+    return delays
+
+
+def run_load_test(args):
+    """スタブサーバーの合成ページをmain()で繰り返しチェックし、スループット・遅延・メモリを計測"""
+    catalog = catalog_from_args(args)
+    server, base_url = start_stub_server()
+    server.state.latency = args.latency
+    server.state.catalog = catalog
+    smtp_server, smtp_port = start_smtp_stub()
+    urls = catalog.urls(base_url, args.urls)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report_path = os.path.join(tmp_dir, "run_report.jsonl")
+        archive_path = os.path.join(tmp_dir, "stock_archive.db")
+        os.environ.update({
+            "PRODUCT_URLS": ",".join(urls),
+            "FETCH_MODE": "http-only",
+            "CHECK_CONCURRENCY": str(args.concurrency),
+            # すべてのURLが同じホストなので、ホストごとの間隔制限は既定では外す
+            "RATE_LIMIT_INTERVAL": str(args.rate_limit),
+            "STATE_DB_FILE": os.path.join(tmp_dir, "stock_state.db"),
+            "PAGE_CACHE_FILE": os.path.join(tmp_dir, "page_cache.json"),
+            "URL_HEALTH_FILE": os.path.join(tmp_dir, "url_health.json"),
+            "ARCHIVE_DB_FILE": archive_path,
+            "NOTIFY_DEDUPE_FILE": os.path.join(tmp_dir, "notify_dedupe.json"),
+            "SNAPSHOT_DIR": os.path.join(tmp_dir, "snapshots"),
+            "SHARD_RESULTS_DIR": os.path.join(tmp_dir, "shards"),
+            "RUN_REPORT_FILE": report_path,
+            # 実行ごとの結果を最後にまとめて読むので、途中で切り替えない
+            "RUN_REPORT_MAX_MB": "0",
+            "LOG_FILE": "",
+            "EMAIL_USER": "loadtest@example.com",
+            "EMAIL_PASS": "password",
+            "RECIPIENT_EMAIL": "loadtest@example.com",
+            "SMTP_HOST": "127.0.0.1",
+            "SMTP_PORT": str(smtp_port),
+            "SMTP_SSL": "0",
+        })
+        import stock_checker
+
+        # URLごとのログは計測の邪魔になるので抑える
+        logging.getLogger("mineo-stock-checker").setLevel(logging.WARNING)
+
+        logger.info(
+            f"URL数: {len(urls)}, 色数: {args.colors}×{args.variants}モデル, ページ {args.page_kb}KB, "
+            f"遅延 {args.latency}秒, エラー率 {args.error_rate:.0%}, 並列数 {args.concurrency}"
+        )
+        started = time.time()
+        for cycle in range(args.cycles):
+            if cycle and args.cycle_interval:
+                time.sleep(args.cycle_interval)
+            stock_checker.main()
+            with open(report_path, "r", encoding="utf-8") as f:
+                report = json.loads(f.readlines()[-1])
+            check_seconds = report["stages"].get("check", report["duration"])
+            totals = [entry["timings"].get("total", 0.0) for entry in report["urls"]]
+            errors = sum(1 for entry in report["urls"] if entry["error"])
+            logger.info(
+                f"サイクル{cycle + 1}: {check_seconds:.2f}秒, {len(totals) / check_seconds:.1f}URL/秒, "
+                f"p50 {percentile(totals, 0.5) * 1000:.0f}ms, p95 {percentile(totals, 0.95) * 1000:.0f}ms, "
+                f"エラー{errors}件, キャッシュヒット{report['counters'].get('cache_hits', 0)}件"
+            )
+
+        with open(report_path, "r", encoding="utf-8") as f:
+            reports = [json.loads(line) for line in f]
+        delays = detection_delays(archive_path, catalog, urls) if catalog.flip_interval else []
+
+    server.shutdown()
+    smtp_server.shutdown()
+
+    totals = [entry["timings"].get("total", 0.0) for report in reports for entry in report["urls"]]
+    check_seconds = sum(report["stages"].get("check", report["duration"]) for report in reports)
+    summary = {
+        "urls": len(urls),
+        "cycles": len(reports),
+        "elapsed": round(time.time() - started, 3),
+        "throughput": round(len(totals) / check_seconds, 2),
+        "latency_p50": percentile(totals, 0.5),
+        "latency_p95": percentile(totals, 0.95),
+        "detections": len(delays),
+        "detection_delay_p50": percentile(delays, 0.5),
+        "detection_delay_p95": percentile(delays, 0.95),
+        "detection_delay_max": max(delays) if delays else None,
+        "peak_rss_bytes": max(report["peak_rss_bytes"] or 0 for report in reports),
+        "emails": len(smtp_server.state.messages),
+        "settings": vars(args),
+    }
+    logger.info(
+        f"スループット {summary['throughput']}URL/秒, 1URLあたり p50 {summary['latency_p50'] * 1000:.0f}ms "
+        f"/ p95 {summary['latency_p95'] * 1000:.0f}ms, ピークRSS {summary['peak_rss_bytes'] / 1024 / 1024:.1f}MB, "
+        f"通知メール{summary['emails']}通"
+    )
+    if catalog.flip_interval:
+        if delays:
+            logger.info(
+                f"在庫の切り替えの検出{len(delays)}件: 遅延 p50 {summary['detection_delay_p50']:.1f}秒 "
+                f"/ p95 {summary['detection_delay_p95']:.1f}秒 / 最大 {summary['detection_delay_max']:.1f}秒"
+            )
+        else:
+            logger.warning("在庫の切り替えを検出できませんでした（--cyclesか--flip-intervalを見直してください）")
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+        logger.info(f"結果を追記しました: {args.output}")
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="合成の商品ページを返すスタブサーバーを相手にした負荷試験")
+    parser.add_argument("--urls", type=int, default=1000, help="監視するURLの数")
+    parser.add_argument("--cycles", type=int, default=3, help="main()を実行する回数")
+    parser.add_argument("--cycle-interval", type=float, default=0.0, help="実行の間隔（秒）")
+    parser.add_argument("--concurrency", type=int, default=10, help="CHECK_CONCURRENCY")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="RATE_LIMIT_INTERVAL（秒）")
+    parser.add_argument("--output", default=None, help="結果を1行のJSONとして追記するファイル（性能の基準値として残す）")
+    add_catalog_arguments(parser)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run_load_test(parse_args(sys.argv[1:]))
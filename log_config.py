@@ -0,0 +1,101 @@
+import atexit
+import json
+import logging
+import os
+import queue
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# extraで渡された項目のうち、JSON形式のログに含めるもの
+STRUCTURED_FIELDS = ("url", "product_name", "source", "in_stock", "cells")
+
+_listener = None
+
+
+class DeferredQueueHandler(QueueHandler):
+    """メッセージの組み立てをせずにキューへ渡し、バックグラウンドのスレッドで整形させる
+
+    標準のQueueHandlerは呼び出し元のスレッドでメッセージを整形してしまうため、
+    例外の情報（スタックフレームを参照している）だけを先に文字列にする
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONにする（ログの集計・検索用）"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(log_file=None, max_bytes=None, backup_count=None, level=None, log_format=None):
+    """ルートロガーにキュー経由の出力を設定し、ファイル・コンソールへの書き込みはバックグラウンドで行う
+
+    すでに設定済みなら何もしない（logging.basicConfigと同じく、ルートロガーに
+    ハンドラーがあれば呼び出し元の設定を優先する）。戻り値のQueueListenerは終了時に自動で止まる
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    if logging.getLogger().handlers:
+        return None
+    if log_file is None:
+        log_file = os.getenv("LOG_FILE", "stock_checker.log")
+    if max_bytes is None:
+        max_bytes = int(float(os.getenv("LOG_MAX_MB", "5")) * 1024 * 1024)
+    if backup_count is None:
+        backup_count = int(os.getenv("LOG_BACKUP_COUNT", "3"))
+    if level is None:
+        level = os.getenv("LOG_LEVEL", "INFO").upper()
+    if log_format is None:
+        log_format = os.getenv("LOG_FORMAT", "text").lower()
+
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        # サイズの上限を超えたら stock_checker.log.1, .2 ... にずらす
+        handlers.append(RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"))
+    formatter = JsonFormatter() if log_format == "json" else logging.Formatter(LOG_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """キューに残っているログをすべて書き出してから止める"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, DeferredQueueHandler):
+            root.removeHandler(handler)
+    _listener = None
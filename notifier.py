@@ -0,0 +1,220 @@
+import html
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from string import Template
+
+# smtplib・ssl・emailは実際にメールを送るときに読み込む
+
+logger = logging.getLogger("mineo-stock-checker")
+
+# HTML形式のメール本文のテンプレート
+EMAIL_TEMPLATE = Template("""
+<html>
+<head>
+    <style>
+        body { font-family: Arial, sans-serif; }
+        table { border-collapse: collapse; width: 100%; }
+        th, td { border: 1px solid #ddd; padding: 8px; text-align: left; }
+        th { background-color: #f2f2f2; }
+        .stock-available { color: green; font-weight: bold; }
+        .stock-unavailable { color: red; }
+    </style>
+</head>
+<body>
+    <h2>mineo商品在庫通知</h2>
+    <p>以下の商品に在庫があります：</p>
+
+    <table>
+        <tr>
+            <th>商品名</th>
+            <th>カラー</th>
+            <th>在庫状況</th>
+        </tr>
+$rows
+    </table>
+    <p>商品ページにアクセスするには、商品名をクリックしてください。</p>
+</body>
+</html>
+""")
+
+ROW_TEMPLATE = Template("""        <tr>
+            <td><a href="$url">$product_name</a></td>
+            <td>$color</td>
+            <td class="$status_class">$status</td>
+        </tr>""")
+
+TEXT_BODY = "在庫のある商品が見つかりました。詳細はHTMLメールをご確認ください。"
+
+
+def render_email_html(in_stock_products):
+    """在庫のある商品の一覧からHTML形式のメール本文を作成"""
+    rows = []
+    for product in in_stock_products:
+        url = html.escape(product["url"], quote=True)
+        product_name = html.escape(product["product_name"])
+        for detail in product["details"]:
+            rows.append(ROW_TEMPLATE.substitute(
+                url=url,
+                product_name=product_name,
+                color=html.escape(detail["color"]),
+                status_class="stock-available" if detail["status"] == "在庫あり" else "stock-unavailable",
+                status=html.escape(detail["status"]),
+            ))
+    return EMAIL_TEMPLATE.substitute(rows="\n".join(rows))
+
+
+def build_message(in_stock_products, sender, recipients):
+    """通知メールを作成"""
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    message = MIMEMultipart("alternative")
+    message["Subject"] = f"【在庫あり】mineo商品在庫通知 ({datetime.now().strftime('%Y-%m-%d %H:%M')})"
+    message["From"] = sender
+    message["To"] = ", ".join(recipients)
+    message.attach(MIMEText(TEXT_BODY, "plain"))
+    message.attach(MIMEText(render_email_html(in_stock_products), "html"))
+    return message
+
+
+class EmailNotifier:
+    """ログイン済みのSMTP接続を使い回してメールを送る（切断されていれば接続し直す）"""
+
+    def __init__(self, user, password, recipients, host=None, port=None, use_ssl=None, timeout=None):
+        if host is None:
+            host = os.getenv("SMTP_HOST", "smtp.gmail.com")
+        if port is None:
+            port = int(os.getenv("SMTP_PORT", "465"))
+        if use_ssl is None:
+            use_ssl = os.getenv("SMTP_SSL", "1").lower() not in ("0", "false", "no")
+        if timeout is None:
+            timeout = float(os.getenv("SMTP_TIMEOUT", "30"))
+        self.user = user
+        self.password = password
+        self.recipients = recipients
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self._server = None
+        self._lock = threading.Lock()
+        # 送信ごとの所要時間（実行レポート用）
+        self.send_times = []
+
+    @classmethod
+    def from_env(cls):
+        """環境変数から作成（必要な設定が足りなければNone）"""
+        user = os.getenv("EMAIL_USER")
+        password = os.getenv("EMAIL_PASS")
+        # 送信先はカンマ区切りで複数指定できる
+        recipients = [r.strip() for r in os.getenv("RECIPIENT_EMAIL", "").split(",") if r.strip()]
+        if not all([user, password, recipients]):
+            return None
+        return cls(user, password, recipients)
+
+    def _connect(self):
+        """SMTPサーバーに接続してログイン"""
+        import smtplib
+        import ssl
+
+        if self.use_ssl:
+            context = ssl.create_default_context()
+            server = smtplib.SMTP_SSL(self.host, self.port, context=context, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.login(self.user, self.password)
+        except Exception:
+            server.close()
+            raise
+        logger.info("SMTPサーバーに接続しました: %s:%s", self.host, self.port)
+        return server
+
+    def _disconnect(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            self._server.close()
+        self._server = None
+
+    def send(self, in_stock_products):
+        """通知メールを送信（送信できたらTrueを返す）"""
+        started = time.perf_counter()
+        try:
+            return self._send(in_stock_products)
+        finally:
+            self.send_times.append(time.perf_counter() - started)
+
+    def _send(self, in_stock_products):
+        import smtplib
+
+        message = build_message(in_stock_products, self.user, self.recipients).as_string()
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._server is None:
+                        self._server = self._connect()
+                    self._server.sendmail(self.user, self.recipients, message)
+                    logger.info("在庫通知メールを送信しました: %s", ', '.join(self.recipients))
+                    return True
+                except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                    # 使い回していた接続が切れていた場合は1回だけ接続し直す
+                    self._server = None
+                    if attempt:
+                        logger.error("メール送信中にエラーが発生しました: %s", e)
+                        return False
+                    logger.warning("SMTP接続が切れていたため接続し直します: %s", e)
+                except Exception as e:
+                    logger.error("メール送信中にエラーが発生しました: %s", e)
+                    self._disconnect()
+                    return False
+        return False
+
+    def close(self):
+        """SMTP接続を閉じる"""
+        with self._lock:
+            self._disconnect()
+
+
+class NotificationQueue:
+    """通知をバックグラウンドのスレッドで送り、チェックの処理を待たせないためのキュー"""
+
+    def __init__(self, notifier):
+        self.notifier = notifier
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="notifier", daemon=True)
+        self._thread.start()
+
+    def submit(self, in_stock_products, on_sent=None):
+        """通知を送信待ちに追加（送信できたらon_sent(in_stock_products)を呼ぶ）"""
+        self._queue.put((in_stock_products, on_sent))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                in_stock_products, on_sent = item
+                if self.notifier.send(in_stock_products) and on_sent is not None:
+                    on_sent(in_stock_products)
+            except Exception as e:
+                logger.error("通知の送信処理でエラーが発生しました: %s", e)
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """送信待ちの通知がなくなるまで待つ"""
+        self._queue.join()
+
+    def close(self, timeout=None):
+        """送信待ちの通知をすべて送ってから終了"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self.notifier.close()
@@ -0,0 +1,328 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from notifier import EmailNotifier
+
+# asyncio・requestsは実際に通知を送るときに読み込む
+
+logger = logging.getLogger("mineo-stock-checker")
+
+IN_STOCK = "在庫あり"
+
+LINE_PUSH_URL = "https://api.line.me/v2/bot/message/push"
+
+
+class ChannelError(Exception):
+    """チャネルへの送信の失敗（retryableなら時間を空けて送り直す）"""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def alert_colors(product):
+    """通知する色（在庫ありに変わった色、指定がなければ在庫ありの色すべて）"""
+    return product.get("alert_colors") or [d["color"] for d in product["details"] if d["status"] == IN_STOCK]
+
+
+def alert_text(products):
+    """チャット向けの通知の本文"""
+    lines = ["【在庫あり】mineo商品在庫通知"]
+    for product in products:
+        lines.append(f"{product['product_name']}: {', '.join(alert_colors(product))}")
+        lines.append(product["url"])
+    return "\n".join(lines)
+
+
+def dedupe_key(channel_name, products):
+    """チャネルと通知の内容（商品のURLと色）から決まるキー（同じ通知を同じチャネルに2回送らないため）"""
+    items = sorted((product["url"], sorted(alert_colors(product))) for product in products)
+    data = json.dumps([channel_name, items], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+def channel_setting(name, setting, default):
+    """チャネルごとの設定（SLACK_TIMEOUTなど）、なければ全チャネル共通の設定（NOTIFY_TIMEOUTなど）"""
+    return os.getenv(f"{name.upper()}_{setting}", os.getenv(f"NOTIFY_{setting}", default))
+
+
+class WebhookChannel:
+    """JSONをPOSTするWebhook（汎用）。本文には通知の内容と重複排除のキーが入る"""
+
+    name = "webhook"
+
+    def __init__(self, url, timeout=None, retries=None, headers=None, name=None):
+        if name is not None:
+            self.name = name
+        if timeout is None:
+            timeout = float(channel_setting(self.name, "TIMEOUT", "10"))
+        if retries is None:
+            retries = int(channel_setting(self.name, "RETRIES", "2"))
+        self.url = url
+        self.timeout = timeout
+        self.retries = max(0, retries)
+        self.headers = headers or {}
+
+    def payload(self, products, key):
+        return {
+            "event": "in_stock",
+            "dedupe_key": key,
+            "text": alert_text(products),
+            "products": [
+                {
+                    "product_name": product["product_name"],
+                    "url": product["url"],
+                    "colors": alert_colors(product),
+                    "details": product["details"],
+                }
+                for product in products
+            ],
+        }
+
+    def request_headers(self, key):
+        # 受け取る側が送り直し（タイムアウト後の再送など）を見分けられるようにする
+        return dict(self.headers, **{"Idempotency-Key": key})
+
+    def send(self, products, key):
+        """1回だけ送る（失敗したらChannelError）"""
+        import requests
+
+        try:
+            response = requests.post(
+                self.url, json=self.payload(products, key), headers=self.request_headers(key), timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            raise ChannelError(str(e))
+        if response.status_code >= 400:
+            # 429とサーバー側のエラーだけ送り直す（設定の誤りなどは何度送っても失敗する）
+            raise ChannelError(
+                f"HTTP {response.status_code}: {response.text[:200]}",
+                retryable=response.status_code == 429 or response.status_code >= 500,
+            )
+
+    def close(self):
+        pass
+
+
+class SlackChannel(WebhookChannel):
+    """SlackのIncoming Webhook"""
+
+    name = "slack"
+
+    def payload(self, products, key):
+        return {"text": alert_text(products)}
+
+
+class DiscordChannel(WebhookChannel):
+    """DiscordのWebhook（本文は2000文字まで）"""
+
+    name = "discord"
+
+    def payload(self, products, key):
+        return {"content": alert_text(products)[:2000]}
+
+
+class LineChannel(WebhookChannel):
+    """LINE Messaging APIのプッシュメッセージ（本文は5000文字まで）"""
+
+    name = "line"
+
+    def __init__(self, token, to, url=None, **kwargs):
+        super().__init__(url or LINE_PUSH_URL, headers={"Authorization": f"Bearer {token}"}, **kwargs)
+        self.to = to
+
+    def payload(self, products, key):
+        return {"to": self.to, "messages": [{"type": "text", "text": alert_text(products)[:5000]}]}
+
+    def request_headers(self, key):
+        # LINEは再送の判定にUUID形式のX-Line-Retry-Keyを使う
+        return dict(self.headers, **{"X-Line-Retry-Key": str(uuid.UUID(key))})
+
+
+class EmailChannel:
+    """メール（EmailNotifierをそのまま使う）"""
+
+    name = "email"
+
+    def __init__(self, notifier, timeout=None, retries=None):
+        if timeout is None:
+            # 接続・ログイン・送信のそれぞれにSMTP_TIMEOUTがかかるので、全体では余裕を持たせる
+            timeout = float(channel_setting(self.name, "TIMEOUT", str(notifier.timeout * 2)))
+        if retries is None:
+            # EmailNotifierが切断時の接続し直しを1回行うので、既定では送り直さない
+            retries = int(os.getenv("EMAIL_RETRIES", "0"))
+        self.notifier = notifier
+        self.timeout = timeout
+        self.retries = max(0, retries)
+
+    def send(self, products, key):
+        if not self.notifier.send(products):
+            raise ChannelError("メールを送信できませんでした")
+
+    def close(self):
+        self.notifier.close()
+
+
+def channels_from_env():
+    """環境変数で設定されたチャネルの一覧"""
+    channels = []
+    email = EmailNotifier.from_env()
+    if email is not None:
+        channels.append(EmailChannel(email))
+    if os.getenv("SLACK_WEBHOOK_URL"):
+        channels.append(SlackChannel(os.getenv("SLACK_WEBHOOK_URL")))
+    if os.getenv("DISCORD_WEBHOOK_URL"):
+        channels.append(DiscordChannel(os.getenv("DISCORD_WEBHOOK_URL")))
+    if os.getenv("LINE_CHANNEL_TOKEN") and os.getenv("LINE_TO"):
+        channels.append(LineChannel(os.getenv("LINE_CHANNEL_TOKEN"), os.getenv("LINE_TO"), url=os.getenv("LINE_API_URL")))
+    if os.getenv("WEBHOOK_URL"):
+        channels.append(WebhookChannel(os.getenv("WEBHOOK_URL")))
+    return channels
+
+
+class NotificationDispatcher:
+    """1件の通知を、設定されたすべてのチャネルへasyncioで同時に送る
+
+    チャネルごとにタイムアウト・再送の回数を持ち、遅いチャネルがほかのチャネルの送信を待たせない。
+    送れたチャネルには重複排除のキーを記録し、dedupe_window秒の間は同じ通知を送らない。
+    EmailNotifierと同じくsend()・close()・send_timesを持つので、NotificationQueueからも使える
+    """
+
+    def __init__(self, channels, dedupe_path=None, dedupe_window=None, backoff=None):
+        if dedupe_path is None:
+            dedupe_path = os.getenv("NOTIFY_DEDUPE_FILE", os.path.join(".cache", "notify_dedupe.json"))
+        if dedupe_window is None:
+            dedupe_window = float(os.getenv("NOTIFY_DEDUPE_MINUTES", "10")) * 60
+        if backoff is None:
+            backoff = float(os.getenv("NOTIFY_RETRY_BACKOFF", "1"))
+        self.channels = channels
+        # 空にすると重複排除のキーをディスクに保存しない（実行中だけ覚えておく）
+        self.dedupe_path = dedupe_path
+        self.dedupe_window = dedupe_window
+        self.backoff = backoff
+        # 送信の処理はブロックするので、チャネルごとにスレッドで実行する。
+        # タイムアウトしたスレッドが残っても、ほかのチャネルと次の送信を待たせないように多めに用意する
+        self._executor = ThreadPoolExecutor(max_workers=max(4, 2 * len(channels)), thread_name_prefix="notify")
+        self._sent = self._load_sent()
+        # send()ごとの所要時間と、チャネルごとの送信結果（実行レポート用）
+        self.send_times = []
+        self.deliveries = []
+
+    @classmethod
+    def from_env(cls):
+        """環境変数から作成（チャネルが1つも設定されていなければNone）"""
+        channels = channels_from_env()
+        if not channels:
+            return None
+        logger.info("通知チャネル: %s", ", ".join(channel.name for channel in channels))
+        return cls(channels)
+
+    def _load_sent(self):
+        if not self.dedupe_path or not os.path.exists(self.dedupe_path):
+            return {}
+        try:
+            with open(self.dedupe_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("通知の重複排除の記録を読み込めませんでした: %s", e)
+            return {}
+
+    def _save_sent(self):
+        now = time.time()
+        self._sent = {key: sent_at for key, sent_at in self._sent.items() if now - sent_at < self.dedupe_window}
+        if not self.dedupe_path:
+            return
+        try:
+            directory = os.path.dirname(self.dedupe_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = self.dedupe_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._sent, f)
+            os.replace(tmp_path, self.dedupe_path)
+        except OSError as e:
+            logger.warning("通知の重複排除の記録を保存できませんでした: %s", e)
+
+    def send(self, in_stock_products, dedupe=True):
+        """すべてのチャネルへ同時に送り、すべてのチャネルに送れたら（送信済みを含む）Trueを返す
+
+        1つでも失敗したらFalseを返し、呼び出し元は通知済みにしない。次に同じ通知を送ると、
+        送れたチャネルは重複排除のキーでスキップされ、失敗したチャネルにだけ送り直される
+        """
+        import asyncio
+
+        started = time.perf_counter()
+        try:
+            deliveries = asyncio.run(self.dispatch(in_stock_products, dedupe))
+        finally:
+            self.send_times.append(time.perf_counter() - started)
+        self._save_sent()
+        self.deliveries.extend(deliveries)
+        logger.info("通知の送信結果: %s", " / ".join(format_delivery(delivery) for delivery in deliveries))
+        return all(delivery["ok"] for delivery in deliveries)
+
+    async def dispatch(self, in_stock_products, dedupe=True):
+        """すべてのチャネルへ同時に送り、チャネルごとの結果を返す"""
+        import asyncio
+
+        return list(await asyncio.gather(
+            *(self._deliver(channel, in_stock_products, dedupe) for channel in self.channels)
+        ))
+
+    async def _deliver(self, channel, products, dedupe):
+        import asyncio
+
+        key = dedupe_key(channel.name, products)
+        delivery = {"channel": channel.name, "ok": False, "deduped": False, "attempts": 0, "latency": 0.0, "error": None}
+        if dedupe and time.time() - self._sent.get(key, float("-inf")) < self.dedupe_window:
+            logger.info("同じ通知を送信済みのためスキップします: %s", channel.name)
+            delivery.update(ok=True, deduped=True)
+            return delivery
+
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        for attempt in range(channel.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            delivery["attempts"] = attempt + 1
+            try:
+                await asyncio.wait_for(loop.run_in_executor(self._executor, channel.send, products, key), channel.timeout)
+                delivery["ok"] = True
+                delivery["error"] = None
+                self._sent[key] = time.time()
+                break
+            except asyncio.TimeoutError:
+                delivery["error"] = f"{channel.timeout:.0f}秒以内に送信できませんでした"
+                retryable = True
+            except ChannelError as e:
+                delivery["error"] = str(e)
+                retryable = e.retryable
+            except Exception as e:
+                delivery["error"] = str(e)
+                retryable = True
+            logger.warning("%sへの通知に失敗しました (%s回目): %s", channel.name, attempt + 1, delivery["error"])
+            if not retryable:
+                break
+        delivery["latency"] = time.perf_counter() - started
+        if not delivery["ok"]:
+            logger.error("%sへ通知できませんでした: %s", channel.name, delivery["error"])
+        return delivery
+
+    def close(self):
+        """チャネルの接続を閉じる（タイムアウトして残っている送信は待たない）"""
+        self._executor.shutdown(wait=False)
+        for channel in self.channels:
+            channel.close()
+
+
+def format_delivery(delivery):
+    if delivery["deduped"]:
+        return f"{delivery['channel']} 送信済み"
+    if delivery["ok"]:
+        return f"{delivery['channel']} {delivery['latency']:.2f}秒"
+    return f"{delivery['channel']} 失敗（{delivery['attempts']}回）"
@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("mineo-stock-checker")
+
+
+class PageCache:
+    """URLごとの取得結果をディスクに保存し、変化のないページの再判定を省くキャッシュ"""
+
+    def __init__(self, path=None, max_entries=None, refresh=None):
+        if path is None:
+            path = os.getenv("PAGE_CACHE_FILE", os.path.join(".cache", "page_cache.json"))
+        if max_entries is None:
+            max_entries = int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "500"))
+        if refresh is None:
+            refresh = os.getenv("PAGE_CACHE_REFRESH", "").lower() in ("1", "true", "yes")
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        # Trueのときはキャッシュを参照せず、すべてのページを判定し直す（保存はする）
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def load(self):
+        """ディスクからキャッシュを読み込む（壊れていれば空から始める）"""
+        if not os.path.exists(self.path):
+            return self
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+            logger.info("ページキャッシュを読み込みました: %s件", len(self._entries))
+        except (OSError, ValueError) as e:
+            logger.warning("ページキャッシュを読み込めませんでした: %s", e)
+            self._entries = {}
+        return self
+
+    def save(self):
+        """古いものから件数の上限まで削ってディスクに書き込む"""
+        with self._lock:
+            if len(self._entries) > self.max_entries:
+                oldest = sorted(self._entries, key=lambda url: self._entries[url]["used_at"])
+                for url in oldest[:len(self._entries) - self.max_entries]:
+                    del self._entries[url]
+            entries = dict(self._entries)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def validators(self, url, colors=None):
+        """条件付きGETに使うヘッダー（If-None-Match / If-Modified-Since）"""
+        entry = None if self.refresh else self._entries.get(url)
+        # 判定した色が違う結果しかなければ、304が返ってきても使えない
+        if entry and entry.get("colors") != (sorted(colors) if colors else None):
+            entry = None
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def not_modified(self, url, colors=None):
+        """304が返ってきたURLの前回の結果"""
+        return self._hit(url, None, colors)
+
+    def lookup(self, url, fragment_hash, colors=None):
+        """在庫状況テーブルが前回と同じなら前回の結果を返す"""
+        return self._hit(url, fragment_hash, colors)
+
+    def _hit(self, url, fragment_hash, colors):
+        with self._lock:
+            entry = None if self.refresh else self._entries.get(url)
+            # 判定した色が違えば（監視リストが変わった）前回の結果は使えない
+            if entry and entry.get("colors") != (sorted(colors) if colors else None):
+                entry = None
+            if entry and (fragment_hash is None or entry["fragment_hash"] == fragment_hash):
+                entry["used_at"] = time.time()
+                self.hits += 1
+                return dict(entry["result"])
+            self.misses += 1
+            return None
+
+    def store(self, url, fragment_hash, result, etag=None, last_modified=None, colors=None):
+        """判定結果を保存（エラーになった結果は保存しない。colorsは判定した色）"""
+        if result.get("error"):
+            return
+        with self._lock:
+            self._entries[url] = {
+                "fragment_hash": fragment_hash,
+                "etag": etag,
+                "last_modified": last_modified,
+                "colors": sorted(colors) if colors else None,
+                "used_at": time.time(),
+                "result": {
+                    "product_name": result["product_name"],
+                    "in_stock": result["in_stock"],
+                    "details": result["details"],
+                },
+            }
+
+    def summary(self):
+        """実行結果の要約に出すヒット・ミスの件数"""
+        return f"キャッシュ ヒット{self.hits}件 / ミス{self.misses}件"
@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windowsにはresourceモジュールがない
+    resource = None
+
+logger = logging.getLogger("mineo-stock-checker")
+
+METRIC_PREFIX = "mineo_stock_checker"
+
+
+def peak_rss_bytes():
+    """このプロセスと終了済みの子プロセス（Chrome・chromedriver）の最大RSS（バイト）"""
+    if resource is None:
+        return None, None
+    # LinuxではKB単位、macOSではバイト単位
+    unit = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    return own, children
+
+
+class RunReport:
+    """1回の実行の段階ごとの所要時間とメモリ使用量をまとめ、JSONL・Prometheus形式で書き出す"""
+
+    def __init__(self, mode="once"):
+        self.mode = mode
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.stages = {}
+        self.durations = {}
+        self.urls = []
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        """withブロックの所要時間を段階nameとして記録"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+
+    def add_durations(self, name, durations):
+        """Chromeの起動やSMTP送信など、回数が決まっていない処理の所要時間を記録"""
+        self.durations.setdefault(name, []).extend(durations)
+
+    def add_results(self, results):
+        """URLごとの段階別の所要時間を記録"""
+        for result in results:
+            self.urls.append({
+                "url": result["url"],
+                "source": result.get("source"),
+                "cached": bool(result.get("cached")),
+                "skipped": bool(result.get("skipped")),
+                "error": result.get("error"),
+                "timings": result.get("timings", {}),
+                "transfer": result.get("transfer"),
+            })
+
+    def count(self, name, value):
+        self.counters[name] = value
+
+    def to_dict(self):
+        own, children = peak_rss_bytes()
+        stage_totals = {}
+        http_bytes = 0
+        for entry in self.urls:
+            for stage, seconds in entry["timings"].items():
+                stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+            if entry["transfer"]:
+                http_bytes += entry["transfer"]["bytes"]
+        return {
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds"),
+            "mode": self.mode,
+            "duration": round(time.perf_counter() - self._started, 3),
+            "peak_rss_bytes": own,
+            "peak_rss_children_bytes": children,
+            "stages": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            "url_stage_totals": {name: round(seconds, 3) for name, seconds in stage_totals.items()},
+            "durations": {name: [round(d, 3) for d in values] for name, values in self.durations.items()},
+            "http_bytes": http_bytes,
+            "counters": self.counters,
+            "urls": self.urls,
+        }
+
+    def write(self, path=None, prometheus_path=None, max_bytes=None, backup_count=None):
+        """JSONLに1行追記し、設定されていればPrometheusのテキストファイルも書き出す
+
+        ファイルがmax_bytesを超えるときは、ログと同じく古い方から backup_count 個（.1, .2, ...）だけ残して切り替える
+        """
+        if path is None:
+            path = os.getenv("RUN_REPORT_FILE", os.path.join(".cache", "run_report.jsonl"))
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv("RUN_REPORT_MAX_MB", "5")) * 1024 * 1024)
+        if backup_count is None:
+            backup_count = int(os.getenv("RUN_REPORT_BACKUP_COUNT", "3"))
+        if prometheus_path is None:
+            prometheus_path = os.getenv("PROMETHEUS_TEXTFILE")
+        report = self.to_dict()
+        try:
+            if path:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                line = json.dumps(report, ensure_ascii=False) + "\n"
+                if max_bytes and os.path.exists(path) and os.path.getsize(path) + len(line.encode("utf-8")) > max_bytes:
+                    rotate_file(path, backup_count)
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            if prometheus_path:
+                write_prometheus_textfile(report, prometheus_path)
+        except OSError as e:
+            logger.warning("実行レポートを書き出せませんでした: %s", e)
+        logger.info(
+            "実行レポート: %.2f秒, 段階別 %s, ピークRSS %s (子プロセス %s)",
+            report["duration"], report["stages"],
+            format_bytes(report["peak_rss_bytes"]), format_bytes(report["peak_rss_children_bytes"]),
+        )
+        return report
+
+
+def rotate_file(path, backup_count):
+    """RotatingFileHandlerと同じく path → path.1 → path.2 … と名前を変え、backup_countより古いものは消す"""
+    if backup_count <= 0:
+        os.remove(path)
+        return
+    for index in range(backup_count - 1, 0, -1):
+        source = f"{path}.{index}"
+        if os.path.exists(source):
+            os.replace(source, f"{path}.{index + 1}")
+    os.replace(path, f"{path}.1")
+
+
+def format_bytes(value):
+    return "不明" if value is None else f"{value / 1024 / 1024:.1f}MB"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_prometheus_textfile(report, path):
+    """node_exporterのtextfileコレクタ向けにメトリクスを書き出す"""
+    lines = [
+        f"# HELP {METRIC_PREFIX}_run_duration_seconds Duration of the last run.",
+        f"# TYPE {METRIC_PREFIX}_run_duration_seconds gauge",
+        f"{METRIC_PREFIX}_run_duration_seconds {report['duration']}",
+        f"# HELP {METRIC_PREFIX}_run_timestamp_seconds Start time of the last run.",
+        f"# TYPE {METRIC_PREFIX}_run_timestamp_seconds gauge",
+        f"{METRIC_PREFIX}_run_timestamp_seconds {datetime.fromisoformat(report['started_at']).timestamp():.0f}",
+    ]
+    for name in ("peak_rss_bytes", "peak_rss_children_bytes", "http_bytes"):
+        if report[name] is not None:
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+            lines.append(f"{METRIC_PREFIX}_{name} {report[name]}")
+    lines.append(f"# HELP {METRIC_PREFIX}_stage_seconds Time spent in each run-level stage.")
+    lines.append(f"# TYPE {METRIC_PREFIX}_stage_seconds gauge")
+    for stage, seconds in report["stages"].items():
+        lines.append(f'{METRIC_PREFIX}_stage_seconds{{stage="{escape_label(stage)}"}} {seconds}')
+    lines.append(f"# HELP {METRIC_PREFIX}_url_stage_seconds Time spent in each stage per URL.")
+    lines.append(f"# TYPE {METRIC_PREFIX}_url_stage_seconds gauge")
+    for entry in report["urls"]:
+        for stage, seconds in entry["timings"].items():
+            lines.append(
+                f'{METRIC_PREFIX}_url_stage_seconds{{url="{escape_label(entry["url"])}",stage="{escape_label(stage)}"}} {seconds}'
+            )
+    lines.append(f"# TYPE {METRIC_PREFIX}_duration_seconds_sum gauge")
+    lines.append(f"# TYPE {METRIC_PREFIX}_duration_seconds_count gauge")
+    for name, values in report["durations"].items():
+        lines.append(f'{METRIC_PREFIX}_duration_seconds_sum{{operation="{escape_label(name)}"}} {sum(values):.3f}')
+        lines.append(f'{METRIC_PREFIX}_duration_seconds_count{{operation="{escape_label(name)}"}} {len(values)}')
+    lines.append(f"# TYPE {METRIC_PREFIX}_run_counter gauge")
+    for name, value in report["counters"].items():
+        lines.append(f'{METRIC_PREFIX}_run_counter{{name="{escape_label(name)}"}} {value}')
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # 書きかけのファイルを読まれないように、一時ファイルに書いてから置き換える
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
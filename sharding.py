@@ -0,0 +1,119 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger("mineo-stock-checker")
+
+
+def parse_shard(value):
+    """「i/n」形式（iは0から始まる）の指定を (i, n) にする"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ValueError(f"シャードの指定は i/n の形式で指定してください: {value}")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"シャードの番号は 0 以上 {count} 未満で指定してください: {value}")
+    return index, count
+
+
+def get_shard(value=None):
+    """--shard または環境変数（SHARD="i/n"、SHARD_INDEX・SHARD_COUNT）から担当するシャードを決める
+
+    指定がなければNone（すべてのURLを担当する）
+    """
+    if value is None:
+        value = os.getenv("SHARD", "").strip()
+    if not value and os.getenv("SHARD_COUNT"):
+        value = f"{os.getenv('SHARD_INDEX', '0')}/{os.getenv('SHARD_COUNT')}"
+    if not value:
+        return None
+    return parse_shard(value)
+
+
+def shard_for(url, count):
+    """URLを担当するシャード（ランデブーハッシュ）
+
+    URLとシャード番号の組ごとの重みが最大のシャードに割り当てるので、
+    監視するURLが増減しても他のURLの担当は変わらず、シャード数を変えたときも移動は最小限になる
+    """
+    return max(range(count), key=lambda index: hashlib.sha1(f"{index}:{url}".encode("utf-8")).digest())
+
+
+def select_shard(urls, shard):
+    """担当するシャードのURLだけを元の順番のまま返す"""
+    if shard is None:
+        return list(urls)
+    index, count = shard
+    return [url for url in urls if shard_for(url, count) == index]
+
+
+def shard_results_dir():
+    return os.getenv("SHARD_RESULTS_DIR", os.path.join(".cache", "shards"))
+
+
+def partial_result_path(shard, directory=None):
+    if directory is None:
+        directory = shard_results_dir()
+    index, count = shard
+    return os.path.join(directory, f"shard-{index}-of-{count}.json")
+
+
+def write_partial_results(shard, urls, results, directory=None):
+    """シャードのチェック結果をファイルに書き出す（マージの段階で読み込む）"""
+    path = partial_result_path(shard, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = {
+        "shard": shard[0],
+        "count": shard[1],
+        "finished_at": time.time(),
+        "urls": urls,
+        "results": results,
+    }
+    # 書きかけのファイルを読まれないように、一時ファイルに書いてから置き換える
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    logger.info("シャード %s/%s の結果を書き出しました: %s (%s件)", shard[0], shard[1], path, len(results))
+    return path
+
+
+def load_partial_results(directory=None):
+    """すべてのシャードの結果を読み込み、(結果のリスト, 読み込んだファイル, 見つからないシャード) を返す"""
+    if directory is None:
+        directory = shard_results_dir()
+    if not os.path.isdir(directory):
+        return [], [], []
+    partials = []
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith("shard-") and name.endswith(".json")):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                partials.append(json.load(f))
+            paths.append(path)
+        except (OSError, ValueError) as e:
+            logger.warning("シャードの結果を読み込めませんでした: %s - %s", path, e)
+    if not partials:
+        return [], paths, []
+
+    # シャード数が混在していたら最新の実行のものだけを使う
+    count = max(partials, key=lambda partial: partial["finished_at"])["count"]
+    partials = [partial for partial in partials if partial["count"] == count]
+    found = {partial["shard"] for partial in partials}
+    missing = [index for index in range(count) if index not in found]
+
+    results = []
+    for partial in sorted(partials, key=lambda partial: partial["shard"]):
+        results.extend(partial["results"])
+    return results, paths, missing
+
+
+def order_results(results, urls):
+    """マージした結果を監視リストの順番に並べる（リストにないURLは最後）"""
+    position = {url: index for index, url in enumerate(urls)}
+    return sorted(results, key=lambda result: position.get(result["url"], len(position)))
@@ -0,0 +1,228 @@
+import gzip
+import hashlib
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:  # zstandardがなければgzipで圧縮する
+    zstandard = None
+
+logger = logging.getLogger("mineo-stock-checker")
+
+# この在庫状況が含まれていたら、原因を調べられるようにページ全体を保存する
+FULL_PAGE_STATUSES = ("状態不明", "判断不能（要確認）")
+
+COMPRESSIONS = {
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+
+
+def default_compression():
+    return "zstd" if zstandard is not None else "gzip"
+
+
+def url_key(url):
+    """URLごとの保存先ディレクトリ名"""
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+
+
+def needs_full_page(result):
+    """ページ全体を保存すべき判定結果か（判断できない色がある、在庫情報が見つからない）"""
+    if result.get("error"):
+        return True
+    return any(detail["status"] in FULL_PAGE_STATUSES for detail in result["details"])
+
+
+def compress(data, compression):
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress(data, path):
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("zstdで圧縮されたスナップショットを読むにはzstandardが必要です")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class SnapshotStore:
+    """デバッグ用に、取得したページを圧縮してURLごとに直近の数件だけ保存する
+
+    書き込みはバックグラウンドのスレッドで行い、チェックの処理を待たせない。
+    通常は在庫判定に使った部分（商品名と在庫状況テーブル）だけを保存し、
+    判定できなかったページだけページ全体を保存する
+    """
+
+    def __init__(self, directory=None, per_url=None, max_bytes=None, compression=None):
+        if directory is None:
+            directory = os.getenv("SNAPSHOT_DIR", os.path.join(".cache", "snapshots"))
+        if per_url is None:
+            per_url = int(os.getenv("SNAPSHOT_PER_URL", "5"))
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv("SNAPSHOT_MAX_MB", "50")) * 1024 * 1024)
+        if compression is None:
+            compression = os.getenv("SNAPSHOT_COMPRESSION", default_compression()).strip().lower()
+        if compression not in COMPRESSIONS or (compression == "zstd" and zstandard is None):
+            logger.warning("使用できないSNAPSHOT_COMPRESSIONです: %s（gzipを使用します）", compression)
+            compression = "gzip"
+        self.directory = directory
+        # 0にするとスナップショットを保存しない
+        self.per_url = max(0, per_url)
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.written = 0
+        self._total_bytes = None
+        self._queue = queue.Queue()
+        self._thread = None
+        if self.enabled:
+            self._thread = threading.Thread(target=self._run, name="snapshots", daemon=True)
+            self._thread.start()
+
+    @property
+    def enabled(self):
+        return self.per_url > 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def save(self, url, soup, html, result, partial=False):
+        """スナップショットを保存待ちに追加（文字列化と圧縮・書き込みはバックグラウンドで行う）
+
+        partialは、htmlがページの途中までしかないこと（ダウンロードを打ち切った場合）を示す
+        """
+        if not self.enabled:
+            return
+        if needs_full_page(result):
+            self._queue.put((url, "partial" if partial else "full", html, time.time()))
+        else:
+            self._queue.put((url, "fragment", soup, time.time()))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                logger.warning("スナップショットを保存できませんでした: %s", e)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, url, kind, content, saved_at):
+        if self._total_bytes is None:
+            self._total_bytes = sum(size for _, size in self._all_files())
+        url_dir = os.path.join(self.directory, url_key(url))
+        os.makedirs(url_dir, exist_ok=True)
+        url_file = os.path.join(url_dir, "url.txt")
+        if not os.path.exists(url_file):
+            with open(url_file, "w", encoding="utf-8") as f:
+                f.write(url + "\n")
+
+        data = compress(str(content).encode("utf-8"), self.compression)
+        name = f"{int(saved_at * 1000)}-{kind}.html{COMPRESSIONS[self.compression]}"
+        path = os.path.join(url_dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        self._total_bytes += len(data)
+        self.written += 1
+
+        # URLごとに新しいものから件数の上限まで残す
+        for old_path in snapshot_files(url_dir)[:-self.per_url]:
+            self._remove(old_path)
+        # 全体の容量を超えたら、URLに関係なく古いものから削除する
+        if self._total_bytes > self.max_bytes:
+            for old_path, _ in sorted(self._all_files(), key=lambda item: os.path.basename(item[0])):
+                if self._total_bytes <= self.max_bytes or old_path == path:
+                    break
+                self._remove(old_path)
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self._total_bytes -= size
+        except OSError:
+            pass
+
+    def _all_files(self):
+        """保存済みのすべてのスナップショットの (パス, サイズ)"""
+        if not os.path.isdir(self.directory):
+            return []
+        files = []
+        for name in os.listdir(self.directory):
+            url_dir = os.path.join(self.directory, name)
+            if os.path.isdir(url_dir):
+                files.extend((path, os.path.getsize(path)) for path in snapshot_files(url_dir))
+        return files
+
+    def flush(self):
+        """保存待ちのスナップショットがなくなるまで待つ"""
+        if self.enabled:
+            self._queue.join()
+
+    def close(self, timeout=None):
+        """保存待ちのスナップショットをすべて書き込んでから終了"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+
+def snapshot_files(url_dir):
+    """URLのディレクトリにあるスナップショットを古い順に返す"""
+    names = [name for name in os.listdir(url_dir) if name.endswith(tuple(COMPRESSIONS.values()))]
+    return [os.path.join(url_dir, name) for name in sorted(names)]
+
+
+def list_snapshots(directory=None, url=None):
+    """保存済みのスナップショットの一覧 [(URL, 保存時刻, 種類, パス)]（新しい順）"""
+    if directory is None:
+        directory = os.getenv("SNAPSHOT_DIR", os.path.join(".cache", "snapshots"))
+    if not os.path.isdir(directory):
+        return []
+    snapshots = []
+    for name in os.listdir(directory):
+        url_dir = os.path.join(directory, name)
+        url_file = os.path.join(url_dir, "url.txt")
+        if not os.path.exists(url_file):
+            continue
+        with open(url_file, "r", encoding="utf-8") as f:
+            snapshot_url = f.read().strip()
+        if url and snapshot_url != url:
+            continue
+        for path in snapshot_files(url_dir):
+            stamp, kind = os.path.basename(path).split(".", 1)[0].split("-", 1)
+            snapshots.append((snapshot_url, int(stamp) / 1000, kind, path))
+    return sorted(snapshots, key=lambda snapshot: snapshot[1], reverse=True)
+
+
+def read_snapshot(path):
+    """スナップショットを展開してHTMLを返す"""
+    with open(path, "rb") as f:
+        return decompress(f.read(), path).decode("utf-8")
+
+
+if __name__ == "__main__":
+    # 使い方: python snapshot_store.py [URL]  （URLを指定すると最新のスナップショットを出力）
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    url = sys.argv[1] if len(sys.argv) > 1 else None
+    snapshots = list_snapshots(url=url)
+    if url and snapshots:
+        print(read_snapshot(snapshots[0][3]))
+    else:
+        for snapshot_url, saved_at, kind, path in snapshots:
+            saved = datetime.fromtimestamp(saved_at).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{saved}  {kind:<8}  {os.path.getsize(path):>8}  {snapshot_url}")
@@ -0,0 +1,325 @@
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from stock_extractor import color_matches
+from watch_list import normalize_url
+
+# http.serverは状態APIを起動するときに読み込む
+
+logger = logging.getLogger("mineo-stock-checker")
+
+# 状態として公開する項目（変化の判定にも使う）
+PUBLIC_FIELDS = ("product_name", "in_stock", "details", "error")
+
+
+def encode(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class StatusBoard:
+    """最新のチェック結果をメモリに持ち、変化があるたびに版（version）を進める
+
+    商品ごとに最後に変わった版を覚えておき、since=版 で前回からの差分だけを返す。
+    全体のJSONはチェック結果を反映するたびに1回だけ作り、以後のリクエストにはそのまま返す。
+    ETagは版から作る弱いETag（同じ版ならchecked_atだけが違っても同じ内容とみなす）
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.updated_at = None
+        self._entries = {}
+        self._removed = {}
+        self._changed = threading.Condition()
+        self._body = None
+        self.closed = False
+
+    def load(self, path):
+        """前回書き出した状態ファイルから再開する（版の番号を引き継ぐ）"""
+        if not path or not os.path.exists(path):
+            return self
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            with self._changed:
+                self.version = data["version"]
+                self.updated_at = data.get("updated_at")
+                self._entries = {entry["url"]: entry for entry in data["products"]}
+                self._body = None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("状態ファイルを読み込めませんでした: %s", e)
+        return self
+
+    def publish(self, results, now=None):
+        """チェック結果を反映し、変化した商品の数を返す（エラーの商品は前回の在庫状況を残す）"""
+        if now is None:
+            now = time.time()
+        changed = []
+        with self._changed:
+            for result in results:
+                url = result["url"]
+                previous = self._entries.get(url)
+                entry = {field: result.get(field) for field in PUBLIC_FIELDS}
+                if result.get("error") and previous is not None:
+                    entry.update(in_stock=previous["in_stock"], details=previous["details"])
+                if previous is not None and self._same(previous, entry):
+                    previous["checked_at"] = now
+                    self._body = None
+                    continue
+                changed.append(url)
+                entry.update(url=url, checked_at=now, changed_at=now)
+                self._entries[url] = entry
+                self._removed.pop(url, None)
+            if changed:
+                self._bump(changed, now)
+        return len(changed)
+
+    def _same(self, previous, entry):
+        # エラーの文言（タイムアウトの秒数など）の違いでは変化としない
+        return (
+            all(previous[field] == entry[field] for field in ("product_name", "in_stock", "details"))
+            and bool(previous["error"]) == bool(entry["error"])
+        )
+
+    def retain(self, urls, now=None):
+        """監視リストから外れた商品を取り除く"""
+        if now is None:
+            now = time.time()
+        urls = set(urls)
+        with self._changed:
+            removed = [url for url in self._entries if url not in urls]
+            for url in removed:
+                del self._entries[url]
+            if removed:
+                self._bump(removed, now, removed=True)
+        return len(removed)
+
+    def _bump(self, urls, now, removed=False):
+        self.version += 1
+        self.updated_at = now
+        for url in urls:
+            if removed:
+                self._removed[url] = self.version
+            else:
+                self._entries[url]["version"] = self.version
+        self._body = None
+        self._changed.notify_all()
+
+    def snapshot(self, since=None):
+        """全体（sinceを指定するとその版より後に変わった商品と、取り除かれた商品のURL）"""
+        with self._changed:
+            products = [
+                entry for entry in self._entries.values()
+                if since is None or entry.get("version", 0) > since
+            ]
+            data = {"version": self.version, "updated_at": self.updated_at, "products": products}
+            if since is not None:
+                data["since"] = since
+                data["removed"] = [url for url, version in self._removed.items() if version > since]
+            return data
+
+    def body(self):
+        """全体のJSON（版が変わるまで同じバイト列を使い回す）と版"""
+        with self._changed:
+            if self._body is None:
+                self._body = encode(self.snapshot())
+            return self._body, self.version
+
+    def product(self, url):
+        """商品1件（URLは正規化して比べる）"""
+        with self._changed:
+            entry = self._entries.get(url)
+            if entry is None:
+                key = normalize_url(url)
+                entry = next((e for u, e in self._entries.items() if normalize_url(u) == key), None)
+            return entry
+
+    def wait(self, since, timeout):
+        """版がsinceより進むまで最大timeout秒待ち、進んだかを返す"""
+        with self._changed:
+            return self._changed.wait_for(lambda: self.version > since or self.closed, timeout)
+
+    def close(self):
+        """待っている長いポーリング・SSEを終わらせる"""
+        with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+
+    def write(self, path):
+        """状態ファイルに書き出す（静的なファイルとしてWebサーバーから配信できる）"""
+        body, _ = self.body()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+
+def color_view(entry, color):
+    """商品の結果を色で絞る（色名の一部でもよい）"""
+    details = [detail for detail in entry["details"] or [] if color_matches(detail["color"], [color])]
+    return dict(entry, details=details, in_stock=any(detail["status"] == "在庫あり" for detail in details))
+
+
+def make_handler(board, max_wait, keepalive):
+    """StatusBoardを読み取り専用で返すハンドラのクラスを作る"""
+    from http.server import BaseHTTPRequestHandler
+
+    class StatusHandler(BaseHTTPRequestHandler):
+        """GET /status（?since=版&wait=秒&color=色）・/status/product?url=&color=・/status/events（SSE）"""
+
+        server_version = "mineo-stock-status/1.0"
+        protocol_version = "HTTP/1.1"
+        # ヘッダーと本文を1回で送る（分けて送ると、接続を使い回すクライアントで遅延確認応答を待つことになる）
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            logger.debug("状態API: %s - %s", self.address_string(), format % args)
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+            try:
+                if parsed.path == "/status":
+                    self.send_status(query)
+                elif parsed.path == "/status/product":
+                    self.send_product(query)
+                elif parsed.path == "/status/events":
+                    self.send_events()
+                elif parsed.path == "/healthz":
+                    self.send_json(200, {"ok": True, "version": board.version})
+                else:
+                    self.send_json(404, {"error": "not found"})
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+        def do_POST(self):
+            self.send_json(405, {"error": "read only"}, {"Allow": "GET"})
+
+        do_PUT = do_DELETE = do_PATCH = do_POST
+
+        def send_status(self, query):
+            since = int(query["since"]) if "since" in query else None
+            wait = min(float(query.get("wait", 0)), max_wait)
+            # 長いポーリング: sinceより新しい版ができるまで待つ
+            if since is not None and wait > 0:
+                board.wait(since, wait)
+            if query.get("color"):
+                # 全商品を色で絞る（色名の一部でもよい）
+                data = board.snapshot(since)
+                data["products"] = [
+                    view for view in (color_view(entry, query["color"]) for entry in data["products"]) if view["details"]
+                ]
+                self.send_json(200, data, {"ETag": f'W/"{data["version"]}"'})
+                return
+            if since is None:
+                body, version = board.body()
+                etag = f'W/"{version}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_body(304, b"", {"ETag": etag})
+                    return
+                self.send_body(200, body, {"ETag": etag})
+                return
+            data = board.snapshot(since)
+            self.send_json(200, data, {"ETag": f'W/"{data["version"]}"'})
+
+        def send_product(self, query):
+            if not query.get("url"):
+                raise ValueError("url を指定してください")
+            entry = board.product(query["url"])
+            if entry is None:
+                self.send_json(404, {"error": "監視していない商品です", "url": query["url"]})
+                return
+            if query.get("color"):
+                entry = color_view(entry, query["color"])
+                if not entry["details"]:
+                    self.send_json(404, {"error": "その色はありません", "color": query["color"]})
+                    return
+            etag = f'W/"{entry.get("version", 0)}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_body(304, b"", {"ETag": etag})
+                return
+            self.send_json(200, entry, {"ETag": etag})
+
+        def send_events(self):
+            """Server-Sent Events: 版が進むたびに差分を送る（Last-Event-IDから再開できる）"""
+            last = self.headers.get("Last-Event-ID")
+            since = int(last) if last and last.isdigit() else None
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            if since is None:
+                # 接続した時点の全体を最初に送る
+                since = self.send_event(board.snapshot())
+            while not board.closed:
+                if board.wait(since, keepalive) and not board.closed:
+                    since = self.send_event(board.snapshot(since))
+                else:
+                    # 途中のプロキシに切られないように、コメント行を送る
+                    self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+
+        def send_event(self, data):
+            self.wfile.write(
+                f"id: {data['version']}\nevent: status\ndata: ".encode("utf-8") + encode(data) + b"\n\n"
+            )
+            self.wfile.flush()
+            return data["version"]
+
+        def send_json(self, status, data, headers=None):
+            self.send_body(status, encode(data), headers)
+
+        def send_body(self, status, body, headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            if status != 304:
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(body)
+
+    return StatusHandler
+
+
+def start_status_server(board, host=None, port=None, max_wait=None, keepalive=None):
+    """状態APIをバックグラウンドのスレッドで起動し、サーバーを返す（ポートが設定されていなければNone）"""
+    if host is None:
+        host = os.getenv("STATUS_API_HOST", "127.0.0.1")
+    if port is None:
+        port = os.getenv("STATUS_API_PORT", "")
+        if port == "":
+            return None
+        port = int(port)
+    if max_wait is None:
+        max_wait = float(os.getenv("STATUS_API_MAX_WAIT", "60"))
+    if keepalive is None:
+        keepalive = float(os.getenv("STATUS_API_KEEPALIVE", "15"))
+    from http.server import ThreadingHTTPServer
+
+    server = ThreadingHTTPServer((host, port), make_handler(board, max_wait, keepalive))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="status-api", daemon=True)
+    thread.start()
+    logger.info("状態APIを起動しました: http://%s:%s/status", host, server.server_address[1])
+    return server
+
+
+def stop_status_server(server, board):
+    """状態APIを止める（待っている長いポーリング・SSEも終わらせる）"""
+    board.close()
+    if server is not None:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,242 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("mineo-stock-checker")
+
+IN_STOCK = "在庫あり"
+
+# 観測ごとに記録する値（すべて同じなら同じ期間としてまとめる）
+VALUE_COLUMNS = ("status", "full_price", "installment_price", "fraction_off")
+
+# observations: チェックのたびに追記する観測（まとめる前）
+# spans: 値が変わらなかった観測を1行にまとめた期間（最初と最後に観測した時刻と観測の回数）
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS observations (
+    url TEXT NOT NULL,
+    color TEXT NOT NULL,
+    observed_at REAL NOT NULL,
+    status TEXT NOT NULL,
+    full_price INTEGER,
+    installment_price INTEGER,
+    fraction_off TEXT
+);
+CREATE INDEX IF NOT EXISTS observations_url_color ON observations (url, color, observed_at);
+CREATE TABLE IF NOT EXISTS spans (
+    url TEXT NOT NULL,
+    color TEXT NOT NULL,
+    status TEXT NOT NULL,
+    full_price INTEGER,
+    installment_price INTEGER,
+    fraction_off TEXT,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    samples INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS spans_url_color ON spans (url, color, first_seen);
+"""
+
+
+def fold(spans, observations):
+    """時刻順の観測をspansに続けてまとめる（値が直前の期間と同じなら伸ばし、違えば新しい期間にする）"""
+    for observation in observations:
+        last = spans[-1] if spans else None
+        if last is not None and all(last[column] == observation[column] for column in VALUE_COLUMNS):
+            last["last_seen"] = observation["observed_at"]
+            last["samples"] += 1
+            continue
+        span = {column: observation[column] for column in ("url", "color") + VALUE_COLUMNS}
+        span.update(first_seen=observation["observed_at"], last_seen=observation["observed_at"], samples=1)
+        spans.append(span)
+    return spans
+
+
+def in_stock_periods(timeline):
+    """期間の一覧から在庫ありが続いた期間を取り出す（価格だけが変わった期間はつなげる）
+
+    untilは在庫ありでなくなったのを最初に観測した時刻（まだ在庫ありならNone）
+    """
+    periods = []
+    previous = None
+    for span in timeline:
+        if span["status"] == IN_STOCK:
+            if previous is not None and previous["status"] == IN_STOCK:
+                periods[-1]["last_seen"] = span["last_seen"]
+            else:
+                periods.append({"since": span["first_seen"], "last_seen": span["last_seen"], "until": None})
+        elif previous is not None and previous["status"] == IN_STOCK:
+            periods[-1]["until"] = span["first_seen"]
+        previous = span
+    for period in periods:
+        period["duration"] = (period["until"] or period["last_seen"]) - period["since"]
+    return periods
+
+
+def summarize(timeline):
+    """色の期間の一覧から、現在の状態と最後に在庫ありだった期間をまとめる"""
+    current = timeline[-1]
+    periods = in_stock_periods(timeline)
+    # 現在の状態が続いている期間（価格が変わっても在庫状況が同じならつなげる）
+    since = current["first_seen"]
+    for span in reversed(timeline):
+        if span["status"] != current["status"]:
+            break
+        since = span["first_seen"]
+    return {
+        "color": current["color"],
+        "status": current["status"],
+        "since": since,
+        "checked_at": current["last_seen"],
+        "full_price": current["full_price"],
+        "installment_price": current["installment_price"],
+        "fraction_off": current["fraction_off"],
+        "last_in_stock": periods[-1] if periods else None,
+        "in_stock_count": len(periods),
+        "samples": sum(span["samples"] for span in timeline),
+    }
+
+
+class StockArchive:
+    """URL・色ごとの在庫状況と価格の観測を追記していく時系列のアーカイブ
+
+    観測はいったんそのまま追記し、compact_after秒より古い観測がたまったら値が変わらなかった
+    観測を1行の期間にまとめる。数か月分の5分ごとの観測でも、1色あたりの行数は変化の回数程度で済む
+    """
+
+    def __init__(self, path=None, compact_after=None):
+        if path is None:
+            path = os.getenv("ARCHIVE_DB_FILE", os.path.join(".cache", "stock_archive.db"))
+        if compact_after is None:
+            compact_after = float(os.getenv("ARCHIVE_COMPACT_HOURS", "24")) * 3600
+        # 空にするとアーカイブに記録しない
+        self.path = path
+        self.enabled = bool(path)
+        self.compact_after = compact_after
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def open(self):
+        if not self.enabled:
+            return self
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(SCHEMA)
+        return self
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def append(self, results, now=None):
+        """チェック結果の色ごとの在庫状況と価格を追記し、追記した件数を返す（エラーの結果は記録しない）"""
+        if self._conn is None:
+            return 0
+        if now is None:
+            now = time.time()
+        rows = [
+            (result["url"], detail["color"], now, detail["status"],
+             detail.get("full_price"), detail.get("installment_price"), detail.get("fraction_off"))
+            for result in results if not result.get("error")
+            for detail in result["details"]
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO observations (url, color, observed_at, status, full_price, installment_price, fraction_off) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def maybe_compact(self, now=None):
+        """最も古い観測がcompact_after秒より古ければまとめる"""
+        if self._conn is None:
+            return 0
+        if now is None:
+            now = time.time()
+        oldest = self._conn.execute("SELECT MIN(observed_at) FROM observations").fetchone()[0]
+        if oldest is None or now - oldest < self.compact_after:
+            return 0
+        return self.compact(now)
+
+    def compact(self, before=None):
+        """before（省略時は現在）より前の観測を期間にまとめて観測を消し、まとめた観測の件数を返す"""
+        if self._conn is None:
+            return 0
+        if before is None:
+            before = time.time()
+        started = time.perf_counter()
+        with self._lock, self._conn:
+            observations = self._conn.execute(
+                "SELECT * FROM observations WHERE observed_at < ? ORDER BY url, color, observed_at", (before,)
+            ).fetchall()
+            by_key = {}
+            for observation in observations:
+                by_key.setdefault((observation["url"], observation["color"]), []).append(observation)
+            for (url, color), rows in by_key.items():
+                last = self._conn.execute(
+                    "SELECT rowid, * FROM spans WHERE url = ? AND color = ? ORDER BY first_seen DESC LIMIT 1",
+                    (url, color),
+                ).fetchone()
+                spans = fold([dict(last)] if last else [], rows)
+                if last:
+                    head = spans.pop(0)
+                    self._conn.execute(
+                        "UPDATE spans SET last_seen = ?, samples = ? WHERE rowid = ?",
+                        (head["last_seen"], head["samples"], last["rowid"]),
+                    )
+                self._conn.executemany(
+                    "INSERT INTO spans (url, color, status, full_price, installment_price, fraction_off, first_seen, last_seen, samples) "
+                    "VALUES (:url, :color, :status, :full_price, :installment_price, :fraction_off, :first_seen, :last_seen, :samples)",
+                    spans,
+                )
+            self._conn.execute("DELETE FROM observations WHERE observed_at < ?", (before,))
+        if observations:
+            logger.info(
+                "在庫のアーカイブをまとめました: 観測%s件 (%s色) %.2f秒",
+                len(observations), len(by_key), time.perf_counter() - started,
+            )
+        return len(observations)
+
+    def counts(self):
+        """まとめていない観測と期間の行数"""
+        if self._conn is None:
+            return {"observations": 0, "spans": 0}
+        return {
+            "observations": self._conn.execute("SELECT COUNT(*) FROM observations").fetchone()[0],
+            "spans": self._conn.execute("SELECT COUNT(*) FROM spans").fetchone()[0],
+        }
+
+    def timeline(self, url, color=None):
+        """URLの色ごとの期間の一覧（まとめていない観測も期間にして続ける） {色: [期間, ...]}"""
+        if self._conn is None:
+            return {}
+        # 色名の一部での絞り込み（color_matchesと同じ）もSQLで行い、ほかの色の行は読まない
+        condition = "url = ?" + (" AND instr(color, ?) > 0" if color else "")
+        params = (url, color) if color else (url,)
+        timelines = {}
+        for span in self._conn.execute(f"SELECT * FROM spans WHERE {condition} ORDER BY color, first_seen", params):
+            timelines.setdefault(span["color"], []).append(dict(span))
+        observations = {}
+        for observation in self._conn.execute(
+            f"SELECT * FROM observations WHERE {condition} ORDER BY color, observed_at", params
+        ):
+            observations.setdefault(observation["color"], []).append(observation)
+        for key, rows in observations.items():
+            fold(timelines.setdefault(key, []), rows)
+        return timelines
+
+    def history(self, url, color=None):
+        """URLの色ごとの現在の状態と、最後に在庫ありだった期間（colorは色名の一部でもよい）"""
+        return [summarize(spans) for spans in self.timeline(url, color).values()]
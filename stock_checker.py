@@ -1,28 +1,52 @@
 import os
+import sys
+import json
 import time
+import codecs
+import random
+import signal
+import argparse
 import logging
-import smtplib
-import ssl
-import requests
 import platform
 import subprocess
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime
-from bs4 import BeautifulSoup
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-
-# ロギングの設定
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("stock_checker.log"),
-    ],
+from urllib.parse import urlparse
+
+# selenium・requests・bs4・smtplibと、状態のデータベース（sqlite3）・アーカイブ・商品の検出・
+# 状態API・通知チャネルのモジュールは、そのコマンドで実際に使うときに読み込む
+# （ブラウザを使わないコマンドの起動を速くするため）
+from log_config import setup_logging
+from page_cache import PageCache
+from stock_extractor import (
+    extract_from_soup,
+    extract_stock,
+    log_extraction,
+    parse_stock_html,
+    stock_data_looks_valid,
+    stock_fragment_hash,
+    StockSectionWatcher,
+)
+from snapshot_store import COMPRESSIONS, SnapshotStore, needs_full_page, read_snapshot
+from notifier import EmailNotifier, NotificationQueue
+from run_report import RunReport
+from url_health import HostBreaker, UrlHealth
+from sharding import get_shard, load_partial_results, order_results, select_shard, write_partial_results
+from watch_list import (
+    compile_fetch_plan,
+    due_fetches,
+    fan_out,
+    fetch_colors,
+    latest_time,
+    load_watch_list,
+    normalize_url,
+    subscription_urls,
+    subscriptions_from_urls,
 )
+
 logger = logging.getLogger("mineo-stock-checker")
 
 
@@ -42,6 +66,38 @@ def get_product_urls():
     return urls
 
 
+def get_watch_list():
+    """監視する商品（購読）のリストを取得（WATCH_LIST_FILEがあればファイルから、なければPRODUCT_URLSから）
+
+    DISCOVERY_URLSを設定した場合は、一覧ページから見つけた商品を後ろに加える
+    """
+    from discovery import DeviceDiscovery, merge_discovered
+
+    discovery = DeviceDiscovery().load()
+    path = os.getenv("WATCH_LIST_FILE")
+    if not path:
+        # 見つけた商品だけを監視する場合はPRODUCT_URLSがなくてもよい
+        urls = get_product_urls() if os.getenv("PRODUCT_URLS") or not discovery.enabled else []
+        return merge_discovered(subscriptions_from_urls(urls), discovery.subscriptions())
+    try:
+        subscriptions = load_watch_list(path)
+    except (OSError, ValueError) as e:
+        logger.error("監視リストを読み込めませんでした: %s - %s", path, e)
+        return []
+    return merge_discovered(subscriptions, discovery.subscriptions())
+
+
+def discover_devices():
+    """一覧ページから商品を探して検出結果を更新する（DISCOVERY_URLSが空ならNone）"""
+    from discovery import DeviceDiscovery
+
+    discovery = DeviceDiscovery().load()
+    if not discovery.enabled:
+        return None
+    # 商品ページの取得にもチェックと同じヘッダー・接続を使う
+    return discovery.crawl(get_http_session())
+
+
 def find_chrome_executable():
     """システムにインストールされているChromeの実行ファイルを探す"""
     system = platform.system()
@@ -74,279 +130,1437 @@ def find_chrome_executable():
             except subprocess.CalledProcessError:
                 pass
     
-    logger.warning(f"Chromeの実行ファイルが見つかりませんでした。システム: {system}")
+    logger.warning("Chromeの実行ファイルが見つかりませんでした。システム: %s", system)
     return None
 
 
-def check_stock(url):
-    """指定されたURLの在庫状況をチェック"""
-    try:
-        # Seleniumでブラウザを起動し、JavaScriptが実行された状態でHTMLを取得
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
-        chrome_options.add_argument("--disable-gpu")
-        chrome_options.add_argument("--window-size=1920,1080")
-        chrome_options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
-        
-        # Chromeの実行ファイルのパスを取得
-        chrome_path = find_chrome_executable()
-        if chrome_path:
-            chrome_options.binary_location = chrome_path
-            logger.info(f"Chrome実行ファイルを設定: {chrome_path}")
-        
-        # ブラウザを起動 (Service指定なしで直接)
-        driver = webdriver.Chrome(options=chrome_options)
-        
+# RESOURCE_FILTERで選べるリソースの絞り込み方法
+# - block: 既知の広告・計測タグと画像・フォントを読み込まない
+# - allow: ALLOWED_HOSTS以外のホストへの接続をすべて止める（画像・フォントも読み込まない）
+# - off: すべて読み込む（従来どおり）
+RESOURCE_FILTERS = ("block", "allow", "off")
+
+# 在庫判定に関係しない広告・計測タグ（保存済みのページで読み込まれていたもの）
+DEFAULT_BLOCKED_URL_PATTERNS = [
+    "*adobedtm.com*",
+    "*googletagmanager.com*",
+    "*google-analytics.com*",
+    "*doubleclick.net*",
+    "*googleadservices.com*",
+    "*connect.facebook.net*",
+    "*facebook.com/tr*",
+    "*s.yimg.jp/images/listing/tool/cv*",
+    "*yahoo.co.jp/pagead*",
+    "*bat.bing.com*",
+    "*amazon-adsystem.com*",
+    "*smartnews-ads.com*",
+    "*line-scdn.net*",
+    "*tr.line.me*",
+    "*criteo.com*",
+    "*adsrvr.org*",
+    "*ladsp.com*",
+    "*valis-cpx.jp*",
+    "*karte.io*",
+    "*youtube.com*",
+]
+
+# 画像・フォント・動画は在庫判定に使わないので拡張子で止める
+BLOCKED_EXTENSIONS = ("png", "jpg", "jpeg", "gif", "webp", "svg", "ico", "woff", "woff2", "ttf", "otf", "eot", "mp4")
+
+# allowのときに接続を許可するホスト（stock_device.jsとjQueryはmineo.jpから読み込まれる）
+DEFAULT_ALLOWED_HOSTS = ["mineo.jp", "*.mineo.jp"]
+
+
+def get_resource_filter():
+    """環境変数からリソースの絞り込み方法を決定"""
+    mode = os.getenv("RESOURCE_FILTER", "block").strip().lower()
+    if mode not in RESOURCE_FILTERS:
+        logger.warning("不明なRESOURCE_FILTERです: %s（blockを使用します）", mode)
+        return "block"
+    return mode
+
+
+def split_setting(value):
+    """カンマ・改行区切りの設定値をリストにする"""
+    return [item.strip() for item in value.replace("\n", ",").split(",") if item.strip()]
+
+
+def blocked_url_patterns(resource_filter):
+    """CDPのNetwork.setBlockedURLsに渡すパターン"""
+    if resource_filter == "off":
+        return []
+    patterns = []
+    if resource_filter == "block":
+        patterns.extend(DEFAULT_BLOCKED_URL_PATTERNS)
+    # 配備先ごとに止めたいURLを追加できる
+    patterns.extend(split_setting(os.getenv("BLOCKED_URL_PATTERNS", "")))
+    for extension in BLOCKED_EXTENSIONS:
+        patterns.append(f"*.{extension}")
+        patterns.append(f"*.{extension}?*")
+    return patterns
+
+
+def allowed_hosts():
+    """allowのときに接続を許可するホスト"""
+    return split_setting(os.getenv("ALLOWED_HOSTS", "")) or DEFAULT_ALLOWED_HOSTS
+
+
+def build_chrome_options(chrome_path=None, resource_filter="off"):
+    """ヘッドレスChrome用のオプションを作成"""
+    from selenium.webdriver.chrome.options import Options
+
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument("--disable-gpu")
+    chrome_options.add_argument("--window-size=1920,1080")
+    chrome_options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
+    if resource_filter != "off":
+        # 画像を読み込まない（デコードと描画のメモリも減る）
+        chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+        chrome_options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+    if resource_filter == "allow":
+        # 許可したホスト以外は名前解決できないようにする（IPアドレスで指定したURLは対象外）
+        rules = ["MAP * ~NOTFOUND"] + [f"EXCLUDE {host}" for host in allowed_hosts()]
+        chrome_options.add_argument(f"--host-resolver-rules={' , '.join(rules)}")
+    if chrome_path:
+        chrome_options.binary_location = chrome_path
+    return chrome_options
+
+
+class BrowserPool:
+    """ヘッドレスChromeのセッションを実行中に使い回すためのプール"""
+
+    def __init__(self, size=None, page_load_timeout=None, resource_filter=None):
+        if size is None:
+            size = int(os.getenv("BROWSER_POOL_SIZE", "1"))
+        if page_load_timeout is None:
+            page_load_timeout = float(os.getenv("CHECK_TIMEOUT", "60"))
+        if resource_filter is None:
+            resource_filter = get_resource_filter()
+        self.size = max(1, size)
+        self.page_load_timeout = page_load_timeout
+        self.resource_filter = resource_filter
+        self.blocked_urls = blocked_url_patterns(resource_filter)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._all = []
+        self._closed = False
+        # Chromeの起動にかかった時間（実行レポート用）
+        self.startup_times = []
+        # Chromeの実行ファイルとオプションは最初に起動するときに一度だけ用意する
+        # （HTTPだけで取得できた実行ではseleniumを読み込まない）
+        self.chrome_path = None
+        self.options = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _prepare(self):
+        """Chromeの実行ファイルを探し、起動オプションを作る"""
+        with self._lock:
+            if self.options is None:
+                self.chrome_path = find_chrome_executable()
+                if self.chrome_path:
+                    logger.info("Chrome実行ファイルを設定: %s", self.chrome_path)
+                self.options = build_chrome_options(self.chrome_path, self.resource_filter)
+        return self.options
+
+    def _start_driver(self):
+        """新しいChromeを起動"""
+        from selenium import webdriver
+
+        options = self._prepare()
+        started = time.perf_counter()
+        driver = webdriver.Chrome(options=options)
+        driver.set_page_load_timeout(self.page_load_timeout)
+        if self.blocked_urls:
+            self._block_urls(driver)
+        elapsed = time.perf_counter() - started
+        self.startup_times.append(elapsed)
+        logger.info("Chromeを起動しました (%.2f秒)", elapsed)
+        return driver
+
+    def _block_urls(self, driver):
+        """在庫判定に不要なリソースをCDPで読み込まないようにする"""
+        from selenium.common.exceptions import WebDriverException
+
+        try:
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": self.blocked_urls})
+        except WebDriverException as e:
+            # 止められなくても判定はできるので、すべて読み込んで続ける
+            logger.warning("リソースの読み込み制限を設定できませんでした: %s", e)
+
+    def _acquire(self):
+        """空いているドライバーを取得（なければ上限まで新規起動）"""
+        wait = 0
+        while True:
+            try:
+                return self._idle.get(timeout=wait) if wait else self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    break
+            # 上限まで起動済みなら、他の処理が返却するのを待つ
+            wait = 0.5
+        try:
+            driver = self._start_driver()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+        with self._lock:
+            self._all.append(driver)
+        return driver
+
+    def _discard(self, driver):
+        """壊れたドライバーを破棄し、次回の取得で起動し直せるようにする"""
+        with self._lock:
+            self._created -= 1
+            if driver in self._all:
+                self._all.remove(driver)
         try:
-            # ページを読み込み、JavaScriptが実行されるのを待つ
-            driver.get(url)
-            # JavaScriptが実行されるのを待つ（必要に応じて調整）
-            time.sleep(3)
-            
-            # 現在のページソースを取得
-            html = driver.page_source
-            
-            # デバッグ用にHTMLを保存
-            with open("latest_html.html", "w", encoding="utf-8") as f:
-                f.write(html)
-                
-            soup = BeautifulSoup(html, "html.parser")
-            logger.debug(f"URLからHTMLを取得しました: {url}")
-        finally:
-            # ブラウザを終了
             driver.quit()
-        
-        # 商品名を取得
-        product_name = soup.select_one(".page-title h1")
-        if product_name:
-            product_name = product_name.text.strip()
-            logger.info(f"商品名: {product_name}")
+        except Exception as e:
+            logger.debug("ドライバー終了時のエラーを無視しました: %s", e)
+
+    def _reset(self, driver):
+        """次のページに状態を持ち越さないようにリセット"""
+        driver.delete_all_cookies()
+        driver.get("about:blank")
+
+    @contextmanager
+    def session(self):
+        """ドライバーを1つ借りて、使い終わったらリセットしてプールに戻す
+
+        ページの読み込みがタイムアウトしただけならChromeは動いているので、破棄せずにプールに戻す
+        """
+        from selenium.common.exceptions import TimeoutException, WebDriverException
+
+        if self._closed:
+            raise RuntimeError("BrowserPoolは既に終了しています")
+        driver = self._acquire()
+        try:
+            yield driver
+        except TimeoutException:
+            self._release(driver)
+            raise
+        except WebDriverException:
+            logger.warning("Chromeセッションが異常終了したため破棄します")
+            self._discard(driver)
+            raise
+        except Exception:
+            self._release(driver)
+            raise
         else:
-            product_name = "不明な商品"
-            logger.warning(f"商品名が取得できませんでした: {url}")
-            
-        # 在庫状況テーブルを検索
-        stock_cells = soup.select(".replace-stock-color")
-        
-        if not stock_cells:
-            logger.warning(f"在庫情報が見つかりませんでした: {url}")
-            return {
-                "product_name": product_name,
-                "url": url,
-                "in_stock": False,
-                "details": [],
-                "error": "在庫情報が見つかりませんでした"
-            }
-        
-        logger.info(f"在庫情報セルを {len(stock_cells)} 個見つけました")
-        
-        in_stock = False
-        details = []
-        
-        for cell in stock_cells:
-            # 色名を取得（親要素のth内）
-            color_element = cell.find_previous("th")
-            color_name = "不明" if not color_element else color_element.text.strip()
-            
-            # セルの内容をログに出力（判断根拠の表示）
-            cell_text = cell.text.strip()
-            logger.info(f"セル内容 ({color_name}): {cell_text}")
-            
-            # アイコンの有無とクラスを確認
-            icon = cell.find("i")
-            icon_class = None
-            if icon:
-                icon_class = icon.get('class')
-                logger.info(f"  - アイコンクラス: {icon_class}")
-            
-            # data-stock-status属性の値を取得
-            data_stock_status = cell.get('data-stock-status')
-            if data_stock_status:
-                logger.info(f"  - data-stock-status: {data_stock_status}")
-            
-            # ------ 在庫判断ロジック（優先順位順） ------
-            # 1. data-stock-statusの値による判断（サイトの仕様に基づく）
-            #    - data-stock-status="2" → 在庫なし
-            #    - data-stock-status="1" → 在庫あり
-            # 2. テキストに「在庫なし」または「入荷待ち」がある場合は在庫なし
-            # 3. テキストがあり、それが「在庫なし」でない場合は在庫あり
-            # 4. アイコンの存在だけでは在庫ありと判断しない（JavaScriptで動的に変更される可能性があるため）
-            
-            if data_stock_status == "2":
-                status = "在庫なし"
-                logger.info(f"  - 判断根拠: data-stock-status=\"2\"（在庫なし）")
-            elif data_stock_status == "1":
-                status = "在庫あり"
-                in_stock = True
-                logger.info(f"  - 判断根拠: data-stock-status=\"1\"（在庫あり）")
-            elif "在庫なし" in cell_text or "入荷待ち" in cell_text:
-                status = "在庫なし"
-                logger.info(f"  - 判断根拠: テキストに「在庫なし」または「入荷待ち」を含む")
-            elif cell_text and "在庫なし" not in cell_text and "入荷待ち" not in cell_text:
-                # テキストがあり、それが「在庫なし」でない場合は在庫あり
-                status = "在庫あり"
-                in_stock = True
-                logger.info(f"  - 判断根拠: テキストが存在し、「在庫なし」や「入荷待ち」を含まない")
-            elif icon and icon_class and 'fa-circle' in icon_class:
-                # アイコンだけでは判断できないが、調査のためログに残す
-                logger.warning(f"  - 注意: アイコン「fa-circle」の存在のみで在庫判断はできません。サイトが動的に更新されている可能性があります。")
-                status = "判断不能（要確認）"
+            self._release(driver)
+
+    def _release(self, driver):
+        """リセットに成功したドライバーだけをプールに戻す"""
+        try:
+            self._reset(driver)
+        except Exception as e:
+            logger.warning("Chromeセッションのリセットに失敗したため破棄します: %s", e)
+            self._discard(driver)
+            return
+        self._idle.put(driver)
+
+    def close(self):
+        """起動済みのChromeをすべて終了"""
+        self._closed = True
+        with self._lock:
+            drivers = list(self._all)
+            self._all.clear()
+            self._created = 0
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception as e:
+                logger.debug("ドライバー終了時のエラーを無視しました: %s", e)
+
+
+# 在庫セルが揃ったかどうかを判定するスクリプト
+# - セルがすべてdata-stock-statusを持っていれば準備完了
+# - 読み込みが完了してもセルがないページは、それ以上待っても変わらないので準備完了とする
+STOCK_READY_SCRIPT = """
+var cells = document.querySelectorAll('.replace-stock-color');
+if (!cells.length) {
+    return document.readyState === 'complete';
+}
+for (var i = 0; i < cells.length; i++) {
+    if (!cells[i].getAttribute('data-stock-status')) {
+        return false;
+    }
+}
+return true;
+"""
+
+
+def wait_for_stock_ready(driver, timeout=None, poll_interval=None):
+    """在庫セルの準備が整うまで待ち、(準備完了したか, 待機秒数) を返す"""
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    if timeout is None:
+        timeout = float(os.getenv("STOCK_READY_TIMEOUT", "10"))
+    if poll_interval is None:
+        poll_interval = float(os.getenv("STOCK_READY_POLL_INTERVAL", "0.1"))
+
+    started = time.perf_counter()
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=poll_interval).until(
+            lambda d: d.execute_script(STOCK_READY_SCRIPT)
+        )
+        ready = True
+    except TimeoutException:
+        ready = False
+    elapsed = time.perf_counter() - started
+    logger.info("在庫セルの準備待ち: %.2f秒 (%s)", elapsed, '完了' if ready else 'タイムアウト')
+    return ready, elapsed
+
+
+def fetch_rendered_html(url, pool):
+    """プールのChromeでページを読み込み、JavaScript実行後のHTMLを取得"""
+    from selenium.common.exceptions import TimeoutException, WebDriverException
+
+    timings = {}
+    for attempt in range(2):
+        started = time.perf_counter()
+        try:
+            with pool.session() as driver:
+                timings["acquire"] = time.perf_counter() - started
+                # ページを読み込み、JavaScriptが実行されるのを待つ
+                load_started = time.perf_counter()
+                driver.get(url)
+                timings["load"] = time.perf_counter() - load_started
+
+                # 在庫セルがstock_device.jsで埋まるまで待つ
+                ready, timings["ready"] = wait_for_stock_ready(driver)
+                if not ready:
+                    logger.warning("在庫セルの読み込み完了を確認できませんでした（現在の状態で判定します）: %s", url)
+
+                # 現在のページソースを取得
+                source_started = time.perf_counter()
+                html = driver.page_source
+                timings["page_source"] = time.perf_counter() - source_started
+            return html, timings
+        except TimeoutException:
+            # 遅いページは起動し直しても遅いので、やり直さずにタイムアウトとして扱う
+            logger.warning("ページの読み込みがタイムアウトしました (%.0f秒): %s", pool.page_load_timeout, url)
+            raise
+        except WebDriverException:
+            # Chromeが落ちた場合は新しいセッションで1回だけやり直す
+            if attempt:
+                raise
+            logger.warning("新しいChromeセッションで再試行します: %s", url)
+
+
+# requestsで取得するときのヘッダー（debug_html.pyと同じ）
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+# FETCH_MODEで選べる取得方法
+# - selenium: Chromeでページを描画して取得（従来どおり）
+# - http: requestsで直接取得し、失敗したときやデータが不完全なときだけSeleniumを使う
+# - http-only: requestsのみで取得（Chromeを使わない）
+FETCH_MODES = ("selenium", "http", "http-only")
+
+# 在庫APIのレスポンスで型番・在庫状態として扱うキー
+STOCK_API_MODELNUM_KEYS = ("modelnum", "modelNum", "model_num", "modelnums", "code")
+STOCK_API_STATUS_KEYS = ("stock_status", "stockStatus", "status", "stock")
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_fetch_mode():
+    """環境変数から取得方法を決定"""
+    mode = os.getenv("FETCH_MODE", "selenium").strip().lower()
+    if mode not in FETCH_MODES:
+        logger.warning("不明なFETCH_MODEです: %s（seleniumを使用します）", mode)
+        return "selenium"
+    return mode
+
+
+def get_http_session():
+    """接続を使い回すためのrequestsセッションを取得"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+
+            _http_session = requests.Session()
+            _http_session.headers.update(HTTP_HEADERS)
+        return _http_session
+
+
+def parse_stock_api_response(data):
+    """在庫APIのJSONから {型番: data-stock-status} の対応表を作る
+
+    次のどちらの形式にも対応する
+    - {"型番": "1", ...}
+    - [{"modelnum": "型番", "stock_status": "1"}, ...]（キー名の揺れはある程度吸収する）
+    """
+    statuses = {}
+
+    def walk(node):
+        if isinstance(node, dict):
+            modelnum = next((node[k] for k in STOCK_API_MODELNUM_KEYS if k in node), None)
+            status = next((node[k] for k in STOCK_API_STATUS_KEYS if k in node), None)
+            if modelnum is not None and status is not None:
+                statuses[str(modelnum)] = str(status)
+                return
+            for key, value in node.items():
+                if isinstance(value, (str, int)) and not isinstance(value, bool):
+                    statuses.setdefault(str(key), str(value))
+                else:
+                    walk(value)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+
+    walk(data)
+    return statuses
+
+
+def apply_stock_api(soup, session):
+    """STOCK_API_URLの在庫データを在庫セルのdata-stock-statusに反映"""
+    api_url = os.getenv("STOCK_API_URL")
+    if not api_url:
+        return False
+
+    rows = soup.select(".replace-stock[data-modelnums]")
+    groupids = sorted({row.get("data-groupids", "") for row in rows if row.get("data-groupids")})
+    modelnums = [row["data-modelnums"] for row in rows if row.select_one(".replace-stock-color")]
+    if not modelnums:
+        return False
+
+    response = session.get(
+        api_url.format(groupids=",".join(groupids), modelnums=",".join(modelnums)),
+        timeout=float(os.getenv("HTTP_TIMEOUT", "30")),
+    )
+    response.raise_for_status()
+    statuses = parse_stock_api_response(response.json())
+
+    for row in rows:
+        cell = row.select_one(".replace-stock-color")
+        status = statuses.get(row["data-modelnums"])
+        if cell is not None and status:
+            cell["data-stock-status"] = status
+    return True
+
+
+def stream_fetch_enabled():
+    """在庫状況テーブルを受け取った時点でダウンロードを打ち切るか（STREAM_FETCH=0で無効）"""
+    return os.getenv("STREAM_FETCH", "1").lower() not in ("0", "false", "no")
+
+
+def read_until_stock_section(response, chunk_size=8192):
+    """レスポンスを少しずつ読み、商品名と在庫状況テーブルが揃った時点で読むのをやめる
+
+    (受け取ったHTML, 途中で打ち切ったか) を返す。打ち切った接続は使い回さずに閉じる
+    """
+    decoder = codecs.getincrementaldecoder(response.encoding)(errors="replace")
+    watcher = StockSectionWatcher()
+    parts = []
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        text = decoder.decode(chunk)
+        parts.append(text)
+        watcher.feed(text)
+        if watcher.complete:
+            return "".join(parts), True
+    parts.append(decoder.decode(b"", final=True))
+    return "".join(parts), False
+
+
+def fetch_stock_http(url, cache=None, stream=None, colors=None):
+    """ブラウザを使わずrequestsで在庫データを取得し、(HTML, soup, 所要時間, 検証用ヘッダー, 転送量) を返す
+
+    キャッシュ済みのページが変わっていなければ（304）、HTMLとsoupはNoneになる。
+    streamがTrueなら、在庫状況テーブルを受け取った時点でダウンロードを打ち切る
+    （HTMLはそこまでの部分になる）。colorsは判定する色（キャッシュの結果が使えるかの判断に使う）
+    """
+    if stream is None:
+        stream = stream_fetch_enabled()
+    timings = {}
+    session = get_http_session()
+
+    # 在庫APIを使う場合、在庫はページ本体と別に変わるので条件付きGETは使わない
+    headers = {}
+    if cache is not None and not os.getenv("STOCK_API_URL"):
+        headers = cache.validators(url, colors)
+
+    fetch_started = time.perf_counter()
+    response = session.get(url, headers=headers, timeout=float(os.getenv("HTTP_TIMEOUT", "30")), stream=True)
+    try:
+        validators = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        if response.status_code == 304:
+            timings["fetch"] = time.perf_counter() - fetch_started
+            return None, None, timings, validators, None
+        response.raise_for_status()
+        if not response.encoding or response.encoding.lower() == "iso-8859-1":
+            # charset指定がない場合、requestsはISO-8859-1とみなすのでUTF-8として読む
+            response.encoding = "utf-8"
+        if stream:
+            html, stopped_early = read_until_stock_section(response)
+        else:
+            html, stopped_early = response.text, False
+        timings["fetch"] = time.perf_counter() - fetch_started
+        content_length = response.headers.get("Content-Length")
+        transfer = {
+            # 圧縮されている場合は圧縮後のバイト数
+            "bytes": response.raw.tell(),
+            "content_length": int(content_length) if content_length and content_length.isdigit() else None,
+            "stopped_early": stopped_early,
+        }
+    finally:
+        response.close()
+    logger.info(
+        "受信: %.1fKB / %s (%.2f秒%s): %s",
+        transfer["bytes"] / 1024,
+        "不明" if transfer["content_length"] is None else f"{transfer['content_length'] / 1024:.1f}KB",
+        timings["fetch"], "、在庫状況テーブルまでで打ち切り" if stopped_early else "", url,
+    )
+
+    parse_started = time.perf_counter()
+    soup = parse_stock_html(html)
+    timings["parse"] = time.perf_counter() - parse_started
+
+    # stock_device.jsが呼び出す在庫APIが設定されていれば、その値でセルを埋める
+    api_started = time.perf_counter()
+    if apply_stock_api(soup, session):
+        timings["stock_api"] = time.perf_counter() - api_started
+        validators = {}
+
+    if not stock_data_looks_valid(soup):
+        raise ValueError("HTTPで取得した在庫データが不完全です")
+    return html, soup, timings, validators, transfer
+
+
+def full_page_html(url, html, transfer):
+    """スナップショットにページ全体を保存するときのHTMLと、それが途中までのものかを返す
+
+    在庫状況テーブルまでで読むのをやめたページは、原因を調べられるようにストリーミングせずに取得し直す
+    （取得し直せなければ、途中までのHTMLを途中までと分かるように保存する）
+    """
+    if not transfer or not transfer["stopped_early"]:
+        return html, False
+    try:
+        response = get_http_session().get(url, timeout=float(os.getenv("HTTP_TIMEOUT", "30")))
+        response.raise_for_status()
+        if not response.encoding or response.encoding.lower() == "iso-8859-1":
+            response.encoding = "utf-8"
+        return response.text, False
+    except Exception as e:
+        logger.warning("スナップショット用にページ全体を取得できませんでした: %s - %s", url, e)
+        return html, True
+
+
+def cached_result(url, cached, timings, started, source, transfer=None):
+    """キャッシュから復元した結果"""
+    logger.info("前回から変化がないため前回の判定結果を使います: %s", url)
+    result = dict(cached)
+    result.update({
+        "url": url,
+        "error": None,
+        "timings": finish_timings(timings, started),
+        "source": source,
+        "transfer": transfer,
+        "cached": True,
+    })
+    return result
+
+
+def finish_timings(timings, started, extract_started=None):
+    """URLごとの所要時間（秒）をまとめる"""
+    timings = dict(timings)
+    now = time.perf_counter()
+    if extract_started is not None:
+        timings["extract"] = now - extract_started
+    timings["total"] = now - started
+    return {name: round(value, 3) for name, value in timings.items()}
+
+
+def check_stock(url, pool=None, fetch_mode=None, cache=None, snapshots=None, colors=None):
+    """指定されたURLの在庫状況をチェック（colorsを指定すると、それ以外の色は判定しない）"""
+    started = time.perf_counter()
+    timings = {}
+    validators = {}
+    transfer = None
+    if fetch_mode is None:
+        fetch_mode = get_fetch_mode()
+    try:
+        soup = None
+        source = "selenium"
+        if fetch_mode in ("http", "http-only"):
+            try:
+                html, soup, timings, validators, transfer = fetch_stock_http(url, cache, colors=colors)
+                source = "http"
+                if soup is None:
+                    cached = cache.not_modified(url, colors) if cache is not None else None
+                    if cached is not None:
+                        return cached_result(url, cached, timings, started, source)
+                    raise ValueError("304が返されましたがキャッシュがありません")
+            except Exception as e:
+                if fetch_mode == "http-only":
+                    raise
+                logger.warning("HTTPでの在庫取得に失敗したためSeleniumで取得します: %s - %s", url, e)
+                soup = None
+                source = "selenium"
+                timings = {}
+                validators = {}
+                transfer = None
+
+        if soup is None:
+            if pool is None:
+                # プールが渡されなければこのURL専用に起動する
+                with BrowserPool(size=1) as own_pool:
+                    html, timings = fetch_rendered_html(url, own_pool)
             else:
-                status = "状態不明"
-                logger.info(f"  - 判断根拠: 既知のパターンに一致しない")
-            
-            details.append({
-                "color": color_name,
-                "status": status
-            })
+                html, timings = fetch_rendered_html(url, pool)
+
+            parse_started = time.perf_counter()
+            soup = parse_stock_html(html)
+            timings["parse"] = time.perf_counter() - parse_started
+
+        # 在庫状況テーブルが前回と同じなら判定をやり直さない
+        fragment_hash = stock_fragment_hash(soup)
+        if cache is not None:
+            cached = cache.lookup(url, fragment_hash, colors)
+            if cached is not None:
+                return cached_result(url, cached, timings, started, source, transfer)
+
+        extract_started = time.perf_counter()
+        logger.debug("URLからHTMLを取得しました (%s): %s", source, url)
+        
+        # 商品名と色ごとの在庫状況を取り出す
+        extraction = extract_from_soup(soup, colors)
+        log_extraction(logger, extraction, url)
         
         result = {
-            "product_name": product_name,
+            "product_name": extraction["product_name"],
             "url": url,
-            "in_stock": in_stock,
-            "details": details,
-            "error": None
+            "in_stock": extraction["in_stock"],
+            "details": extraction["details"],
+            "error": extraction["error"],
+            "timings": finish_timings(timings, started, extract_started),
+            "source": source,
+            "transfer": transfer,
         }
+        if cache is not None:
+            cache.store(url, fragment_hash, result, colors=colors, **validators)
+        if snapshots is not None:
+            # デバッグ用にページを保存（書き込みはバックグラウンドで行う）
+            save_started = time.perf_counter()
+            partial = False
+            if snapshots.enabled and needs_full_page(result):
+                html, partial = full_page_html(url, html, transfer)
+            snapshots.save(url, soup, html, result, partial=partial)
+            result["timings"]["save"] = round(time.perf_counter() - save_started, 3)
         
         return result
         
     except Exception as e:
-        logger.error(f"在庫チェック中にエラーが発生しました: {url} - {str(e)}")
+        logger.error("在庫チェック中にエラーが発生しました: %s - %s", url, e)
         return {
             "product_name": url,
             "url": url,
             "in_stock": False,
             "details": [],
-            "error": str(e)
+            "error": str(e),
+            "timings": finish_timings(timings, started),
         }
 
 
+class HostRateLimiter:
+    """同じホストへのアクセスが一定間隔以上空くように待たせる"""
+
+    def __init__(self, interval=None):
+        if interval is None:
+            interval = float(os.getenv("RATE_LIMIT_INTERVAL", "0.5"))
+        self.interval = max(0.0, interval)
+        self._lock = threading.Lock()
+        self._next_allowed = {}
+
+    def wait(self, url):
+        """このURLのホストにアクセスしてよい時刻まで待つ"""
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            allowed = max(now, self._next_allowed.get(host, now))
+            self._next_allowed[host] = allowed + self.interval
+        if allowed > now:
+            time.sleep(allowed - now)
+
+
+def timeout_result(url, timeout):
+    """時間内にチェックが終わらなかったURLの結果"""
+    logger.error("在庫チェックがタイムアウトしました (%.0f秒): %s", timeout, url)
+    return {
+        "product_name": url,
+        "url": url,
+        "in_stock": False,
+        "details": [],
+        "error": f"タイムアウトしました ({timeout:.0f}秒)",
+        "timings": {"total": round(timeout, 3)},
+    }
+
+
+def check_urls(urls, pool=None, concurrency=None, rate_limiter=None, timeout=None, cache=None, snapshots=None,
+               colors=None, health=None, host_breaker=None):
+    """複数のURLを並行してチェックし、URLの順番どおりに結果を返す（colorsはURLごとの監視する色）
+
+    healthを渡すと失敗が続いているURLをスキップする。同じホストのURLが最初から続けて
+    失敗した場合は、そのホストの残りのURLをチェックしない
+    """
+    if concurrency is None:
+        concurrency = int(os.getenv("CHECK_CONCURRENCY", "3"))
+    if timeout is None:
+        timeout = float(os.getenv("CHECK_TIMEOUT", "60"))
+    if rate_limiter is None:
+        rate_limiter = HostRateLimiter()
+    if host_breaker is None:
+        host_breaker = HostBreaker()
+    concurrency = max(1, min(concurrency, len(urls) or 1))
+
+    started_at = {}
+    # 結果を記録したURLの番号（打ち切ったURLのチェックが後から終わっても、同じURLを2回数えない）
+    recorded = set()
+    recorded_lock = threading.Lock()
+
+    def record_once(index, result):
+        with recorded_lock:
+            if index in recorded:
+                return False
+            recorded.add(index)
+        record_result(result, health, host_breaker)
+        return True
+
+    def run(index, url):
+        skipped = (health.allow(url) if health is not None else None) or host_breaker.allow(url)
+        if skipped is not None:
+            return skipped
+        rate_limiter.wait(url)
+        started_at[index] = time.monotonic()
+        logger.info("URLをチェック中: %s", url)
+        result = check_stock(url, pool, cache=cache, snapshots=snapshots, colors=(colors or {}).get(url))
+        # 次のURLを始める前にホストの失敗を数える
+        record_once(index, result)
+        return result
+
+    results = [None] * len(urls)
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="check")
+    try:
+        futures = {executor.submit(run, index, url): index for index, url in enumerate(urls)}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[futures[future]] = future.result()
+            # 時間がかかりすぎているURLは結果を待たずに打ち切る
+            now = time.monotonic()
+            for future in list(pending):
+                index = futures[future]
+                if index in started_at and now - started_at[index] > timeout:
+                    pending.discard(future)
+                    result = timeout_result(urls[index], timeout)
+                    if record_once(index, result):
+                        results[index] = result
+                    else:
+                        # 打ち切る直前にチェックが終わっていた（記録した結果を使う）
+                        results[index] = future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+def record_result(result, health, host_breaker):
+    """URLとホストの失敗の記録を更新"""
+    if health is not None:
+        health.record(result)
+    host_breaker.record(result)
+
+
 def send_email(in_stock_products):
-    """在庫のある商品についてメール通知を送信"""
+    """在庫のある商品についてメール通知を送信（送信できたらTrueを返す）"""
     if not in_stock_products:
         logger.info("在庫のある商品はありません。メール送信をスキップします。")
-        return
-    
-    email_user = os.getenv("EMAIL_USER")
-    email_pass = os.getenv("EMAIL_PASS")
-    recipient_email = os.getenv("RECIPIENT_EMAIL")
+        return False
     
-    if not all([email_user, email_pass, recipient_email]):
+    notifier = EmailNotifier.from_env()
+    if notifier is None:
         logger.error("メール送信に必要な環境変数が設定されていません")
-        return
-    
+        return False
     try:
-        message = MIMEMultipart("alternative")
-        message["Subject"] = f"【在庫あり】mineo商品在庫通知 ({datetime.now().strftime('%Y-%m-%d %H:%M')})"
-        message["From"] = email_user
-        message["To"] = recipient_email
+        return notifier.send(in_stock_products)
+    finally:
+        notifier.close()
+
+
+def start_notifications():
+    """通知用のバックグラウンドキューを開始（通知チャネルが1つも設定されていなければNone）
+
+    通知はメール・Slack・Discord・LINE・Webhookのうち設定されたすべてのチャネルへ同時に送る
+    """
+    from notify_dispatch import NotificationDispatcher
+
+    dispatcher = NotificationDispatcher.from_env()
+    return NotificationQueue(dispatcher) if dispatcher is not None else None
+
+
+def report_deliveries(report, deliveries):
+    """チャネルごとの通知の所要時間と失敗の件数を実行レポートに記録"""
+    for delivery in deliveries:
+        if not delivery["deduped"]:
+            report.add_durations(f"notify_{delivery['channel']}", [delivery["latency"]])
+    failed = sum(1 for delivery in deliveries if not delivery["ok"])
+    report.count("notify_failures", failed)
+
+
+def report_results(all_results):
+    """チェック結果をログに出力し、在庫のある商品のリストを返す"""
+    in_stock_products = []
+    for result in all_results:
+        logger.info("所要時間 (%s): %s", result['url'], result['timings'])
         
-        # HTML形式のメール本文を作成
-        html = f"""
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; }}
-                table {{ border-collapse: collapse; width: 100%; }}
-                th, td {{ border: 1px solid #ddd; padding: 8px; text-align: left; }}
-                th {{ background-color: #f2f2f2; }}
-                .stock-available {{ color: green; font-weight: bold; }}
-                .stock-unavailable {{ color: red; }}
-            </style>
-        </head>
-        <body>
-            <h2>mineo商品在庫通知</h2>
-            <p>以下の商品に在庫があります：</p>
+        if result["in_stock"]:
+            in_stock_products.append(result)
+            logger.info("在庫あり: %s", result['product_name'])
             
-            <table>
-                <tr>
-                    <th>商品名</th>
-                    <th>カラー</th>
-                    <th>在庫状況</th>
-                </tr>
-        """
-        
-        for product in in_stock_products:
-            for detail in product["details"]:
+            # 在庫ありの詳細をログに出力
+            for detail in result["details"]:
                 if detail["status"] == "在庫あり":
-                    status_class = "stock-available"
-                    status_text = "在庫あり"
-                else:
-                    status_class = "stock-unavailable"
-                    status_text = detail["status"]
-                    
-                html += f"""
-                <tr>
-                    <td><a href="{product['url']}">{product['product_name']}</a></td>
-                    <td>{detail['color']}</td>
-                    <td class="{status_class}">{status_text}</td>
-                </tr>
-                """
-        
-        html += """
-            </table>
-            <p>商品ページにアクセスするには、商品名をクリックしてください。</p>
-        </body>
-        </html>
-        """
-        
-        text_part = MIMEText("在庫のある商品が見つかりました。詳細はHTMLメールをご確認ください。", "plain")
-        html_part = MIMEText(html, "html")
-        
-        message.attach(text_part)
-        message.attach(html_part)
-        
-        # SMTPサーバーに接続してメール送信
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
-            server.login(email_user, email_pass)
-            server.sendmail(email_user, recipient_email, message.as_string())
-            
-        logger.info(f"在庫通知メールを送信しました: {recipient_email}")
-        
-    except Exception as e:
-        logger.error(f"メール送信中にエラーが発生しました: {str(e)}")
+                    logger.info("  - %s: %s", detail['color'], detail['status'])
+    return in_stock_products
+
+
+def save_cache(cache):
+    """ページキャッシュを保存（失敗してもチェックは止めない）"""
+    try:
+        cache.save()
+    except OSError as e:
+        logger.warning("ページキャッシュを保存できませんでした: %s", e)
+
+
+def save_health(health):
+    """URLの失敗の記録を保存（失敗してもチェックは止めない）"""
+    try:
+        health.save()
+    except OSError as e:
+        logger.warning("URLの健全性の記録を保存できませんでした: %s", e)
+
+
+def archive_results(archive, report, page_results):
+    """ページのチェック結果をアーカイブに追記し、古い観測がたまっていればまとめる（失敗してもチェックは止めない）"""
+    import sqlite3
+
+    try:
+        report.count("archived_observations", archive.append(page_results))
+        archive.maybe_compact()
+    except sqlite3.Error as e:
+        logger.warning("在庫のアーカイブに記録できませんでした: %s", e)
+
+
+def publish_status(board, all_results, urls=None):
+    """最新の結果を状態API・状態ファイル（STATUS_FILE）に反映（urlsを指定すると、それ以外の商品は取り除く）"""
+    changed = board.publish(all_results)
+    if urls is not None:
+        changed += board.retain(urls)
+    if changed:
+        logger.info("状態を更新しました: %s件 (版 %s)", changed, board.version)
+    status_file = os.getenv("STATUS_FILE")
+    if status_file:
+        try:
+            board.write(status_file)
+        except OSError as e:
+            logger.warning("状態ファイルを書き出せませんでした: %s", e)
+
+
+def report_health(report, page_results, health, host_breaker):
+    """スキップしたURLと、今回チェックを止めたURL・ホストを要約に出す"""
+    skipped = [result["url"] for result in page_results if result.get("skipped")]
+    if skipped:
+        logger.warning("チェックしなかったURL: %s件 (%s)", len(skipped), ", ".join(skipped))
+    if health.tripped:
+        logger.warning("失敗が続いたためチェックを止めたURL: %s", ", ".join(health.tripped))
+    if host_breaker.tripped_hosts:
+        logger.error("すべてのURLが失敗したためチェックを中止したホスト: %s", ", ".join(host_breaker.tripped_hosts))
+    logger.info("URLの健全性: %s", health.summary())
+    report.count("skipped_urls", len(skipped))
+    report.count("tripped_urls", len(health.tripped))
+    report.count("recovered_urls", len(health.recovered))
+    report.count("tripped_hosts", len(host_breaker.tripped_hosts))
+
+
+def notify_changes(store, all_results, in_stock_products, notifications):
+    """在庫なし→在庫ありに変わった商品（と再通知の時期が来た商品）だけメール送信"""
+    to_notify = store.update(all_results)
+    if to_notify:
+        if notifications is None:
+            logger.error("通知チャネル（メール・Slack・Discord・LINE・Webhook）が設定されていません")
+            return
+        # 送信はバックグラウンドで行い、送れたら通知済みとして記録する
+        notifications.submit(to_notify, on_sent=store.mark_notified)
+    elif in_stock_products:
+        logger.info("在庫状況に変化がないため通知しません")
+
 
+def main(shard=None):
+    """メイン処理（shardを指定すると担当するURLだけをチェックし、結果をファイルに書き出す）"""
+    from status_api import StatusBoard
+    from stock_archive import StockArchive
 
-def main():
-    """メイン処理"""
     logger.info("mineo在庫チェッカー実行開始")
     
-    urls = get_product_urls()
-    if not urls:
+    # シャードごとのジョブは一覧を取得しない（先に discover コマンドで更新した検出結果を使う）
+    discovered = discover_devices() if shard is None else None
+    subscriptions = get_watch_list()
+    if not subscriptions:
         logger.error("チェックする商品URLがありません")
         return
     
-    logger.info(f"{len(urls)}個の商品URLをチェックします")
+    # 同じページを指す商品は1回だけ取得する
+    plan = compile_fetch_plan(subscriptions)
+    watched_urls = subscription_urls(plan)
+    if len(plan) < len(subscriptions):
+        logger.info("監視リスト: %s件の商品を%sページの取得にまとめました", len(subscriptions), len(plan))
+    if shard is not None:
+        pages = set(select_shard([fetch["url"] for fetch in plan], shard))
+        plan = [fetch for fetch in plan if fetch["url"] in pages]
+    plan = skip_recently_checked(plan)
+    urls = [fetch["url"] for fetch in plan]
     
-    in_stock_products = []
-    all_results = []
+    if shard is not None:
+        logger.info("シャード %s/%s: %s個の商品URLを担当します", shard[0], shard[1], len(urls))
+    else:
+        logger.info("%s個の商品URLをチェックします", len(urls))
     
-    for url in urls:
-        logger.info(f"URLをチェック中: {url}")
-        result = check_stock(url)
-        all_results.append(result)
-        
-        if result["in_stock"]:
-            in_stock_products.append(result)
-            logger.info(f"在庫あり: {result['product_name']}")
-            
-            # 在庫ありの詳細をログに出力
-            for detail in result["details"]:
-                if detail["status"] == "在庫あり":
-                    logger.info(f"  - {detail['color']}: {detail['status']}")
+    run_started = time.perf_counter()
+    report = RunReport(mode="shard" if shard is not None else "once")
+    concurrency = int(os.getenv("CHECK_CONCURRENCY", "3"))
+    pool_size = int(os.getenv("BROWSER_POOL_SIZE", str(concurrency)))
+    with report.stage("cache_load"):
+        cache = PageCache().load()
+        health = UrlHealth().load()
+    host_breaker = HostBreaker()
+    snapshots = SnapshotStore()
+    pool = BrowserPool(size=pool_size)
+    try:
+        with report.stage("check"):
+            page_results = check_urls(
+                urls, pool, concurrency=concurrency, cache=cache, snapshots=snapshots, colors=fetch_colors(plan),
+                health=health, host_breaker=host_breaker,
+            )
+    finally:
+        with report.stage("browser_close"):
+            pool.close()
+    report.add_durations("chrome_start", pool.startup_times)
+    with report.stage("cache_save"):
+        save_cache(cache)
+        save_health(health)
+    with report.stage("snapshot_save"):
+        snapshots.close()
+    
+    # ページの結果を、そのページを監視している商品ごとの結果にする
+    all_results = fan_out(plan, page_results)
+    in_stock_products = report_results(all_results)
     
     # 在庫結果の要約をログに出力
-    logger.info(f"チェック完了: 合計{len(urls)}商品中、{len(in_stock_products)}商品で在庫あり")
+    logger.info("チェック完了: 合計%s商品中、%s商品で在庫あり", len(all_results), len(in_stock_products))
+    logger.info("チェック全体の所要時間: %.2f秒 (%s)", time.perf_counter() - run_started, cache.summary())
+    report_health(report, page_results, health, host_breaker)
     
-    # 在庫がある場合はメール送信
-    if in_stock_products:
-        send_email(in_stock_products)
+    if shard is not None:
+        # 通知はすべてのシャードの結果をマージしてから1回だけ行う
+        with report.stage("shard_write"):
+            write_partial_results(shard, urls, all_results)
+    else:
+        notify_results(report, all_results, in_stock_products)
+        if os.getenv("STATUS_FILE"):
+            publish_status(StatusBoard().load(os.getenv("STATUS_FILE")), all_results, watched_urls)
+    with report.stage("archive"), StockArchive() as archive:
+        archive_results(archive, report, page_results)
+    
+    report.add_results(page_results)
+    report.count("urls", len(urls))
+    report.count("subscriptions", len(all_results))
+    report.count("in_stock_products", len(in_stock_products))
+    report.count("cache_hits", cache.hits)
+    report.count("cache_misses", cache.misses)
+    if discovered is not None:
+        report_discovery(report, discovered)
+    report.write()
     
     logger.info("mineo在庫チェッカー実行終了")
 
 
+def report_discovery(report, discovered):
+    """商品の検出の件数を実行レポートに記録する"""
+    for name in ("new", "changed", "removed"):
+        report.count(f"discovered_{name}", len(discovered[name]))
+    report.count("discovery_fetches", discovered["fetched"])
+
+
+def skip_recently_checked(plan):
+    """チェックの間隔が指定されたページのうち、前回のチェックから間隔が経っていないものを除く"""
+    from stock_state import StockStateStore
+
+    if not any(fetch["interval"] for fetch in plan):
+        return plan
+    with StockStateStore() as store:
+        due = due_fetches(plan, store.last_checked)
+    if len(due) < len(plan):
+        logger.info("チェックの間隔が経っていない%sページをスキップします", len(plan) - len(due))
+    return due
+
+
+def notify_results(report, all_results, in_stock_products):
+    """在庫状況の変化を記録し、通知が必要ならメールを送る"""
+    from stock_state import StockStateStore
+
+    with report.stage("notify"), StockStateStore() as store:
+        notifications = start_notifications()
+        notify_changes(store, all_results, in_stock_products, notifications)
+        if notifications is not None:
+            notifications.close()
+            report_deliveries(report, notifications.notifier.deliveries)
+
+
+def merge_shards():
+    """すべてのシャードの結果をまとめ、1回だけ通知する"""
+    from status_api import StatusBoard
+
+    logger.info("シャードの結果のマージ開始")
+    report = RunReport(mode="merge")
+    with report.stage("shard_load"):
+        all_results, paths, missing = load_partial_results()
+    if not paths:
+        logger.error("マージするシャードの結果がありません")
+        return
+    if missing:
+        # 届いた結果だけでも通知する（欠けたシャードのURLは次回の実行でチェックされる）
+        logger.error("結果がないシャードがあります: %s", ", ".join(str(index) for index in missing))
+    # マージするジョブにも監視リストがあればその順番に並べる
+    watched_urls = None
+    if os.getenv("WATCH_LIST_FILE") or os.getenv("PRODUCT_URLS") or os.getenv("DISCOVERY_URLS"):
+        watched_urls = subscription_urls(compile_fetch_plan(get_watch_list()))
+        all_results = order_results(all_results, watched_urls)
+    
+    in_stock_products = report_results(all_results)
+    logger.info("マージ完了: 結果ファイル%s個, 合計%s商品中、%s商品で在庫あり", len(paths), len(all_results), len(in_stock_products))
+    notify_results(report, all_results, in_stock_products)
+    if os.getenv("STATUS_FILE"):
+        publish_status(StatusBoard().load(os.getenv("STATUS_FILE")), all_results, watched_urls)
+    
+    # 同じ結果を次回もう一度マージしないように削除する
+    for path in paths:
+        os.remove(path)
+    
+    report.add_results(all_results)
+    report.count("urls", len(all_results))
+    report.count("in_stock_products", len(in_stock_products))
+    report.count("shard_files", len(paths))
+    report.count("missing_shards", len(missing))
+    report.write()
+    
+    logger.info("シャードの結果のマージ終了")
+
+
+class AdaptiveSchedule:
+    """URLごとに次回のチェック時刻を決める（変化直後は短く、安定していれば長い間隔）"""
+
+    def __init__(self, min_interval=None, max_interval=None, stable_period=None, jitter=None):
+        if min_interval is None:
+            min_interval = float(os.getenv("DAEMON_MIN_INTERVAL", "60"))
+        if max_interval is None:
+            max_interval = float(os.getenv("DAEMON_MAX_INTERVAL", "900"))
+        if stable_period is None:
+            # この期間（秒）変化がなければ最長の間隔にする
+            stable_period = float(os.getenv("DAEMON_STABLE_PERIOD", str(3 * 24 * 3600)))
+        if jitter is None:
+            jitter = float(os.getenv("DAEMON_JITTER", "0.1"))
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.stable_period = max(1.0, stable_period)
+        self.jitter = jitter
+        self._next_due = {}
+        self._last_stock = {}
+        self._changed_at = {}
+        self._intervals = {}
+
+    def add(self, url, changed_at=None, now=None, interval=None):
+        """URLを登録し、すぐにチェックするようにする（intervalを指定するとそのURLは固定の間隔）"""
+        if now is None:
+            now = time.time()
+        self._next_due.setdefault(url, now)
+        self._changed_at.setdefault(url, changed_at or now)
+        if interval:
+            self._intervals[url] = interval
+        else:
+            self._intervals.pop(url, None)
+
+    def urls(self):
+        return list(self._next_due)
+
+    def remove(self, url):
+        self._next_due.pop(url, None)
+        self._last_stock.pop(url, None)
+        self._changed_at.pop(url, None)
+        self._intervals.pop(url, None)
+
+    def due(self, now=None):
+        """チェックする時刻になったURL"""
+        if now is None:
+            now = time.time()
+        return [url for url, due in self._next_due.items() if due <= now]
+
+    def seconds_until_next(self, now=None):
+        if now is None:
+            now = time.time()
+        if not self._next_due:
+            return self.max_interval
+        return max(0.0, min(self._next_due.values()) - now)
+
+    def interval_for(self, url, now=None):
+        """最後に変化してからの時間に応じた間隔（ジッターなし）"""
+        if url in self._intervals:
+            return self._intervals[url]
+        if now is None:
+            now = time.time()
+        stable_for = now - self._changed_at.get(url, now)
+        ratio = min(1.0, stable_for / self.stable_period)
+        return self.min_interval + (self.max_interval - self.min_interval) * ratio
+
+    def record(self, result, now=None):
+        """チェック結果を受け取り、次回のチェック時刻を決める"""
+        if now is None:
+            now = time.time()
+        url = result["url"]
+        if not result.get("error"):
+            # 価格の変動はアーカイブにだけ残し、チェック間隔は色ごとの在庫状況の変化だけで決める
+            stock = [(detail["color"], detail["status"]) for detail in result["details"]]
+            previous = self._last_stock.get(url)
+            if previous is not None and previous != stock:
+                logger.info("在庫状況が変化したためチェック間隔を短くします: %s", url)
+                self._changed_at[url] = now
+            self._last_stock[url] = stock
+        interval = self.interval_for(url, now)
+        # 同じ時刻にアクセスが集中しないように揺らす
+        interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        self._next_due[url] = now + interval
+        return interval
+
+
+def run_daemon(duration=None):
+    """ブラウザやキャッシュを保ったまま常駐し、URLごとの間隔でチェックを続ける"""
+    from status_api import StatusBoard, start_status_server, stop_status_server
+    from stock_archive import StockArchive
+    from stock_state import StockStateStore
+
+    logger.info("mineo在庫チェッカー常駐モード開始")
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info("終了シグナルを受け取りました (%s)。実行中のチェックが終わったら終了します", signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    heartbeat_interval = float(os.getenv("DAEMON_HEARTBEAT", "300"))
+    discovery_interval = float(os.getenv("DISCOVERY_INTERVAL_MINUTES", "60")) * 60
+    concurrency = int(os.getenv("CHECK_CONCURRENCY", "3"))
+    pool_size = int(os.getenv("BROWSER_POOL_SIZE", str(concurrency)))
+    deadline = time.monotonic() + duration if duration else None
+    schedule = AdaptiveSchedule()
+    cache = PageCache().load()
+    health = UrlHealth().load()
+    snapshots = SnapshotStore()
+    rate_limiter = HostRateLimiter()
+    checks = 0
+    last_heartbeat = time.monotonic()
+    last_discovery = None
+    notifications = start_notifications()
+    # 最新の結果をほかのツールから読めるようにする（STATUS_API_PORTを設定した場合）
+    board = StatusBoard().load(os.getenv("STATUS_FILE"))
+    status_server = start_status_server(board)
+
+    with BrowserPool(size=pool_size) as pool, StockStateStore() as store, StockArchive() as archive, snapshots:
+        while not stop.is_set():
+            if deadline and time.monotonic() >= deadline:
+                logger.info("指定された実行時間が経過しました")
+                break
+
+            # 一覧ページから商品を探すのは間隔を空けて（商品のチェックより間隔が長くてよい）
+            discovered = None
+            if last_discovery is None or time.monotonic() - last_discovery >= discovery_interval:
+                discovered = discover_devices()
+                last_discovery = time.monotonic()
+
+            # 監視するURLの追加・削除を反映
+            plan = compile_fetch_plan(get_watch_list())
+            urls = [fetch["url"] for fetch in plan]
+            for fetch in plan:
+                schedule.add(fetch["url"], changed_at=latest_time(fetch, store.last_changed), interval=fetch["interval"])
+            for url in set(schedule.urls()) - set(urls):
+                schedule.remove(url)
+
+            due = set(schedule.due())
+            due_plan = [fetch for fetch in plan if fetch["url"] in due]
+            due_urls = [fetch["url"] for fetch in due_plan]
+            if due_urls:
+                report = RunReport(mode="daemon")
+                host_breaker = HostBreaker()
+                health.new_cycle()
+                startups_before = len(pool.startup_times)
+                deliveries_before = len(notifications.notifier.deliveries) if notifications else 0
+                with report.stage("check"):
+                    page_results = check_urls(
+                        due_urls, pool, concurrency=concurrency, rate_limiter=rate_limiter, cache=cache,
+                        snapshots=snapshots, colors=fetch_colors(due_plan), health=health, host_breaker=host_breaker,
+                    )
+                checks += len(page_results)
+                for result in page_results:
+                    schedule.record(result)
+                with report.stage("cache_save"):
+                    save_cache(cache)
+                    save_health(health)
+                report_health(report, page_results, health, host_breaker)
+                all_results = fan_out(due_plan, page_results)
+                in_stock_products = report_results(all_results)
+                with report.stage("notify"):
+                    notify_changes(store, all_results, in_stock_products, notifications)
+                with report.stage("archive"):
+                    archive_results(archive, report, page_results)
+                publish_status(board, all_results, subscription_urls(plan))
+                # 前回のサイクル以降のChrome起動・通知の送信（送信は非同期なので前回分まで）
+                report.add_durations("chrome_start", pool.startup_times[startups_before:])
+                if notifications is not None:
+                    report_deliveries(report, notifications.notifier.deliveries[deliveries_before:])
+                report.add_results(page_results)
+                report.count("urls", len(due_urls))
+                report.count("subscriptions", len(all_results))
+                report.count("in_stock_products", len(in_stock_products))
+                report.count("cache_hits", cache.hits)
+                report.count("cache_misses", cache.misses)
+                if discovered is not None:
+                    report_discovery(report, discovered)
+                report.write()
+
+            if time.monotonic() - last_heartbeat >= heartbeat_interval:
+                logger.info(
+                    "稼働中: 監視%s件, 累計チェック%s件, %s, 次のチェックまで%.0f秒",
+                    len(urls), checks, cache.summary(), schedule.seconds_until_next(),
+                )
+                last_heartbeat = time.monotonic()
+
+            wait_seconds = min(schedule.seconds_until_next(), heartbeat_interval)
+            if deadline:
+                wait_seconds = min(wait_seconds, max(0.0, deadline - time.monotonic()))
+            stop.wait(max(1.0, wait_seconds))
+
+        if notifications is not None:
+            notifications.close()
+        stop_status_server(status_server, board)
+
+    logger.info("mineo在庫チェッカー常駐モード終了")
+
+
+def replay(path, colors=None):
+    """保存済みのHTML（スナップショットの圧縮ファイルも可）から在庫を判定して出力（ネットワークは使わない）"""
+    if path.endswith(tuple(COMPRESSIONS.values())):
+        html = read_snapshot(path)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            html = f.read()
+    extraction = extract_stock(html, colors or None)
+    log_extraction(logger, extraction, path)
+    result = {key: extraction[key] for key in ("product_name", "in_stock", "details", "error")}
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 1 if extraction["error"] else 0
+
+
+def notify_test():
+    """テスト用の商品を設定されたすべてのチャネルへ送り、通知の設定を確認する（1つでも失敗したら1）"""
+    from notify_dispatch import NotificationDispatcher
+
+    product = {
+        "product_name": "通知テスト（mineo在庫チェッカー）",
+        "url": "https://mineo.jp/",
+        "in_stock": True,
+        "details": [{"color": "テスト", "status": "在庫あり"}],
+    }
+    dispatcher = NotificationDispatcher.from_env()
+    if dispatcher is None:
+        logger.error("通知チャネル（メール・Slack・Discord・LINE・Webhook）が設定されていません")
+        return 1
+    try:
+        # 設定の確認なので、直前に同じテストを送っていても送る
+        dispatcher.send([product], dedupe=False)
+    finally:
+        dispatcher.close()
+    return 0 if all(delivery["ok"] for delivery in dispatcher.deliveries) else 1
+
+
+def format_duration(seconds):
+    """秒数を「1日3時間5分」の形にする"""
+    minutes = int(seconds // 60)
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    text = (f"{days}日" if days else "") + (f"{hours}時間" if hours else "")
+    return text + f"{minutes}分" if minutes or not text else text
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+
+
+def format_price(entry):
+    """一括価格と分割（24カ月）の月額（記録がなければ空文字）"""
+    parts = []
+    if entry["full_price"] is not None:
+        parts.append(f"{entry['full_price']:,}円")
+    if entry["installment_price"] is not None:
+        parts.append(f"分割 {entry['installment_price']:,}円/月")
+    return " / ".join(parts)
+
+
+def history(url, color=None, as_json=False):
+    """アーカイブから、色ごとの現在の在庫状況と最後に在庫ありだった期間を出力"""
+    from stock_archive import StockArchive
+
+    with StockArchive() as archive:
+        if not archive.enabled:
+            logger.error("ARCHIVE_DB_FILE が空のため、アーカイブは記録されていません")
+            return 1
+        entries = archive.history(normalize_url(url), color or None)
+    if not entries:
+        logger.error("アーカイブに記録がありません: %s", url)
+        return 1
+    if as_json:
+        print(json.dumps(entries, ensure_ascii=False, indent=2))
+        return 0
+    for entry in entries:
+        print(f"{entry['color']}: {entry['status']}（{format_time(entry['since'])}から、最終確認 {format_time(entry['checked_at'])}） {format_price(entry)}")
+        period = entry["last_in_stock"]
+        if period is None:
+            print("  記録の期間中に在庫ありになったことはありません")
+        elif period["until"] is None:
+            print(f"  在庫あり: {format_time(period['since'])}から{format_duration(period['duration'])}続いています")
+        else:
+            print(
+                f"  最後に在庫あり: {format_time(period['since'])} 〜 {format_time(period['until'])}"
+                f"（{format_duration(period['duration'])}、在庫ありは記録の期間中{entry['in_stock_count']}回）"
+            )
+    return 0
+
+
+def discover(as_json=False):
+    """一覧ページから商品を探し、監視する商品と前回からの変化を出力（取得するのは新しい商品・変わった商品のページだけ）"""
+    from discovery import DeviceDiscovery
+
+    discovery = DeviceDiscovery().load()
+    if not discovery.enabled:
+        logger.error("DISCOVERY_URLS が設定されていません")
+        return 1
+    summary = discovery.crawl(get_http_session())
+    watched = discovery.watched_devices()
+    if as_json:
+        print(json.dumps(dict(summary, devices=[dict(device, url=url) for url, device in watched]), ensure_ascii=False, indent=2))
+    else:
+        for url, device in watched:
+            mark = "（新規）" if url in summary["new"] else "（変更）" if url in summary["changed"] else ""
+            print(f"{device.get('page_name') or device['name']}: {url} {device.get('colors', 0)}色{mark}")
+        for url in summary["removed"]:
+            print(f"掲載終了: {url}")
+    # 一覧を1つも取得できず、前回の結果もない場合だけ失敗とする
+    return 1 if summary["errors"] and not summary["listed"] else 0
+
+
+# サブコマンド（省略時はcheck）
+COMMANDS = ("check", "replay", "history", "discover", "notify-test", "bench")
+
+
+def parse_args(argv=None):
+    """コマンドライン引数を解析"""
+    if argv is None:
+        argv = sys.argv[1:]
+    # 従来どおりサブコマンドなし（python stock_checker.py --daemon など）でもチェックを実行する
+    if not argv or argv[0] not in COMMANDS + ("-h", "--help"):
+        argv = ["check"] + list(argv)
+    parser = argparse.ArgumentParser(description="mineo在庫チェッカー")
+    subparsers = parser.add_subparsers(dest="command")
+
+    check = subparsers.add_parser("check", help="商品ページの在庫をチェックして通知する（既定）")
+    check.add_argument("--daemon", action="store_true", help="常駐してURLごとの間隔でチェックを続ける")
+    check.add_argument("--duration", type=float, default=None, help="常駐モードで実行を続ける秒数（省略時は終了シグナルまで）")
+    check.add_argument("--shard", default=None, help="i/n の形式で指定すると、n分割したURLのうちi番目（0から）だけをチェックして結果をファイルに書き出す")
+    check.add_argument("--merge", action="store_true", help="各シャードの結果をまとめて1回だけ通知する")
+
+    replay_parser = subparsers.add_parser("replay", help="保存済みのHTMLやスナップショットから在庫を判定する")
+    replay_parser.add_argument("file", help="HTMLファイル（.html.gz / .html.zst のスナップショットも可）")
+    replay_parser.add_argument("--colors", default="", help="判定する色（カンマ区切り、省略時はすべて）")
+
+    history_parser = subparsers.add_parser("history", help="アーカイブから、色ごとに最後に在庫ありだった期間と価格を表示する")
+    history_parser.add_argument("url", help="商品ページのURL")
+    history_parser.add_argument("--color", default=None, help="表示する色（色名の一部でもよい、省略時はすべて）")
+    history_parser.add_argument("--json", action="store_true", help="JSONで出力する")
+
+    discover_parser = subparsers.add_parser("discover", help="一覧ページ（DISCOVERY_URLS）から商品を探し、監視する商品を表示する")
+    discover_parser.add_argument("--json", action="store_true", help="JSONで出力する")
+
+    subparsers.add_parser("notify-test", help="テスト用の商品を設定されたすべての通知チャネルへ送る")
+
+    bench = subparsers.add_parser("bench", help="ベンチマークを実行する（python bench.py と同じ）")
+    bench.add_argument("names", nargs="*", help="実行するベンチマーク（省略時はすべて）")
+
+    args = parser.parse_args(argv)
+    if args.command == "check":
+        try:
+            args.shard = get_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.daemon and (args.shard is not None or args.merge):
+            parser.error("--daemon は --shard・--merge と同時に指定できません")
+    return args
+
+
+def run(args):
+    """サブコマンドを実行し、終了コードを返す"""
+    if args.command == "bench":
+        import bench
+
+        return bench.run_benchmarks(args.names)
+    # ロギングの設定（ファイル・コンソールへの書き込みはバックグラウンドのスレッドで行う）
+    setup_logging()
+    if args.command == "replay":
+        return replay(args.file, split_setting(args.colors))
+    if args.command == "history":
+        return history(args.url, args.color, args.json)
+    if args.command == "discover":
+        return discover(args.json)
+    if args.command == "notify-test":
+        return notify_test()
+    if args.daemon:
+        run_daemon(args.duration)
+    elif args.merge:
+        merge_shards()
+    else:
+        main(args.shard)
+    return 0
+
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    sys.exit(run(parse_args()))
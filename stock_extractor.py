@@ -0,0 +1,255 @@
+import hashlib
+import importlib.util
+from html.parser import HTMLParser
+
+# lxmlがあれば高速なlxmlでパースする（なければ標準のhtml.parser）
+# bs4とlxmlは最初にパースするときに読み込む
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") is not None else "html.parser"
+
+# パースする範囲（商品名・価格表・在庫状況テーブル）
+# 価格はキャンペーンの案内などを含むdevice-price-container全体ではなく、価格表だけをパースする
+STOCK_SECTION_CLASSES = ("page-title", "device-price-table", "device-stock-container")
+
+UNKNOWN_PRODUCT = "不明な商品"
+NO_STOCK_INFO = "在庫情報が見つかりませんでした"
+
+
+def is_stock_section_class(class_value):
+    """パース対象の要素のclass属性か"""
+    return bool(class_value) and any(name in STOCK_SECTION_CLASSES for name in class_value.split())
+
+
+def parse_stock_html(html, parser=None, scoped=True):
+    """在庫判定に必要な部分（商品名と在庫状況テーブル）だけをパース"""
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    if parser is None:
+        parser = HTML_PARSER
+    parse_only = SoupStrainer(class_=is_stock_section_class) if scoped else None
+    return BeautifulSoup(html, parser, parse_only=parse_only)
+
+
+class StockSectionWatcher(HTMLParser):
+    """少しずつ受け取るHTMLを読み、商品名と在庫状況テーブルが揃ったかを判定する
+
+    ダウンロードを途中で打ち切るための判定だけを行い、在庫の判定は受け取った部分を
+    parse_stock_htmlでパースし直して行う
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.stock_section_closed = False
+        self._in_page_title = None
+        self._title_parts = None
+        self._stock_tag = None
+        self._stock_depth = 0
+
+    @property
+    def complete(self):
+        return self.title is not None and self.stock_section_closed
+
+    def handle_starttag(self, tag, attrs):
+        class_value = dict(attrs).get("class") or ""
+        if self._stock_tag is not None:
+            # 同じ名前のタグだけを数えれば、閉じタグのない要素（img・brなど）に影響されない
+            if tag == self._stock_tag:
+                self._stock_depth += 1
+        elif not self.stock_section_closed and "device-stock-container" in class_value.split():
+            self._stock_tag = tag
+            self._stock_depth = 1
+        if self.title is None:
+            if self._in_page_title is None and "page-title" in class_value.split():
+                self._in_page_title = tag
+            elif self._in_page_title is not None and tag == "h1":
+                self._title_parts = []
+
+    def handle_endtag(self, tag):
+        if self._stock_tag is not None and tag == self._stock_tag:
+            self._stock_depth -= 1
+            if self._stock_depth == 0:
+                self._stock_tag = None
+                self.stock_section_closed = True
+        if self._title_parts is not None and tag == "h1":
+            self.title = "".join(self._title_parts).strip()
+            self._title_parts = None
+            self._in_page_title = None
+
+    def handle_data(self, data):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+
+
+def stock_data_looks_valid(soup):
+    """在庫セルがそろっていて、すべてにdata-stock-statusが入っているか"""
+    cells = soup.select(".replace-stock-color")
+    return bool(cells) and all(cell.get("data-stock-status") in ("1", "2") for cell in cells)
+
+
+def stock_fragment_hash(soup):
+    """商品名と在庫状況テーブルの内容のハッシュ（変化の有無の判定に使う）"""
+    return hashlib.sha256(str(soup).encode("utf-8")).hexdigest()
+
+
+def find_color_name(cell):
+    """在庫セルと同じ行のthから色名を取得"""
+    row = cell.find_parent("tr")
+    color_element = row.find("th") if row else None
+    if color_element is None:
+        # 表の形が想定と違う場合は直前のthを使う
+        color_element = cell.find_previous("th")
+    return "不明" if not color_element else color_element.text.strip()
+
+
+def classify_cell(cell_text, data_stock_status, icon_class):
+    """在庫セル1つの在庫状況を判定し、(在庫状況, 判断根拠) を返す
+
+    ------ 在庫判断ロジック（優先順位順） ------
+    1. data-stock-statusの値による判断（サイトの仕様に基づく）
+       - data-stock-status="2" → 在庫なし
+       - data-stock-status="1" → 在庫あり
+    2. テキストに「在庫なし」または「入荷待ち」がある場合は在庫なし
+    3. テキストがあり、それが「在庫なし」でない場合は在庫あり
+    4. アイコンの存在だけでは在庫ありと判断しない（JavaScriptで動的に変更される可能性があるため）
+    """
+    if data_stock_status == "2":
+        return "在庫なし", "data-stock-status=\"2\"（在庫なし）"
+    if data_stock_status == "1":
+        return "在庫あり", "data-stock-status=\"1\"（在庫あり）"
+    if "在庫なし" in cell_text or "入荷待ち" in cell_text:
+        return "在庫なし", "テキストに「在庫なし」または「入荷待ち」を含む"
+    if cell_text:
+        # テキストがあり、それが「在庫なし」でない場合は在庫あり
+        return "在庫あり", "テキストが存在し、「在庫なし」や「入荷待ち」を含まない"
+    if icon_class and "fa-circle" in icon_class:
+        # アイコンだけでは判断できないが、調査のため根拠に残す
+        return "判断不能（要確認）", "アイコン「fa-circle」の存在のみで在庫判断はできません。サイトが動的に更新されている可能性があります。"
+    return "状態不明", "既知のパターンに一致しない"
+
+
+def parse_yen(text):
+    """「64,416」「2,079円/月」などの金額を整数にする（数字がなければNone）"""
+    digits = "".join(ch for ch in text or "" if ch.isdigit())
+    return int(digits) if digits else None
+
+
+def find_prices(soup):
+    """価格表から一括価格・分割（24カ月）の月額・一括価格の表示（割引があれば割引前後の価格）を取り出す
+
+    価格表が1つでなければ（モデルごとに分かれていれば）色と対応づけられないので空の辞書を返す
+    """
+    tables = soup.select(".device-price-table")
+    if len(tables) != 1:
+        return {}
+    table = tables[0]
+    full_price = table.select_one(".replace-stock-full-price")
+    installment = table.select_one(".replace-stock-installment-price")
+    fraction_off = table.select_one(".replace-stock-fraction-off")
+    return {
+        "full_price": parse_yen(full_price.text) if full_price else None,
+        "installment_price": parse_yen(installment.text) if installment else None,
+        "fraction_off": (" ".join(fraction_off.text.split()) or None) if fraction_off else None,
+    }
+
+
+def row_prices(cell, page_prices):
+    """在庫セルの色の価格（行のdata-priceを価格表の表示で上書きする）"""
+    row = cell.find_parent("tr")
+    full_price = page_prices.get("full_price") or parse_yen(row.get("data-price") if row else None)
+    return {
+        "full_price": full_price,
+        "installment_price": page_prices.get("installment_price"),
+        "fraction_off": page_prices.get("fraction_off"),
+    }
+
+
+def color_matches(color, colors):
+    """ページの色名が監視する色のいずれかに当たるか（「ブラック」は「8GB/256GB ブラック」にも当たる）"""
+    return any(watched in color for watched in colors)
+
+
+def extract_from_soup(soup, colors=None):
+    """パース済みのページから商品名と色ごとの在庫状況を取り出す（副作用なし）
+
+    戻り値の "cells" には、色ごとの判断材料（セルのテキスト・アイコンのクラス・
+    data-stock-status）と判断根拠が入る。"details" には色ごとの在庫状況と価格（なければNone）が入る。
+    colorsを指定すると、それ以外の色は判定しない
+    """
+    title = soup.select_one(".page-title h1")
+    product_name = title.text.strip() if title else None
+    page_prices = find_prices(soup)
+
+    cells = []
+    in_stock = False
+    skipped = 0
+    for cell in soup.select(".replace-stock-color"):
+        color = find_color_name(cell)
+        if colors and not color_matches(color, colors):
+            skipped += 1
+            continue
+        cell_text = cell.text.strip()
+        icon = cell.find("i")
+        icon_class = icon.get("class") if icon else None
+        data_stock_status = cell.get("data-stock-status")
+        status, reason = classify_cell(cell_text, data_stock_status, icon_class)
+        if status == "在庫あり":
+            in_stock = True
+        cells.append({
+            "color": color,
+            "status": status,
+            "reason": reason,
+            "text": cell_text,
+            "icon_class": icon_class,
+            "data_stock_status": data_stock_status,
+            "prices": row_prices(cell, page_prices),
+        })
+
+    return {
+        "product_name": product_name or UNKNOWN_PRODUCT,
+        "product_name_found": product_name is not None,
+        "in_stock": in_stock,
+        "details": [{"color": c["color"], "status": c["status"], **c["prices"]} for c in cells],
+        "cells": cells,
+        "error": None if cells or skipped else NO_STOCK_INFO,
+    }
+
+
+def extract_stock(html, colors=None):
+    """HTMLから商品名と色ごとの在庫状況を取り出す（副作用なし）"""
+    return extract_from_soup(parse_stock_html(html), colors)
+
+
+class CellSummary:
+    """色ごとの判定結果と判断根拠（ログに出力されるときだけ文字列にする）"""
+
+    def __init__(self, cells):
+        self.cells = cells
+
+    def __str__(self):
+        return "; ".join(f"{cell['color']}: {cell['status']} - {cell['reason']}" for cell in self.cells)
+
+
+def log_extraction(logger, extraction, source):
+    """抽出結果と判断根拠を商品ごとに1件のログに出力（色ごとの判断材料はextraのcellsに入る）"""
+    if not extraction["product_name_found"]:
+        logger.warning("商品名が取得できませんでした: %s", source)
+
+    cells = extraction["cells"]
+    if not cells:
+        # 監視する色がすべて判定対象外なら、在庫情報がないわけではない
+        if extraction["error"]:
+            logger.warning("在庫情報が見つかりませんでした: %s", source)
+        return
+
+    logger.info(
+        "在庫判定: %s %s色 [%s]", extraction["product_name"], len(cells), CellSummary(cells),
+        extra={
+            "url": source,
+            "product_name": extraction["product_name"],
+            "in_stock": extraction["in_stock"],
+            "cells": cells,
+        },
+    )
+    uncertain = [cell for cell in cells if cell["status"] == "判断不能（要確認）"]
+    if uncertain:
+        logger.warning("注意: %s [%s]", extraction["product_name"], CellSummary(uncertain))
@@ -0,0 +1,168 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("mineo-stock-checker")
+
+IN_STOCK = "在庫あり"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stock_state (
+    url TEXT NOT NULL,
+    color TEXT NOT NULL,
+    product_name TEXT,
+    status TEXT NOT NULL,
+    changed_at REAL NOT NULL,
+    checked_at REAL NOT NULL,
+    notified_at REAL,
+    PRIMARY KEY (url, color)
+);
+"""
+
+
+class StockStateStore:
+    """URL・色ごとの前回の在庫状況を保存し、変化があったときだけ通知するためのストア
+
+    在庫状況と価格の推移はStockArchive（stock_checker.py history）に記録する
+    """
+
+    def __init__(self, path=None, realert_interval=None):
+        if path is None:
+            path = os.getenv("STATE_DB_FILE", os.path.join(".cache", "stock_state.db"))
+        if realert_interval is None:
+            # 在庫ありが続いている場合に再通知する間隔（分、0なら再通知しない）
+            realert_interval = float(os.getenv("REALERT_INTERVAL_MINUTES", "0")) * 60
+        self.path = path
+        self.realert_interval = realert_interval
+        self._lock = threading.Lock()
+        self._conn = None
+        self._state = {}
+        self._url_changed = {}
+        self._url_checked = {}
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def open(self):
+        """データベースを開き、現在の状態をメモリに読み込む"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(SCHEMA)
+        # (url, color) で直接引けるように辞書で持つ
+        self._state = {
+            (row["url"], row["color"]): dict(row)
+            for row in self._conn.execute("SELECT * FROM stock_state")
+        }
+        self._url_changed = {}
+        self._url_checked = {}
+        for (url, _), row in self._state.items():
+            self._url_changed[url] = max(self._url_changed.get(url, 0), row["changed_at"])
+            self._url_checked[url] = max(self._url_checked.get(url, 0), row["checked_at"])
+        return self
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get(self, url, color):
+        """URL・色の現在の状態（なければNone）"""
+        return self._state.get((url, color))
+
+    def last_changed(self, url):
+        """URLのいずれかの色の在庫状況が最後に変わった時刻（なければNone）"""
+        return self._url_changed.get(url)
+
+    def last_checked(self, url):
+        """URLを最後にチェックした時刻（なければNone）"""
+        return self._url_checked.get(url)
+
+    def update(self, results, now=None):
+        """チェック結果を反映し、通知すべき商品（在庫ありに変わった色と、まだ通知できていない色がある商品）を返す"""
+        if now is None:
+            now = time.time()
+        to_notify = []
+        with self._lock, self._conn:
+            for result in results:
+                # エラーになったURLは前回の状態を保つ
+                if result.get("error"):
+                    continue
+                alert_colors = []
+                for detail in result["details"]:
+                    key = (result["url"], detail["color"])
+                    previous = self._state.get(key)
+                    status = detail["status"]
+                    if previous is None or previous["status"] != status:
+                        self._record_change(key, result["product_name"], status, now, previous)
+                        if status == IN_STOCK:
+                            alert_colors.append(detail["color"])
+                    else:
+                        previous["checked_at"] = now
+                        self._url_checked[key[0]] = now
+                        self._conn.execute(
+                            "UPDATE stock_state SET checked_at = ? WHERE url = ? AND color = ?",
+                            (now, key[0], key[1]),
+                        )
+                        if status == IN_STOCK and self._needs_realert(previous, now):
+                            alert_colors.append(detail["color"])
+                if alert_colors:
+                    logger.info("通知対象: %s (%s)", result['product_name'], ', '.join(alert_colors))
+                    to_notify.append(dict(result, alert_colors=alert_colors))
+        return to_notify
+
+    def _record_change(self, key, product_name, status, now, previous):
+        """状態が変わったときに現在の状態を更新"""
+        url, color = key
+        if previous is not None:
+            logger.info("在庫状況が変化しました: %s %s %s → %s", product_name, color, previous['status'], status)
+        row = {
+            "url": url,
+            "color": color,
+            "product_name": product_name,
+            "status": status,
+            "changed_at": now,
+            "checked_at": now,
+            "notified_at": None,
+        }
+        self._state[key] = row
+        self._url_changed[url] = now
+        self._url_checked[url] = now
+        self._conn.execute(
+            "INSERT OR REPLACE INTO stock_state (url, color, product_name, status, changed_at, checked_at, notified_at) "
+            "VALUES (:url, :color, :product_name, :status, :changed_at, :checked_at, :notified_at)",
+            row,
+        )
+
+    def _needs_realert(self, state, now):
+        """在庫ありが続いている色を再通知する時期か（在庫ありに変わってからまだ通知できていなければ毎回）"""
+        if state["notified_at"] is None or state["notified_at"] < state["changed_at"]:
+            # 前回の送信がすべてのチャネルで失敗した（送れるまで通知対象に残す）
+            return True
+        if not self.realert_interval:
+            return False
+        last = state["notified_at"] or state["changed_at"]
+        return now - last >= self.realert_interval
+
+    def mark_notified(self, products, now=None):
+        """通知できた色に通知時刻を記録"""
+        if now is None:
+            now = time.time()
+        with self._lock, self._conn:
+            for product in products:
+                for color in product.get("alert_colors", []):
+                    state = self._state.get((product["url"], color))
+                    if state is None:
+                        continue
+                    state["notified_at"] = now
+                    self._conn.execute(
+                        "UPDATE stock_state SET notified_at = ? WHERE url = ? AND color = ?",
+                        (now, product["url"], color),
+                    )
@@ -0,0 +1,577 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# ロギングの設定
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    handlers=[
+        logging.StreamHandler(),
+    ],
+)
+logger = logging.getLogger("mineo-stub-server")
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 在庫APIのパス（STOCK_API_URLにはこのパスを指定する）
+STOCK_API_PATH = "/api/stock"
+
+# 広告・計測タグや画像などの外部リソースを模したパス（/third-party/<ホスト名>/<ファイル名>）
+THIRD_PARTY_PATH = "/third-party/"
+
+THIRD_PARTY_SCRIPTS = [
+    "assets.adobedtm.com/launch.min.js",
+    "www.googletagmanager.com/gtm.js",
+    "connect.facebook.net/en_US/fbevents.js",
+    "s.yimg.jp/images/listing/tool/cv/ytag.js",
+    "bat.bing.com/bat.js",
+    "c.amazon-adsystem.com/aat/amzn.js",
+    "cdn.smartnews-ads.com/i/pixel.js",
+    "d.line-scdn.net/n/line_tag/public/release/v1/lt.js",
+]
+
+CONTENT_TYPES = {
+    ".js": "application/javascript",
+    ".png": "image/png",
+    ".woff2": "font/woff2",
+}
+
+ROW_PATTERN = re.compile(
+    r'<tr[^>]*class="replace-stock"[^>]*data-modelnums="([^"]*)"[^>]*>.*?'
+    r'<td class="replace-stock-color"[^>]*data-stock-status="([^"]*)"',
+    re.S,
+)
+
+
+def fixture_name_for_path(path):
+    """URLのパスから保存済みHTMLのファイル名を求める（https___mineo_jp_... 形式）"""
+    return re.sub(r"[^A-Za-z0-9]", "_", "https://mineo.jp" + path) + ".html"
+
+
+def load_fixture(path):
+    """パスに対応する保存済みHTMLを読み込む（なければNone）"""
+    file_path = os.path.join(FIXTURE_DIR, fixture_name_for_path(path))
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def recorded_stock_statuses():
+    """保存済みHTMLから {型番: data-stock-status} を集めて在庫APIの応答とする"""
+    statuses = {}
+    for name in sorted(os.listdir(FIXTURE_DIR)):
+        if not name.startswith("https___mineo_jp_") or not name.endswith(".html"):
+            continue
+        with open(os.path.join(FIXTURE_DIR, name), "r", encoding="utf-8") as f:
+            for modelnum, status in ROW_PATTERN.findall(f.read()):
+                statuses[modelnum] = status
+    return statuses
+
+
+def blank_stock_statuses(html):
+    """JavaScript実行前の状態を再現するため、data-stock-statusを空にする"""
+    return re.sub(r'data-stock-status="[^"]*"', 'data-stock-status=""', html)
+
+
+SYNTHETIC_ROW = """<tr data-line="devicecolor_stock_line" class="replace-stock" data-groupids="{groupid}" data-modelnums="{modelnum}" data-name="{color}の在庫" data-price="49896">
+                                <th>
+                                    <span class="stock-color" style="background-color:#{rgb}"></span>{color}
+                                </th>
+                                <td class="replace-stock-color" data-datetime="" data-stock-status="{status}" style="visibility: visible;">{text}</td>
+                            </tr>"""
+
+SYNTHETIC_PAGE = """<html lang="ja">
+<head><title>{name} | mineo</title></head>
+<body>
+    <div id="wrapper">
+        <main class="page-layout-default">
+            <div class="container-page-title">
+                <div class="width-flex">
+                    <div class="page-title">
+                        <span><h1>{name}</h1></span>
+                    </div>
+                </div>
+            </div>
+            <article>
+                <!-- device-stock-container -->
+                <section class="device-stock-container bg-grey50">
+                    <div class="width-flex">
+                        <h2 class="line-height30px">{name}<br>在庫状況</h2>
+{tables}
+                    </div>
+                </section>
+            </article>
+        </main>
+    </div>
+{padding}
+    <script src="/asset/js/common/stock_device.js"></script>
+</body>
+</html>
+"""
+
+
+SYNTHETIC_TABLE = """
+                        {heading}<table class="width-middle">
+                            <tbody>{rows}
+                        </tbody></table>"""
+
+
+def synthetic_product_page(name, statuses, padding_kb=0, groupid="SYN000", variants=None):
+    """保存済みHTMLと同じ構造の商品ページを作る
+
+    statusesは色ごとのdata-stock-status（"1"=在庫あり, "2"=在庫なし, ""=JavaScript実行前）。
+    容量違いなど複数のモデルがあるページは、variantsに [(モデル名, statuses), ...] を指定する
+    （色名は「モデル名 カラーN」になる）。
+    padding_kbで、実際のページのように在庫状況テーブルの後ろに続くスクリプトの量を指定する
+    """
+    if variants is None:
+        variants = [(None, statuses)]
+    tables = []
+    for variant_index, (variant, variant_statuses) in enumerate(variants):
+        rows = []
+        for index, status in enumerate(variant_statuses):
+            rows.append(SYNTHETIC_ROW.format(
+                groupid=groupid,
+                modelnum=f"{groupid}{index:03d}" if variant is None else f"{groupid}V{variant_index}{index:03d}",
+                color=f"カラー{index + 1}" if variant is None else f"{variant} カラー{index + 1}",
+                rgb=f"{(index * 2654435761) & 0xFFFFFF:06x}",
+                status=status,
+                text="在庫なし" if status == "2" else ('<i class="far fa-circle"></i>' if status == "1" else ""),
+            ))
+        heading = "" if variant is None else f"<h3>{variant}</h3>\n                        "
+        tables.append(SYNTHETIC_TABLE.format(heading=heading, rows="".join(rows)))
+    script = "<script>(function(){var d=window.dataLayer=window.dataLayer||[];d.push({event:'tracking'});})();</script>\n"
+    padding = script * (padding_kb * 1024 // len(script) + 1) if padding_kb else ""
+    return SYNTHETIC_PAGE.format(name=name, tables="".join(tables), padding=padding)
+
+
+SYNTHETIC_LISTING = """<html lang="ja">
+<head><title>スマートフォン | mineo</title></head>
+<body>
+    <header>
+        <nav><a href="/device/">端末</a><a href="/device/smartphone/">Android</a><a href="/device/iphone/">iPhone</a></nav>
+    </header>
+    <main>
+        <h1>スマートフォン一覧</h1>
+        <ul class="device-list">{items}
+        </ul>
+    </main>
+</body>
+</html>
+"""
+
+SYNTHETIC_LISTING_ITEM = """
+            <li class="device-item">
+                <a href="{path}">
+                    <img src="/asset/img/device/{slug}.png" alt="{name}">
+                    <p class="device-name">{name}</p>
+                    <p class="device-price">{price:,}円（税込）</p>
+                </a>
+                {label}
+            </li>"""
+
+
+def synthetic_listing_page(devices):
+    """mineoのスマートフォン一覧のような、商品ごとのカードが並ぶページを作る
+
+    devicesは [(パス, 商品名, 価格, ラベル), ...]（ラベルは「在庫なし」などの表示、なければ空文字）
+    """
+    items = []
+    for path, name, price, label in devices:
+        items.append(SYNTHETIC_LISTING_ITEM.format(
+            path=path, slug=path.strip("/").rsplit("/", 1)[-1], name=name, price=price,
+            label=f'<span class="device-label">{label}</span>' if label else "",
+        ))
+    return SYNTHETIC_LISTING.format(items="".join(items))
+
+
+def synthetic_sitemap(base_url, entries):
+    """サイトマップのXMLを作る（entriesは [(パス, 更新日), ...]）"""
+    urls = "".join(f"<url><loc>{base_url}{path}</loc><lastmod>{lastmod}</lastmod></url>" for path, lastmod in entries)
+    return f'<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{urls}</urlset>'
+
+
+# 合成の商品ページのパス（/synthetic/<商品番号>/）
+SYNTHETIC_PATH = "/synthetic/"
+
+# 通知のWebhook（Slack・Discord・LINE・汎用）の代わりに受け取るパス（/webhook/<名前>）
+WEBHOOK_PATH = "/webhook/"
+
+
+class SyntheticCatalog:
+    """番号を指定するだけで返せる合成の商品ページの一覧（負荷試験用）
+
+    色ごとの在庫状況は商品番号・モデル・色から決まり、flip_intervalを指定すると
+    flip_ratioの割合の色がその間隔ごとに在庫あり・在庫なしを繰り返す
+    """
+
+    def __init__(self, colors=5, variants=1, in_stock_ratio=0.3, blank_ratio=0.0, page_kb=50,
+                 error_rate=0.0, flip_interval=0.0, flip_ratio=0.1, seed=0):
+        self.colors = colors
+        self.variants = variants
+        self.in_stock_ratio = in_stock_ratio
+        # data-stock-statusが空のまま（JavaScript実行前）の色の割合
+        self.blank_ratio = blank_ratio
+        self.page_kb = page_kb
+        # 500エラーを返す割合
+        self.error_rate = error_rate
+        self.flip_interval = flip_interval
+        self.flip_ratio = flip_ratio
+        self.seed = seed
+        self.started = time.time()
+
+    def _fraction(self, *parts):
+        """商品・モデル・色ごとに決まる0以上1未満の値"""
+        key = ":".join(str(part) for part in (self.seed,) + parts)
+        return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "big") / 2 ** 64
+
+    def epoch(self, now=None):
+        """開始してから何回在庫が切り替わったか"""
+        if not self.flip_interval:
+            return 0
+        if now is None:
+            now = time.time()
+        return int((now - self.started) // self.flip_interval)
+
+    def flip_time(self, epoch):
+        """epoch回目の切り替えの時刻"""
+        return self.started + epoch * self.flip_interval
+
+    def flips(self, product, variant, color):
+        """在庫が切り替わる色か"""
+        return bool(self.flip_interval) and self._fraction(product, variant, color, "flip") < self.flip_ratio
+
+    def status(self, product, variant, color, now=None):
+        value = self._fraction(product, variant, color, "stock")
+        if value < self.blank_ratio:
+            return ""
+        in_stock = value < self.blank_ratio + self.in_stock_ratio
+        if self.flips(product, variant, color) and self.epoch(now) % 2:
+            in_stock = not in_stock
+        return "1" if in_stock else "2"
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def page(self, product, now=None):
+        variants = [
+            (f"{64 * 2 ** index}GB" if self.variants > 1 else None,
+             [self.status(product, index, color, now) for color in range(self.colors)])
+            for index in range(self.variants)
+        ]
+        html = synthetic_product_page(f"合成商品 {product}", None, groupid=f"SYN{product:05d}", variants=variants)
+        padding_kb = max(0, self.page_kb - len(html.encode("utf-8")) // 1024)
+        return synthetic_product_page(f"合成商品 {product}", None, padding_kb=padding_kb,
+                                      groupid=f"SYN{product:05d}", variants=variants)
+
+    def urls(self, base_url, count):
+        return [f"{base_url}{SYNTHETIC_PATH}{product}/" for product in range(count)]
+
+
+def resource_heavy_page(resource_base, name, statuses, images=30, fonts=3, image_kb=100):
+    """広告・計測タグ、画像、フォントを読み込む商品ページを作る（Chromeのリソース制限の計測用）
+
+    resource_baseには外部リソースを返すサーバーのURLを指定する
+    （ページと別のホスト名にすると、ALLOWED_HOSTSによる制限も試せる）
+    """
+    base = resource_base + THIRD_PARTY_PATH
+    tags = [f'<script async src="{base}{script}"></script>' for script in THIRD_PARTY_SCRIPTS]
+    tags.append("<style>")
+    for index in range(fonts):
+        tags.append(f'@font-face {{ font-family: "stub{index}"; src: url("{base}fonts.example/stub{index}.woff2"); }}')
+        tags.append(f'.font{index} {{ font-family: "stub{index}"; }}')
+    tags.append("</style>")
+    for index in range(fonts):
+        tags.append(f'<p class="font{index}">フォント{index}</p>')
+    for index in range(images):
+        tags.append(f'<img src="{base}images.example/banner{index}.png?size={image_kb}" width="300" height="250">')
+    html = synthetic_product_page(name, statuses)
+    return html.replace("</body>", "\n".join(tags) + "\n</body>")
+
+
+class StubState:
+    """スタブサーバーの応答内容（テストから書き換えられる）"""
+
+    def __init__(self):
+        self.statuses = recorded_stock_statuses()
+        # Trueにすると商品ページのdata-stock-statusを空にして返す
+        self.blank_status = False
+        # Trueにすると在庫APIが500エラーを返す
+        self.api_error = False
+        # 応答を返すまでの遅延（秒）
+        self.latency = 0.0
+        # 外部リソースを返すまでの遅延（秒）
+        self.resource_latency = 0.0
+        # 0より大きくすると、本文をこの速度（バイト/秒）で少しずつ送る
+        self.bytes_per_second = 0
+        # クライアントが途中で接続を閉じた応答の数
+        self.aborted = 0
+        # SyntheticCatalogを設定すると /synthetic/<商品番号>/ で合成の商品ページを返す
+        self.catalog = None
+        # パスごとに返すHTML（保存済みHTMLより優先する）
+        self.pages = {}
+        self.requests = []
+        # Webhookで受け取った通知（パス・ヘッダー・本文）
+        self.webhooks = []
+        # Webhookのパスごとの応答までの遅延（秒）と、500エラーを返す残りの回数
+        self.webhook_latency = {}
+        self.webhook_failures = {}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """保存済みHTMLと在庫APIを返すハンドラ"""
+
+    server_version = "mineo-stub/1.0"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        state = self.server.state
+        parsed = urlparse(self.path)
+        state.requests.append(parsed.path)
+        if state.latency:
+            time.sleep(state.latency)
+
+        if parsed.path == STOCK_API_PATH:
+            if state.api_error:
+                self.send_body(500, "application/json", b'{"error": "stub"}')
+                return
+            query = parse_qs(parsed.query)
+            modelnums = ",".join(query.get("modelnums", [])).split(",")
+            body = [
+                {"modelnum": modelnum, "stock_status": state.statuses[modelnum]}
+                for modelnum in modelnums
+                if modelnum in state.statuses
+            ]
+            self.send_body(200, "application/json", json.dumps(body).encode("utf-8"))
+            return
+
+        if parsed.path.startswith(THIRD_PARTY_PATH):
+            self.send_third_party(parsed)
+            return
+
+        html = state.pages.get(parsed.path)
+        if html is None and state.catalog is not None and parsed.path.startswith(SYNTHETIC_PATH):
+            product = parsed.path[len(SYNTHETIC_PATH):].strip("/")
+            if state.catalog.should_fail():
+                self.send_body(500, "text/html; charset=utf-8", b"stub error")
+                return
+            if product.isdigit():
+                html = state.catalog.page(int(product))
+        if html is None:
+            html = load_fixture(parsed.path)
+        if html is None:
+            self.send_body(404, "text/html; charset=utf-8", b"not found")
+            return
+        if state.blank_status:
+            html = blank_stock_statuses(html)
+        body = html.encode("utf-8")
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_body(200, "text/html; charset=utf-8", body, {"ETag": etag})
+
+    def do_POST(self):
+        """通知のWebhookを受け取る（本文のJSONを記録する）"""
+        state = self.server.state
+        path = urlparse(self.path).path
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if not path.startswith(WEBHOOK_PATH):
+            self.send_body(404, "text/plain", b"not found")
+            return
+        if state.webhook_latency.get(path):
+            time.sleep(state.webhook_latency[path])
+        if state.webhook_failures.get(path):
+            state.webhook_failures[path] -= 1
+            self.send_body(500, "text/plain", b"stub error")
+            return
+        state.webhooks.append({
+            "path": path,
+            "headers": dict(self.headers),
+            "body": json.loads(body.decode("utf-8")) if body else None,
+        })
+        try:
+            self.send_body(200, "text/plain", b"ok")
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントがタイムアウトして先に接続を閉じた
+            state.aborted += 1
+            self.close_connection = True
+
+    def send_third_party(self, parsed):
+        """外部リソースの代わりに、遅延させてダミーの内容を返す"""
+        state = self.server.state
+        if state.resource_latency:
+            time.sleep(state.resource_latency)
+        extension = os.path.splitext(parsed.path)[1]
+        if extension == ".js":
+            body = b"(function(){window.stubTags=(window.stubTags||0)+1;})();"
+        else:
+            size_kb = int(parse_qs(parsed.query).get("size", ["20"])[0])
+            body = b"\0" * (size_kb * 1024)
+        self.send_body(200, CONTENT_TYPES.get(extension, "application/octet-stream"), body)
+
+    def send_body(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        state = self.server.state
+        if not state.bytes_per_second:
+            self.wfile.write(body)
+            return
+        # 遅い回線を再現するため、4KBずつ間隔を空けて送る
+        chunk_size = 4096
+        try:
+            for offset in range(0, len(body), chunk_size):
+                self.wfile.write(body[offset:offset + chunk_size])
+                self.wfile.flush()
+                time.sleep(chunk_size / state.bytes_per_second)
+        except (BrokenPipeError, ConnectionResetError):
+            state.aborted += 1
+            self.close_connection = True
+
+
+def start_stub_server(port=0):
+    """スタブサーバーをバックグラウンドで起動し、(server, ベースURL) を返す"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    logger.info(f"スタブサーバーを起動しました: {base_url}")
+    return server, base_url
+
+
+class SmtpStubState:
+    """SMTPスタブが受け取ったメール（テストから参照する）"""
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        self.logins = 0
+        # Trueにすると、メールを1通受け取るたびに接続を切る
+        self.drop_after_message = False
+
+
+class SmtpStubHandler(socketserver.StreamRequestHandler):
+    """テスト用の最小限のSMTPサーバー（認証はすべて受け付ける）"""
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode("utf-8"))
+
+    def handle(self):
+        state = self.server.state
+        state.connections += 1
+        sender = None
+        recipients = []
+        self.reply("220 mineo-stub ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.wfile.write(b"250-mineo-stub\r\n250 AUTH PLAIN LOGIN\r\n")
+            elif verb == "AUTH":
+                state.logins += 1
+                self.reply("235 Authentication successful")
+            elif verb == "MAIL":
+                sender = command.split(":", 1)[1].strip().strip("<>")
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[1].strip().strip("<>"))
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                    data.append(data_line)
+                state.messages.append({
+                    "from": sender,
+                    "to": recipients,
+                    "data": b"".join(data).decode("utf-8", "replace"),
+                })
+                self.reply("250 OK")
+                if state.drop_after_message:
+                    return
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+def start_smtp_stub(port=0):
+    """SMTPスタブをバックグラウンドで起動し、(server, ポート番号) を返す"""
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", port), SmtpStubHandler)
+    server.daemon_threads = True
+    server.state = SmtpStubState()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f"SMTPスタブを起動しました: 127.0.0.1:{server.server_address[1]}")
+    return server, server.server_address[1]
+
+
+def add_catalog_arguments(parser):
+    """合成の商品ページの設定をコマンドライン引数に追加（loadtest.pyと共通）"""
+    parser.add_argument("--colors", type=int, default=5, help="1モデルあたりの色数")
+    parser.add_argument("--variants", type=int, default=1, help="1ページあたりのモデル（容量違いなど）の数")
+    parser.add_argument("--in-stock-ratio", type=float, default=0.3, help="在庫ありの色の割合")
+    parser.add_argument("--blank-ratio", type=float, default=0.0, help="data-stock-statusが空の色の割合")
+    parser.add_argument("--page-kb", type=int, default=50, help="ページの大きさ（KB）")
+    parser.add_argument("--latency", type=float, default=0.0, help="応答を返すまでの遅延（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500エラーを返す割合")
+    parser.add_argument("--flip-interval", type=float, default=0.0, help="在庫を切り替える間隔（秒、0なら切り替えない）")
+    parser.add_argument("--flip-ratio", type=float, default=0.1, help="在庫が切り替わる色の割合")
+    parser.add_argument("--seed", type=int, default=0, help="在庫状況を決める乱数の種")
+
+
+def catalog_from_args(args):
+    return SyntheticCatalog(
+        colors=args.colors, variants=args.variants, in_stock_ratio=args.in_stock_ratio,
+        blank_ratio=args.blank_ratio, page_kb=args.page_kb, error_rate=args.error_rate,
+        flip_interval=args.flip_interval, flip_ratio=args.flip_ratio, seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="保存済みHTMLと合成の商品ページを返すスタブサーバー")
+    parser.add_argument("port", type=int, nargs="?", default=8000)
+    add_catalog_arguments(parser)
+    args = parser.parse_args()
+    port = args.port
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    server.state = StubState()
+    server.state.latency = args.latency
+    server.state.catalog = catalog_from_args(args)
+    logger.info(f"スタブサーバーを起動しました: http://127.0.0.1:{port}")
+    logger.info(f"在庫API: http://127.0.0.1:{port}{STOCK_API_PATH}?modelnums={{modelnums}}")
+    logger.info(f"合成の商品ページ: http://127.0.0.1:{port}{SYNTHETIC_PATH}<商品番号>/")
+    logger.info(f"通知のWebhook: http://127.0.0.1:{port}{WEBHOOK_PATH}<名前>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
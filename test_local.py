@@ -1,7 +1,28 @@
 import os
+import sys
+import json
+import time
 import logging
-from bs4 import BeautifulSoup
-from stock_checker import send_email
+import tempfile
+import subprocess
+from stock_checker import send_email, check_stock, check_urls, notify_changes, fetch_stock_http, full_page_html, get_watch_list
+from stock_extractor import extract_from_soup, extract_stock, log_extraction, parse_stock_html
+from stub_server import (
+    start_stub_server, start_smtp_stub, synthetic_listing_page, synthetic_product_page, synthetic_sitemap, STOCK_API_PATH,
+    WEBHOOK_PATH,
+)
+from notifier import EmailNotifier, NotificationQueue
+from notify_dispatch import (
+    DiscordChannel, EmailChannel, LineChannel, NotificationDispatcher, SlackChannel, WebhookChannel, dedupe_key,
+)
+from page_cache import PageCache
+from stock_state import StockStateStore
+from stock_archive import StockArchive
+from snapshot_store import SnapshotStore, list_snapshots, read_snapshot
+from watch_list import compile_fetch_plan, fan_out, fetch_colors, load_watch_list
+from url_health import HALF_OPEN, OPEN, HostBreaker, UrlHealth
+from status_api import StatusBoard, start_status_server, stop_status_server
+from discovery import DeviceDiscovery
 
 # ロギングの設定
 logging.basicConfig(
@@ -13,109 +34,38 @@ logging.basicConfig(
 )
 logger = logging.getLogger("mineo-stock-checker-test")
 
+# テスト対象のHTMLファイル
+TEST_FILES = [
+    {
+        "file": "https___mineo_jp_device_smartphone_motorola_edge_40_neo_.html",
+        "url": "https://mineo.jp/device/smartphone/motorola-edge-40-neo/",
+        "path": "/device/smartphone/motorola-edge-40-neo/"
+    },
+    {
+        "file": "https___mineo_jp_device_smartphone_aquos_sense9_8gb_256gb_.html",
+        "url": "https://mineo.jp/device/smartphone/aquos-sense9/",
+        "path": "/device/smartphone/aquos-sense9-8gb-256gb/"
+    }
+]
+
 def check_stock_from_file(file_path, url="https://example.com"):
-    """ローカルのHTMLファイルから在庫状況をチェック"""
+    """ローカルのHTMLファイルから在庫状況をチェック（stock_checkerと同じ抽出処理を使う）"""
     try:
         with open(file_path, 'r', encoding='utf-8') as file:
             html_content = file.read()
-        
-        soup = BeautifulSoup(html_content, "html.parser")
         logger.debug(f"ファイルからHTMLを読み込みました: {file_path}")
         
-        # 商品名を取得
-        product_name = soup.select_one(".page-title h1")
-        if product_name:
-            product_name = product_name.text.strip()
-            logger.info(f"商品名: {product_name}")
-        else:
-            product_name = "不明な商品"
-            logger.warning(f"商品名が取得できませんでした: {file_path}")
-            
-        # 在庫状況テーブルを検索
-        stock_cells = soup.select(".replace-stock-color")
-        
-        if not stock_cells:
-            logger.warning(f"在庫情報が見つかりませんでした: {file_path}")
-            return {
-                "product_name": product_name,
-                "url": url,
-                "in_stock": False,
-                "details": [],
-                "error": "在庫情報が見つかりませんでした"
-            }
-        
-        logger.info(f"在庫情報セルを {len(stock_cells)} 個見つけました")
+        extraction = extract_stock(html_content)
+        log_extraction(logger, extraction, file_path)
         
-        in_stock = False
-        details = []
-        
-        for cell in stock_cells:
-            # 色名を取得（親要素のth内）
-            color_element = cell.find_previous("th")
-            color_name = "不明" if not color_element else color_element.text.strip()
-            
-            # セルの内容をログに出力（判断根拠の表示）
-            cell_text = cell.text.strip()
-            logger.info(f"セル内容 ({color_name}): {cell_text}")
-            
-            # アイコンの有無とクラスを確認
-            icon = cell.find("i")
-            icon_class = None
-            if icon:
-                icon_class = icon.get('class')
-                logger.info(f"  - アイコンクラス: {icon_class}")
-            
-            # data-stock-status属性の値を取得
-            data_stock_status = cell.get('data-stock-status')
-            if data_stock_status:
-                logger.info(f"  - data-stock-status: {data_stock_status}")
-            
-            # ------ 在庫判断ロジック（優先順位順） ------
-            # 1. テキストに「在庫なし」または「入荷待ち」がある場合は在庫なし
-            # 2. data-stock-statusの値による判断（サイトの仕様に基づく）
-            #    - data-stock-status="2" → 在庫なし
-            #    - data-stock-status="1" → 在庫あり
-            # 3. テキストがあり、それが「在庫なし」でない場合は在庫あり
-            # 4. アイコンの存在だけでは在庫ありと判断しない（JavaScriptで動的に変更される可能性があるため）
-            
-            if "在庫なし" in cell_text or "入荷待ち" in cell_text:
-                status = "在庫なし"
-                logger.info(f"  - 判断根拠: テキストに「在庫なし」または「入荷待ち」を含む")
-            elif data_stock_status == "2":
-                status = "在庫なし"
-                logger.info(f"  - 判断根拠: data-stock-status=\"2\"（在庫なし）")
-            elif data_stock_status == "1":
-                status = "在庫あり"
-                in_stock = True
-                logger.info(f"  - 判断根拠: data-stock-status=\"1\"（在庫あり）")
-            elif cell_text and "在庫なし" not in cell_text and "入荷待ち" not in cell_text:
-                # テキストがあり、それが「在庫なし」でない場合は在庫あり
-                status = "在庫あり"
-                in_stock = True
-                logger.info(f"  - 判断根拠: テキストが存在し、「在庫なし」や「入荷待ち」を含まない")
-            elif icon and icon_class and 'fa-circle' in icon_class:
-                # アイコンだけでは判断できないが、調査のためログに残す
-                logger.warning(f"  - 注意: アイコン「fa-circle」の存在のみで在庫判断はできません。サイトが動的に更新されている可能性があります。")
-                status = "判断不能（要確認）"
-            else:
-                status = "状態不明"
-                logger.info(f"  - 判断根拠: 既知のパターンに一致しない")
-            
-            details.append({
-                "color": color_name,
-                "status": status
-            })
-        
-        result = {
-            "product_name": product_name,
+        return {
+            "product_name": extraction["product_name"],
             "url": url,
-            "in_stock": in_stock,
-            "details": details,
-            "error": None
+            "in_stock": extraction["in_stock"],
+            "details": extraction["details"],
+            "error": extraction["error"]
         }
         
-        return result
-        
     except Exception as e:
         logger.error(f"在庫チェック中にエラーが発生しました: {file_path} - {str(e)}")
         return {
@@ -126,21 +76,647 @@ def check_stock_from_file(file_path, url="https://example.com"):
             "error": str(e)
         }
 
+def check_http_fetch(test_files):
+    """スタブサーバーを相手に、ブラウザなしの取得結果が保存済みHTMLの結果と一致するか確認"""
+    server, base_url = start_stub_server()
+    ok = True
+    try:
+        os.environ["STOCK_API_URL"] = base_url + STOCK_API_PATH + "?modelnums={modelnums}"
+
+        # JavaScript実行前の状態（data-stock-statusが空）のページを返し、在庫APIで埋める
+        server.state.blank_status = True
+        for test in test_files:
+            path = test["path"]
+            expected = check_stock_from_file(test["file"], test["url"])
+            result = check_stock(base_url + path, fetch_mode="http-only")
+            if result["error"] or result["details"] != expected["details"]:
+                ok = False
+                logger.error(f"HTTP取得の結果が一致しません: {path} - {result['details']} != {expected['details']}")
+            else:
+                logger.info(f"HTTP取得の結果が一致しました: {path} ({result['timings']})")
+
+        # 在庫APIが失敗した場合はエラーとして扱われる（httpモードではSeleniumに切り替わる）
+        server.state.api_error = True
+        path = test_files[0]["path"]
+        result = check_stock(base_url + path, fetch_mode="http-only")
+        if not result["error"]:
+            ok = False
+            logger.error("在庫APIのエラーが検出されませんでした")
+    finally:
+        os.environ.pop("STOCK_API_URL", None)
+        server.shutdown()
+
+    logger.info(f"HTTP取得テスト: {'成功' if ok else '失敗'}")
+    return ok
+
+def check_page_cache(test_files):
+    """2回目のチェックで、304と在庫状況テーブルのハッシュ一致によりキャッシュが使われるか確認"""
+    server, base_url = start_stub_server()
+    ok = True
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = os.path.join(tmp_dir, "page_cache.json")
+            urls = [base_url + test["path"] for test in test_files]
+
+            # 1回目はすべてミス、2回目は304ですべてヒットする
+            for expected_hits in (0, len(urls)):
+                cache = PageCache(path=cache_path).load()
+                results = [check_stock(url, fetch_mode="http-only", cache=cache) for url in urls]
+                cache.save()
+                if cache.hits != expected_hits or any(r["error"] for r in results):
+                    ok = False
+                    logger.error(f"キャッシュのヒット数が想定と違います: {cache.summary()}")
+
+            # 在庫APIを使う場合は条件付きGETをせず、テーブルのハッシュ一致でヒットする
+            os.environ["STOCK_API_URL"] = base_url + STOCK_API_PATH + "?modelnums={modelnums}"
+            cache = PageCache(path=cache_path).load()
+            results = [check_stock(url, fetch_mode="http-only", cache=cache) for url in urls]
+            if cache.hits != len(urls) or not all(r.get("cached") for r in results):
+                ok = False
+                logger.error(f"在庫APIを使うときのキャッシュのヒット数が想定と違います: {cache.summary()}")
+
+            # 強制的に取り直す設定ではキャッシュを使わない
+            cache = PageCache(path=cache_path, refresh=True).load()
+            results = [check_stock(url, fetch_mode="http-only", cache=cache) for url in urls]
+            if cache.hits != 0:
+                ok = False
+                logger.error(f"強制再取得でキャッシュが使われました: {cache.summary()}")
+    finally:
+        os.environ.pop("STOCK_API_URL", None)
+        server.shutdown()
+
+    logger.info(f"ページキャッシュテスト: {'成功' if ok else '失敗'}")
+    return ok
+
+def check_state_store(test_files):
+    """在庫なし→在庫ありに変わったとき（と送信に失敗した通知）だけ通知対象になるか確認"""
+    results = [check_stock_from_file(test["file"], test["url"]) for test in test_files]
+    in_stock_urls = [r["url"] for r in results if r["in_stock"]]
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with StockStateStore(path=os.path.join(tmp_dir, "state.db"), realert_interval=3600) as store:
+            # 初回は在庫ありの商品が通知対象
+            notified = store.update(results, now=1000)
+            ok &= [p["url"] for p in notified] == in_stock_urls
+            store.mark_notified(notified, now=1000)
+
+            # 変化がなければ通知しない
+            ok &= store.update(results, now=1300) == []
+
+            # 在庫なしになってから在庫ありに戻ったら通知する
+            sold_out = [dict(r, details=[dict(d, status="在庫なし") for d in r["details"]]) for r in results]
+            ok &= store.update(sold_out, now=1600) == []
+            notified = store.update(results, now=1900)
+            ok &= [p["url"] for p in notified] == in_stock_urls
+
+            # 送信に失敗した（mark_notifiedされなかった）通知は、送れるまで次のチェックでも通知対象になる
+            notified = store.update(results, now=1950)
+            ok &= [p["url"] for p in notified] == in_stock_urls
+            store.mark_notified(notified, now=1950)
+            ok &= store.update(results, now=2000) == []
+
+            # 再通知の間隔が過ぎたら在庫ありが続いていても通知する
+            ok &= store.update(results, now=1950 + 3600)[0]["url"] == in_stock_urls[0]
+
+        # 保存した状態は次回の実行に引き継がれる
+        with StockStateStore(path=os.path.join(tmp_dir, "state.db")) as store:
+            ok &= store.update(results, now=9000) == []
+
+    logger.info(f"在庫状態ストアテスト: {'成功' if ok else '失敗'}")
+    return ok
+
+def check_snapshot_store(test_files):
+    """スナップショットがURLごとに件数の上限まで残り、判定できないページだけ全体（打ち切ったページは取得し直して）が保存されるか確認"""
+    server, base_url = start_stub_server()
+    ok = True
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            urls = [base_url + test["path"] for test in test_files]
+            with SnapshotStore(directory=tmp_dir, per_url=2, compression="gzip") as snapshots:
+                for _ in range(3):
+                    for url in urls:
+                        check_stock(url, fetch_mode="http-only", snapshots=snapshots)
+                # 判定できない色があるページはページ全体を保存する
+                html = synthetic_product_page("判定できないページ", ["1", ""])
+                soup = parse_stock_html(html)
+                snapshots.save(urls[0], soup, html, dict(extract_from_soup(soup), url=urls[0]))
+            saved = list_snapshots(tmp_dir)
+            ok &= len(saved) == 2 * len(urls)
+            latest = list_snapshots(tmp_dir, urls[0])
+            ok &= [kind for _, _, kind, _ in latest] == ["full", "fragment"]
+            ok &= "<title>" in read_snapshot(latest[0][3])
+            ok &= "device-stock-container" in read_snapshot(latest[1][3])
+            ok &= "<title>" not in read_snapshot(latest[1][3])
+
+            # 在庫状況テーブルまでで受信を打ち切ったページは、ページ全体を取得し直して保存する
+            long_path = "/device/smartphone/long-page/"
+            server.state.pages[long_path] = synthetic_product_page("長いページ", ["1", "2"], padding_kb=64)
+            html, _, _, _, transfer = fetch_stock_http(base_url + long_path, stream=True)
+            full_html, partial = full_page_html(base_url + long_path, html, transfer)
+            ok &= transfer["stopped_early"] and "</html>" not in html
+            ok &= not partial and full_html == server.state.pages[long_path]
+            server.state.pages[long_path] = None
+            ok &= full_page_html(base_url + long_path, html, transfer) == (html, True)
+
+            # 全体の容量の上限を超えたら古いものから削除する
+            with SnapshotStore(directory=tmp_dir, per_url=2, max_bytes=1, compression="gzip") as snapshots:
+                check_stock(urls[1], fetch_mode="http-only", snapshots=snapshots)
+            ok &= len(list_snapshots(tmp_dir)) == 1
+    finally:
+        server.shutdown()
+
+    logger.info(f"スナップショットテスト: {'成功' if ok else '失敗'}")
+    return ok
+
+def check_email_notifier(test_files):
+    """SMTPスタブを相手に、接続を使い回して複数の宛先に送れるか・切断後に接続し直せるか確認"""
+    results = [check_stock_from_file(test["file"], test["url"]) for test in test_files]
+    in_stock_products = [r for r in results if r["in_stock"]]
+    server, port = start_smtp_stub()
+    ok = True
+    try:
+        notifier = EmailNotifier(
+            "sender@example.com", "password", ["a@example.com", "b@example.com"],
+            host="127.0.0.1", port=port, use_ssl=False,
+        )
+        sent = []
+        notifications = NotificationQueue(notifier)
+        notifications.submit(in_stock_products, on_sent=sent.append)
+        notifications.submit(in_stock_products, on_sent=sent.append)
+        notifications.join()
+
+        # 2通とも1回の接続・ログインで送られる
+        state = server.state
+        ok &= len(state.messages) == 2 and state.connections == 1 and state.logins == 1
+        ok &= state.messages[0]["to"] == ["a@example.com", "b@example.com"]
+        ok &= len(sent) == 2
+
+        # サーバー側で接続が切れても、接続し直して送れる
+        state.drop_after_message = True
+        notifications.submit(in_stock_products, on_sent=sent.append)
+        notifications.submit(in_stock_products, on_sent=sent.append)
+        notifications.close()
+        ok &= len(state.messages) == 4 and state.connections == 2 and len(sent) == 4
+        if not ok:
+            logger.error(f"SMTPスタブの状態が想定と違います: 接続{state.connections}回, ログイン{state.logins}回, メール{len(state.messages)}通")
+    finally:
+        server.shutdown()
+
+    logger.info(f"メール通知テスト: {'成功' if ok else '失敗'}")
+    return ok
+
+def check_notify_dispatch(test_files):
+    """Webhookのスタブ・SMTPスタブを相手に、全チャネルへ同時に送れるか・遅いチャネルがほかを待たせないか確認"""
+    results = [check_stock_from_file(test["file"], test["url"]) for test in test_files]
+    in_stock_products = [r for r in results if r["in_stock"]]
+    server, base_url = start_stub_server()
+    smtp_server, smtp_port = start_smtp_stub()
+    ok = True
+    try:
+        webhook = base_url + WEBHOOK_PATH
+        # Discordは応答が遅れてタイムアウトし、汎用のWebhookは1回目だけ500エラーを返す
+        server.state.webhook_latency[WEBHOOK_PATH + "discord"] = 2.0
+        server.state.webhook_failures[WEBHOOK_PATH + "generic"] = 1
+        email = EmailNotifier("sender@example.com", "password", ["a@example.com"], host="127.0.0.1", port=smtp_port, use_ssl=False)
+        channels = [
+            EmailChannel(email, timeout=5, retries=0),
+            SlackChannel(webhook + "slack", timeout=5, retries=0),
+            DiscordChannel(webhook + "discord", timeout=0.5, retries=0),
+            LineChannel("token", "U0000", url=webhook + "line", timeout=5, retries=0),
+            WebhookChannel(webhook + "generic", timeout=5, retries=2),
+        ]
+        dispatcher = NotificationDispatcher(channels, dedupe_path="", dedupe_window=600, backoff=0.1)
+        started = time.perf_counter()
+        # Discordが失敗したので、全体としては送れていない
+        ok &= not dispatcher.send(in_stock_products)
+        elapsed = time.perf_counter() - started
+        deliveries = {d["channel"]: d for d in dispatcher.deliveries}
+
+        # Discordのタイムアウト（0.5秒）を待つだけで、応答の遅れ（2秒）は待たない
+        ok &= elapsed < 1.5 and not deliveries["discord"]["ok"]
+        ok &= all(deliveries[name]["ok"] for name in ("email", "slack", "line", "webhook"))
+        ok &= deliveries["email"]["latency"] < 0.5 and deliveries["webhook"]["attempts"] == 2
+        ok &= len(smtp_server.state.messages) == 1
+        hooks = {hook["path"][len(WEBHOOK_PATH):]: hook for hook in server.state.webhooks}
+        ok &= sorted(hooks) == ["generic", "line", "slack"]
+        ok &= hooks["generic"]["headers"]["Idempotency-Key"] == dedupe_key("webhook", in_stock_products)
+        ok &= hooks["line"]["body"]["to"] == "U0000" and "X-Line-Retry-Key" in hooks["line"]["headers"]
+        ok &= in_stock_products[0]["product_name"] in hooks["slack"]["body"]["text"]
+
+        # 送れたチャネルには同じ通知を送らず、失敗したDiscordだけ送り直す
+        server.state.webhook_latency.clear()
+        dispatcher.deliveries.clear()
+        ok &= dispatcher.send(in_stock_products)
+        dispatcher.close()
+        deliveries = {d["channel"]: d for d in dispatcher.deliveries}
+        ok &= all(deliveries[name]["deduped"] for name in ("email", "slack", "line", "webhook"))
+        ok &= deliveries["discord"]["ok"] and not deliveries["discord"]["deduped"]
+        ok &= len(smtp_server.state.messages) == 1
+
+        # 一部のチャネルだけ失敗した通知は通知済みにならず、次のチェックで失敗したチャネルにだけ送り直す
+        server.state.webhooks.clear()
+        server.state.webhook_failures[WEBHOOK_PATH + "partial"] = 1
+        with tempfile.TemporaryDirectory() as tmp_dir, StockStateStore(path=os.path.join(tmp_dir, "state.db")) as store:
+            queue = NotificationQueue(NotificationDispatcher(
+                [SlackChannel(webhook + "slack", timeout=5, retries=0), WebhookChannel(webhook + "partial", timeout=5, retries=0)],
+                dedupe_path="", dedupe_window=600,
+            ))
+            product = in_stock_products[0]
+            color = product["details"][0]["color"]
+            notify_changes(store, results, in_stock_products, queue)
+            queue.join()
+            ok &= store.get(product["url"], color)["notified_at"] is None
+            # 次のチェックでは失敗したWebhookにだけ送り直して通知済みにし、その次はもう送らない
+            for _ in range(2):
+                notify_changes(store, results, in_stock_products, queue)
+                queue.join()
+            queue.close()
+            ok &= store.get(product["url"], color)["notified_at"] is not None
+            sent = [hook["path"][len(WEBHOOK_PATH):] for hook in server.state.webhooks]
+            ok &= sorted(sent) == ["partial", "slack"]
+        if not ok:
+            logger.error(f"通知の送信結果が想定と違います: {dispatcher.deliveries}, {elapsed:.2f}秒")
+    finally:
+        server.shutdown()
+        smtp_server.shutdown()
+
+    logger.info(f"通知の同時送信テスト: {'成功' if ok else '失敗'} ({elapsed:.2f}秒)")
+    return ok
+
+def check_sharding(test_files, shard_count=3):
+    """n個のプロセスでシャードごとにチェックし、マージで1通だけ通知されるか確認"""
+    server, base_url = start_stub_server()
+    smtp_server, smtp_port = start_smtp_stub()
+    ok = True
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # 同じページを別のURLとして複数監視する
+            urls = [base_url + test["path"] + f"?n={n}" for n in range(4) for test in test_files]
+            env = dict(
+                os.environ,
+                PRODUCT_URLS=",".join(urls),
+                FETCH_MODE="http-only",
+                STOCK_API_URL=base_url + STOCK_API_PATH + "?modelnums={modelnums}",
+                SHARD_RESULTS_DIR=os.path.join(tmp_dir, "shards"),
+                STATE_DB_FILE=os.path.join(tmp_dir, "state.db"),
+                PAGE_CACHE_FILE=os.path.join(tmp_dir, "page_cache.json"),
+                URL_HEALTH_FILE=os.path.join(tmp_dir, "url_health.json"),
+                ARCHIVE_DB_FILE=os.path.join(tmp_dir, "archive.db"),
+                NOTIFY_DEDUPE_FILE=os.path.join(tmp_dir, "notify_dedupe.json"),
+                STATUS_FILE=os.path.join(tmp_dir, "status.json"),
+                SLACK_WEBHOOK_URL=base_url + WEBHOOK_PATH + "slack",
+                WEBHOOK_URL=base_url + WEBHOOK_PATH + "generic",
+                SNAPSHOT_DIR=os.path.join(tmp_dir, "snapshots"),
+                RUN_REPORT_FILE=os.path.join(tmp_dir, "run_report.jsonl"),
+                LOG_FILE="",
+                EMAIL_USER="sender@example.com",
+                EMAIL_PASS="password",
+                RECIPIENT_EMAIL="a@example.com",
+                SMTP_HOST="127.0.0.1",
+                SMTP_PORT=str(smtp_port),
+                SMTP_SSL="0",
+            )
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stock_checker.py")
+            processes = [
+                subprocess.Popen([sys.executable, script, "--shard", f"{index}/{shard_count}"], env=env,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                for index in range(shard_count)
+            ]
+            ok &= all(process.wait(timeout=60) == 0 for process in processes)
+            # シャードの間でURLの重複・漏れがない
+            checked = []
+            for index in range(shard_count):
+                with open(os.path.join(tmp_dir, "shards", f"shard-{index}-of-{shard_count}.json"), encoding="utf-8") as f:
+                    checked.extend(result["url"] for result in json.load(f)["results"])
+            ok &= sorted(checked) == sorted(urls)
+            # シャードの段階では通知しない
+            ok &= len(smtp_server.state.messages) == 0
+
+            merge = subprocess.run([sys.executable, script, "--merge"], env=env, capture_output=True, timeout=60)
+            ok &= merge.returncode == 0
+            ok &= len(smtp_server.state.messages) == 1
+            # メールと同じ通知が、SlackとWebhookにも1回ずつ届く
+            ok &= sorted(hook["path"] for hook in server.state.webhooks) == [WEBHOOK_PATH + "generic", WEBHOOK_PATH + "slack"]
+            ok &= not os.listdir(os.path.join(tmp_dir, "shards"))
+            # マージした結果が状態ファイルに書き出される
+            with open(os.path.join(tmp_dir, "status.json"), encoding="utf-8") as f:
+                ok &= sorted(product["url"] for product in json.load(f)["products"]) == sorted(urls)
+            if not ok:
+                logger.error(
+                    f"シャードのマージ結果が想定と違います: メール{len(smtp_server.state.messages)}通, "
+                    f"Webhook{len(server.state.webhooks)}件"
+                )
+    finally:
+        server.shutdown()
+        smtp_server.shutdown()
+
+    logger.info(f"シャーディングテスト: {'成功' if ok else '失敗'}")
+    return ok
+
+def check_watch_list(test_files):
+    """同じページを指す商品が1回の取得にまとまり、監視する色だけが結果に入るか確認"""
+    server, base_url = start_stub_server()
+    ok = True
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test = test_files[1]
+            expected = check_stock_from_file(test["file"], test["url"])
+            color = expected["details"][0]["color"]
+            # スキームの大文字・末尾のスラッシュ・フラグメントだけが違うURLと、pageで同じページを指定した商品
+            upper_base_url = base_url.replace("http://", "HTTP://")
+            watch_list_path = os.path.join(tmp_dir, "watch_list.toml")
+            with open(watch_list_path, "w", encoding="utf-8") as f:
+                f.write(
+                    "[[products]]\n"
+                    f'url = "{base_url}{test["path"]}"\n'
+                    "\n[[products]]\n"
+                    f'url = "{upper_base_url}{test["path"].rstrip("/")}#stock"\n'
+                    f'colors = ["{color}"]\n'
+                    "priority = 10\n"
+                    "\n[[products]]\n"
+                    f'url = "{base_url}/device/smartphone/aquos-sense9/"\n'
+                    f'page = "{base_url}{test["path"]}"\n'
+                    f'colors = ["{color}"]\n'
+                    'name = "AQUOS sense9"\n'
+                )
+            subscriptions = load_watch_list(watch_list_path)
+            plan = compile_fetch_plan(subscriptions)
+            ok &= len(plan) == 1 and plan[0]["colors"] is None and plan[0]["priority"] == 10
+
+            os.environ["FETCH_MODE"] = "http-only"
+            results = fan_out(plan, check_urls([fetch["url"] for fetch in plan], colors=fetch_colors(plan)))
+            ok &= server.state.requests.count(test["path"]) == 1
+            ok &= [r["url"] for r in results] == [s["url"] for s in subscriptions]
+            ok &= results[0]["details"] == expected["details"]
+            ok &= all(r["details"] == expected["details"][:1] for r in results[1:])
+            ok &= results[2]["product_name"] == "AQUOS sense9"
+
+            # 監視していない色は判定しない（判定した色が違えばキャッシュも使わない）
+            cache = PageCache(path=os.path.join(tmp_dir, "page_cache.json"))
+            url = base_url + test["path"]
+            result = check_stock(url, fetch_mode="http-only", cache=cache, colors=[color])
+            ok &= result["details"] == expected["details"][:1]
+            result = check_stock(url, fetch_mode="http-only", cache=cache)
+            ok &= not result.get("cached") and result["details"] == expected["details"]
+            if not ok:
+                logger.error(f"監視リストの結果が想定と違います: {[r['details'] for r in results]}")
+    finally:
+        os.environ.pop("FETCH_MODE", None)
+        server.shutdown()
+
+    logger.info(f"監視リストテスト: {'成功' if ok else '失敗'}")
+    return ok
+
+def check_url_health(test_files):
+    """失敗が続くURLがスキップされ、時間が経つと試しにチェックされるか、ホストごと止まるか確認"""
+    server, base_url = start_stub_server()
+    ok = True
+    try:
+        os.environ["FETCH_MODE"] = "http-only"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            health_path = os.path.join(tmp_dir, "url_health.json")
+            # 販売終了などで在庫状況テーブルがなくなったページ
+            dead_path = "/device/smartphone/discontinued/"
+            server.state.pages[dead_path] = '<html><div class="page-title"><h1>販売終了</h1></div></html>'
+            dead_url = base_url + dead_path
+            urls = [dead_url, base_url + test_files[0]["path"]]
+
+            # 実行ごとに読み込み・保存し、2回続けて失敗したら3回目はアクセスしない
+            for _ in range(3):
+                health = UrlHealth(path=health_path, failure_threshold=2, backoff=60).load()
+                results = check_urls(urls, concurrency=1, health=health)
+                health.save()
+            ok &= server.state.requests.count(dead_path) == 2
+            ok &= results[0].get("skipped") and not results[1]["error"]
+            ok &= health.skipped == [dead_url]
+
+            # 確認時刻を過ぎたら1回だけ試し、成功すれば元に戻る
+            ok &= health.state(dead_url, now=time.time() + 61) == HALF_OPEN
+            ok &= health.allow(dead_url, now=time.time() + 61) is None
+            health.record({"url": dead_url, "error": None, "details": []})
+            ok &= health.recovered == [dead_url] and health.allow(dead_url) is None
+
+            # 同じホストのURLが最初から続けて失敗したら、残りはアクセスせずに終わる
+            server.state.requests.clear()
+            dead_urls = [base_url + f"/device/smartphone/discontinued-{n}/" for n in range(6)]
+            host_breaker = HostBreaker(threshold=3)
+            results = check_urls(dead_urls, concurrency=1, host_breaker=host_breaker)
+            ok &= len(server.state.requests) == 3
+            ok &= sum(1 for r in results if r.get("skipped")) == 3 and len(host_breaker.tripped_hosts) == 1
+
+            # 打ち切ったURLのチェックが後から成功しても、打ち切りの失敗を上書きしない
+            slow_url = base_url + test_files[0]["path"]
+            timeout_health = UrlHealth(path=os.path.join(tmp_dir, "timeout_health.json"), failure_threshold=1, backoff=60)
+            server.state.latency = 1.5
+            results = check_urls([slow_url], concurrency=1, timeout=0.3, health=timeout_health)
+            time.sleep(2)
+            server.state.latency = 0.0
+            ok &= results[0]["error"].startswith("タイムアウト") and timeout_health.state(slow_url) == OPEN
+            if not ok:
+                logger.error(f"URLの健全性の結果が想定と違います: {health.summary()}, リクエスト{len(server.state.requests)}件")
+    finally:
+        os.environ.pop("FETCH_MODE", None)
+        server.shutdown()
+
+    logger.info(f"URL健全性テスト: {'成功' if ok else '失敗'}")
+    return ok
+
+def check_status_api(test_files):
+    """状態APIがETag・商品と色ごとの取得・since=の差分・長いポーリング・SSEに応えるか確認"""
+    import http.client
+    import threading
+    from urllib.parse import urlencode
+
+    import requests
+
+    results = [check_stock_from_file(test["file"], test["url"]) for test in test_files]
+    board = StatusBoard()
+    board.publish(results)
+    server = start_status_server(board, port=0, keepalive=1)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    session = requests.Session()
+    ok = True
+    try:
+        response = session.get(base_url + "/status")
+        ok &= response.status_code == 200 and len(response.json()["products"]) == len(results)
+        ok &= session.get(base_url + "/status", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+        # 商品と色ごと（URLは正規化して比べ、色名は一部でもよい）
+        in_stock = next(r for r in results if r["in_stock"])
+        color = in_stock["details"][0]["color"]
+        product = session.get(base_url + "/status/product", params={"url": in_stock["url"] + "?utm_source=test"}).json()
+        ok &= product["details"] == in_stock["details"]
+        by_color = session.get(base_url + "/status/product", params={"url": in_stock["url"], "color": color[:2]}).json()
+        ok &= [d["color"] for d in by_color["details"]] == [d["color"] for d in in_stock["details"] if color[:2] in d["color"]]
+        ok &= session.get(base_url + "/status/product", params={"url": "https://mineo.jp/unknown/"}).status_code == 404
+        ok &= session.post(base_url + "/status").status_code == 405
+
+        # 長いポーリング: 変化があった時点で、変わった商品だけが返る
+        version = board.version
+        sold_out = dict(in_stock, in_stock=False, details=[dict(d, status="在庫なし") for d in in_stock["details"]])
+        threading.Timer(0.3, board.publish, args=([sold_out],)).start()
+        started = time.perf_counter()
+        delta = session.get(base_url + "/status", params={"since": version, "wait": 10}).json()
+        waited = time.perf_counter() - started
+        ok &= 0.2 < waited < 5 and [p["url"] for p in delta["products"]] == [in_stock["url"]]
+        ok &= delta["version"] == version + 1 and not delta["products"][0]["in_stock"]
+
+        # SSE: 接続時の全体のあと、変化のたびに差分が届く
+        events = session.get(base_url + "/status/events", stream=True, timeout=10)
+        lines = events.iter_lines(chunk_size=1, decode_unicode=True)
+        first = next(line for line in lines if line.startswith("data: "))
+        ok &= len(json.loads(first[len("data: "):])["products"]) == len(results)
+        board.retain([r["url"] for r in results if r is not in_stock])
+        event_id = next(line for line in lines if line.startswith("id: "))
+        data = json.loads(next(line for line in lines if line.startswith("data: "))[len("data: "):])
+        ok &= event_id == f"id: {board.version}" and data["removed"] == [in_stock["url"]]
+        events.close()
+
+        # メモリから返すので、接続を使い回せば1リクエストは1ミリ秒もかからない
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        path = "/status/product?" + urlencode({"url": results[0]["url"]})
+        times = []
+        for _ in range(200):
+            started = time.perf_counter()
+            connection.request("GET", path)
+            connection.getresponse().read()
+            times.append(time.perf_counter() - started)
+        connection.close()
+        times.sort()
+        if not ok:
+            logger.error(f"状態APIの応答が想定と違います: 版{board.version}, {delta}")
+    finally:
+        stop_status_server(server, board)
+    logger.info(f"状態APIテスト: {'成功' if ok else '失敗'} (p50 {times[len(times) // 2] * 1000:.2f}ms)")
+    return ok
+
+def check_stock_archive(test_files):
+    """価格が取り出せるか、アーカイブが変化だけにまとめられ、最後に在庫ありだった期間を答えられるか確認"""
+    ok = True
+    with open(test_files[1]["file"], "r", encoding="utf-8") as f:
+        details = extract_stock(f.read())["details"]
+    ok &= all(d["full_price"] == 64416 and d["installment_price"] == 2684 for d in details)
+
+    url = test_files[1]["url"]
+    color = details[0]["color"]
+    start = time.time() - 3 * 24 * 3600
+    # 5分ごとに3日分: 1日目は在庫なし、2日目の途中から12時間だけ在庫あり（途中で値下げ）、以後は在庫なし
+    in_stock_from, price_cut, in_stock_until = start + 30 * 3600, start + 36 * 3600, start + 42 * 3600
+
+    def sample(now):
+        status = "在庫あり" if in_stock_from <= now < in_stock_until else "在庫なし"
+        price = 59800 if now >= price_cut else 64416
+        return [{"url": url, "error": None, "details": [dict(details[0], status=status, full_price=price)]}]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with StockArchive(path=os.path.join(tmp_dir, "archive.db"), compact_after=24 * 3600) as archive:
+            compacted = 0
+            for n in range(3 * 24 * 12):
+                now = start + n * 300
+                archive.append(sample(now), now=now)
+                compacted += archive.maybe_compact(now=now)
+            # まとめていない観測も含めて答える
+            entry = archive.history(url, color)[0]
+            period = entry["last_in_stock"]
+            ok &= compacted > 0 and entry["samples"] == 3 * 24 * 12
+            ok &= period["since"] == in_stock_from and period["until"] == in_stock_until
+            ok &= period["duration"] == in_stock_until - in_stock_from and entry["in_stock_count"] == 1
+            ok &= entry["status"] == "在庫なし" and entry["since"] == in_stock_until and entry["full_price"] == 59800
+
+            # すべてまとめると、変化（在庫なし→在庫あり→値下げ→在庫なし）の4行だけが残る
+            archive.compact(before=now + 1)
+            timeline = archive.timeline(url)[color]
+            ok &= [(span["status"], span["full_price"]) for span in timeline] == [
+                ("在庫なし", 64416), ("在庫あり", 64416), ("在庫あり", 59800), ("在庫なし", 59800)
+            ]
+            started = time.perf_counter()
+            ok &= archive.history(url, color)[0]["last_in_stock"] == period
+            query_ms = (time.perf_counter() - started) * 1000
+            if not ok:
+                logger.error(f"アーカイブの結果が想定と違います: {entry}")
+    logger.info(f"アーカイブテスト: {'成功' if ok else '失敗'} (問い合わせ {query_ms:.1f}ms)")
+    return ok
+
+def check_discovery(test_files):
+    """一覧ページから商品が見つかり、2回目以降は新しい商品・変わった商品のページだけを取得するか確認"""
+    server, base_url = start_stub_server()
+    ok = True
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_path = os.path.join(tmp_dir, "discovery.json")
+            listing_path = "/device/smartphone/"
+            moto, aquos = test_files[0]["path"], test_files[1]["path"]
+            # 在庫状況テーブルのないページ（アクセサリーなど）と、excludeで監視しない商品
+            accessory, excluded = "/device/smartphone/mineo-case/", "/device/smartphone/pixel-stub/"
+            server.state.pages[accessory] = '<html><div class="page-title"><h1>ケース</h1></div></html>'
+            devices = [
+                (moto, "motorola edge 40 neo", 49896, ""),
+                (aquos, "AQUOS sense9", 64416, "在庫なし"),
+                (accessory, "mineoオリジナルケース", 1980, ""),
+                (excluded, "Pixel（スタブ）", 79800, ""),
+            ]
+            server.state.pages[listing_path] = synthetic_listing_page(devices)
+
+            def crawl():
+                server.state.requests.clear()
+                discovery = DeviceDiscovery(
+                    listing_urls=[base_url + listing_path], path=state_path, include=[], exclude=["*pixel*"],
+                ).load()
+                return discovery, discovery.crawl()
+
+            # 1回目: すべて新しい商品（excludeに合う商品のページは取得しない）
+            discovery, summary = crawl()
+            watched = [url for url, _ in discovery.watched_devices()]
+            ok &= len(summary["new"]) == 4 and summary["fetched"] == 3 and excluded not in server.state.requests
+            ok &= watched == sorted([base_url + moto, base_url + aquos])
+
+            # 2回目: 一覧が変わっていなければ（304）商品ページは取得しない
+            discovery, summary = crawl()
+            ok &= server.state.requests == [listing_path] and summary["fetched"] == 0
+            ok &= not summary["new"] and not summary["changed"] and not summary["removed"]
+
+            # 3回目: 値下げされた商品と新しい商品のページだけを取得し、一覧から消えた商品は監視から外す
+            new_path = "/device/smartphone/new-phone/"
+            server.state.pages[new_path] = synthetic_product_page("新機種", ["1", "2"])
+            devices = [(moto, "motorola edge 40 neo", 44800, "値下げ"), devices[2], devices[3], (new_path, "新機種", 39800, "NEW")]
+            server.state.pages[listing_path] = synthetic_listing_page(devices)
+            discovery, summary = crawl()
+            ok &= summary["new"] == [base_url + new_path] and summary["changed"] == [base_url + moto]
+            ok &= summary["removed"] == [base_url + aquos] and summary["fetched"] == 2
+            ok &= sorted(server.state.requests) == sorted([listing_path, moto, new_path])
+            ok &= [url for url, _ in discovery.watched_devices()] == sorted([base_url + moto, base_url + new_path])
+
+            # サイトマップ: 更新日が変わった商品だけを取得する
+            sitemap_path = "/sitemap.xml"
+            server.state.pages[sitemap_path] = synthetic_sitemap(base_url, [(moto, "2024-06-01"), (aquos, "2024-06-01"), ("/company/", "2024-06-01")])
+            sitemap = DeviceDiscovery(listing_urls=[base_url + sitemap_path], path=os.path.join(tmp_dir, "sitemap.json"))
+            ok &= len(sitemap.crawl()["new"]) == 2
+            server.state.pages[sitemap_path] = synthetic_sitemap(base_url, [(moto, "2024-07-01"), (aquos, "2024-06-01")])
+            summary = sitemap.crawl()
+            ok &= summary["changed"] == [base_url + moto] and summary["fetched"] == 1
+
+            # 監視リスト: PRODUCT_URLSと同じページ（書き方だけ違うURL）は重ねて監視しない
+            os.environ.update(
+                DISCOVERY_URLS=base_url + listing_path, DISCOVERY_FILE=state_path, DISCOVERY_EXCLUDE="*pixel*",
+                PRODUCT_URLS=base_url + moto.rstrip("/") + "?utm_source=x",
+            )
+            subscriptions = get_watch_list()
+            ok &= [s["page"] for s in subscriptions] == [base_url + moto, base_url + new_path]
+            if not ok:
+                logger.error(f"商品の検出結果が想定と違います: {summary}, リクエスト{server.state.requests}")
+    finally:
+        for name in ("DISCOVERY_URLS", "DISCOVERY_FILE", "DISCOVERY_EXCLUDE", "PRODUCT_URLS"):
+            os.environ.pop(name, None)
+        server.shutdown()
+
+    logger.info(f"商品の検出テスト: {'成功' if ok else '失敗'}")
+    return ok
+
 def main():
     """テスト実行"""
     logger.info("mineo在庫チェッカーテスト実行開始")
     
-    # テスト対象のHTMLファイル
-    test_files = [
-        {
-            "file": "https___mineo_jp_device_smartphone_motorola_edge_40_neo_.html",
-            "url": "https://mineo.jp/device/smartphone/motorola-edge-40-neo/"
-        },
-        {
-            "file": "https___mineo_jp_device_smartphone_aquos_sense9_8gb_256gb_.html",
-            "url": "https://mineo.jp/device/smartphone/aquos-sense9/"
-        }
-    ]
+    test_files = TEST_FILES
     
     in_stock_products = []
     all_results = []
@@ -174,11 +750,32 @@ def main():
                 if detail["status"] == "在庫あり":
                     logger.info(f"  - {detail['color']}: {detail['status']}")
     
+    # ブラウザを使わない取得方法をスタブサーバーで確認
+    # 失敗したチェックが1つでもあれば終了コードを1にする
+    checks = [
+        check_http_fetch,
+        check_page_cache,
+        check_state_store,
+        check_snapshot_store,
+        check_email_notifier,
+        check_notify_dispatch,
+        check_sharding,
+        check_watch_list,
+        check_url_health,
+        check_stock_archive,
+        check_status_api,
+        check_discovery,
+    ]
+    failed = [check.__name__ for check in checks if not check(test_files)]
+    
     # メール送信をテストする場合は環境変数を設定して以下のコメントを解除
     # if in_stock_products and os.getenv("EMAIL_USER") and os.getenv("EMAIL_PASS") and os.getenv("RECIPIENT_EMAIL"):
     #     send_email(in_stock_products)
     
+    if failed:
+        logger.error(f"失敗したチェック: {', '.join(failed)}")
     logger.info("mineo在庫チェッカーテスト実行終了")
+    return 1 if failed else 0
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    sys.exit(main()) 
\ No newline at end of file
@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+
+logger = logging.getLogger("mineo-stock-checker")
+
+# 回路の状態
+# - closed: 通常どおりチェックする
+# - open: 失敗が続いているので、次の確認時刻まではチェックしない
+# - half-open: 確認時刻が来たので1回だけ試し、成功したらclosedに戻す
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+def skipped_result(url, reason):
+    """チェックせずにスキップしたURLの結果"""
+    return {
+        "product_name": url,
+        "url": url,
+        "in_stock": False,
+        "details": [],
+        "error": reason,
+        "skipped": True,
+        "timings": {"total": 0.0},
+    }
+
+
+def is_failure(result):
+    """URLの健全性の判定で失敗として数える結果か
+
+    取得のエラー・タイムアウトのほか、「在庫情報が見つかりませんでした」（販売終了などでページの
+    形が変わった）も失敗として数える
+    """
+    return bool(result.get("error")) and not result.get("skipped")
+
+
+class UrlHealth:
+    """URLごとの連続失敗回数をディスクに保存し、失敗が続くURLのチェックを指数的に間引く（サーキットブレーカー）
+
+    連続でfailure_threshold回失敗すると回路を開き、backoff秒後に1回だけ試す。
+    また失敗したら間隔を2倍（max_backoffまで）にして開き直し、成功したら閉じる
+    """
+
+    def __init__(self, path=None, failure_threshold=None, backoff=None, max_backoff=None):
+        if path is None:
+            path = os.getenv("URL_HEALTH_FILE", os.path.join(".cache", "url_health.json"))
+        if failure_threshold is None:
+            failure_threshold = int(os.getenv("URL_FAILURE_THRESHOLD", "3"))
+        if backoff is None:
+            backoff = float(os.getenv("URL_BACKOFF_MINUTES", "10")) * 60
+        if max_backoff is None:
+            max_backoff = float(os.getenv("URL_MAX_BACKOFF_MINUTES", "360")) * 60
+        self.path = path
+        # 0にすると回路を開かない（失敗の記録だけ行う）
+        self.failure_threshold = max(0, failure_threshold)
+        self.backoff = backoff
+        self.max_backoff = max(backoff, max_backoff)
+        self.skipped = []
+        self.tripped = []
+        self.recovered = []
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def load(self):
+        """ディスクから読み込む（壊れていれば空から始める）"""
+        if not os.path.exists(self.path):
+            return self
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("URLの健全性の記録を読み込めませんでした: %s", e)
+            self._entries = {}
+        return self
+
+    def save(self):
+        with self._lock:
+            # 正常なURLは記録しておく必要がない
+            entries = {url: entry for url, entry in self._entries.items() if entry["failures"]}
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def state(self, url, now=None):
+        """URLの回路の状態（closed / open / half-open）"""
+        if now is None:
+            now = time.time()
+        entry = self._entries.get(url)
+        if entry is None or entry.get("retry_at") is None:
+            return CLOSED
+        return HALF_OPEN if now >= entry["retry_at"] else OPEN
+
+    def allow(self, url, now=None):
+        """URLをチェックしてよいか（回路が開いている間はスキップした結果を返す）
+
+        チェックしてよければNone、スキップするならその結果を返す
+        """
+        with self._lock:
+            state = self.state(url, now)
+            if state == HALF_OPEN:
+                logger.info("失敗が続いていたURLを試しにチェックします: %s", url)
+            if state != OPEN:
+                return None
+            entry = self._entries[url]
+            self.skipped.append(url)
+        retry_at = datetime.fromtimestamp(entry["retry_at"]).strftime("%m/%d %H:%M")
+        logger.info("失敗が続いているためスキップします（次の確認: %s）: %s", retry_at, url)
+        return skipped_result(url, f"{entry['failures']}回連続で失敗したためスキップしました（次の確認: {retry_at}）: {entry['error']}")
+
+    def record(self, result, now=None):
+        """チェック結果を反映し、回路を開閉する"""
+        if now is None:
+            now = time.time()
+        if result.get("skipped"):
+            return
+        url = result["url"]
+        with self._lock:
+            entry = self._entries.get(url)
+            if not is_failure(result):
+                if entry and entry["failures"]:
+                    if entry.get("retry_at") is not None:
+                        logger.info("失敗が続いていたURLが復旧しました: %s", url)
+                        self.recovered.append(url)
+                    del self._entries[url]
+                return
+            if entry is None:
+                entry = self._entries[url] = {"failures": 0, "retry_at": None}
+            entry["failures"] += 1
+            entry["error"] = result["error"]
+            entry["failed_at"] = now
+            if self.failure_threshold and entry["failures"] >= self.failure_threshold:
+                # 開くたびに確認までの間隔を2倍にする
+                backoff = min(self.max_backoff, self.backoff * 2 ** (entry["failures"] - self.failure_threshold))
+                if entry["retry_at"] is None:
+                    logger.warning("%s回連続で失敗したため%.0f分間チェックを止めます: %s", entry["failures"], backoff / 60, url)
+                    self.tripped.append(url)
+                entry["retry_at"] = now + backoff
+
+    def new_cycle(self):
+        """スキップ・停止・復旧したURLの記録を空にする（常駐モードのサイクルごと）"""
+        with self._lock:
+            self.skipped = []
+            self.tripped = []
+            self.recovered = []
+
+    def summary(self):
+        return f"失敗が続いてスキップ{len(self.skipped)}件 / 新たに停止{len(self.tripped)}件 / 復旧{len(self.recovered)}件"
+
+
+class HostBreaker:
+    """1回の実行の中で、同じホストのURLが最初からthreshold件続けて失敗したら残りをチェックしない
+
+    サイト全体の障害やメンテナンス中に、すべてのURLで読み込みのタイムアウトを待たないようにする
+    """
+
+    def __init__(self, threshold=None):
+        if threshold is None:
+            threshold = int(os.getenv("HOST_FAILURE_THRESHOLD", "5"))
+        # 0にするとホスト単位では止めない
+        self.threshold = max(0, threshold)
+        self.tripped_hosts = []
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._succeeded = set()
+
+    def allow(self, url):
+        """URLのホストをチェックしてよいか（止めていればスキップした結果を返す）"""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self.tripped_hosts:
+                return None
+            failures = self._failures[host]
+        return skipped_result(url, f"{host} のURLが{failures}件続けて失敗したため、このホストのチェックを中止しました")
+
+    def record(self, result):
+        if result.get("skipped") or not self.threshold:
+            return
+        host = urlparse(result["url"]).netloc
+        with self._lock:
+            if not is_failure(result):
+                self._succeeded.add(host)
+                return
+            self._failures[host] = self._failures.get(host, 0) + 1
+            # 1件でも成功していれば、サイト全体の障害ではない
+            if (host not in self._succeeded and host not in self.tripped_hosts
+                    and self._failures[host] >= self.threshold):
+                logger.error("%s のURLが%s件続けて失敗したため、このホストの残りのチェックを中止します", host, self._failures[host])
+                self.tripped_hosts.append(host)
@@ -0,0 +1,207 @@
+import logging
+import os
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+try:
+    import tomllib
+except ImportError:  # Python 3.10以前はtomliを使う
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+from stock_extractor import color_matches
+
+logger = logging.getLogger("mineo-stock-checker")
+
+IN_STOCK = "在庫あり"
+
+# URLの比較で無視するクエリ（広告・計測用）
+IGNORED_QUERY_PREFIXES = ("utm_", "gclid", "fbclid", "yclid")
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    """同じページを指すURLを同じ文字列にする
+
+    スキーム・ホスト名の大文字小文字、既定のポート、フラグメント、計測用のクエリ、
+    末尾のスラッシュの有無の違いを吸収する
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    path = parts.path or "/"
+    # mineoの商品ページは「/」で終わる（拡張子のあるファイルはそのまま）
+    if not path.endswith("/") and "." not in path.rsplit("/", 1)[-1]:
+        path += "/"
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith(IGNORED_QUERY_PREFIXES)
+    ))
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+def read_watch_list_file(path):
+    """監視リストのファイル（.toml / .yaml / .yml）を読み込む"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".toml":
+        if tomllib is None:
+            raise ValueError("TOMLの監視リストを読むにはtomliが必要です（Python 3.10以前）")
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    if extension in (".yaml", ".yml"):
+        # PyYAMLはYAMLの監視リストを使う場合だけ必要なので、ここで読み込む
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("YAMLの監視リストを読むにはPyYAMLが必要です")
+        with open(path, "r", encoding="utf-8") as f:
+            return yaml.safe_load(f) or {}
+    raise ValueError(f"監視リストの形式がわかりません（.toml / .yaml / .yml）: {path}")
+
+
+def load_watch_list(path):
+    """監視リストのファイルを読み込み、購読（監視する商品ごとの設定）のリストを返す
+
+    [[products]]
+    url = "https://mineo.jp/device/smartphone/aquos-sense9-8gb-256gb/"
+    page = "https://mineo.jp/device/smartphone/aquos-sense9/"  # 取得するページ（省略時はurl）
+    colors = ["ブラック"]  # 監視する色（省略時はすべて）
+    priority = 10          # 大きいほど先にチェックする（既定値0）
+    interval = 600         # チェックの間隔（秒、省略時は毎回）
+    name = "AQUOS sense9"  # 通知に使う商品名（省略時はページの商品名）
+    """
+    data = read_watch_list_file(path)
+    entries = data.get("products") if isinstance(data, dict) else data
+    if not isinstance(entries, list):
+        raise ValueError("監視リストには products のリストを書いてください")
+    return [subscription_from_entry(entry, index) for index, entry in enumerate(entries)]
+
+
+def subscription_from_entry(entry, index):
+    """監視リストの1項目を検証して購読にする"""
+    if isinstance(entry, str):
+        entry = {"url": entry}
+    if not isinstance(entry, dict) or not entry.get("url"):
+        raise ValueError(f"{index + 1}番目の項目にurlがありません")
+    colors = entry.get("colors") or []
+    if isinstance(colors, str):
+        colors = [colors]
+    try:
+        priority = int(entry.get("priority", 0))
+        interval = float(entry["interval"]) if entry.get("interval") is not None else None
+    except (TypeError, ValueError):
+        raise ValueError(f"{index + 1}番目の項目のpriority・intervalは数値で指定してください: {entry['url']}")
+    return {
+        "url": entry["url"].strip(),
+        "page": normalize_url(entry.get("page") or entry["url"]),
+        "colors": [str(color).strip() for color in colors if str(color).strip()],
+        "priority": priority,
+        "interval": interval,
+        "name": entry.get("name"),
+    }
+
+
+def subscriptions_from_urls(urls):
+    """PRODUCT_URLSのURLをすべての色を監視する購読にする"""
+    return [subscription_from_entry(url, index) for index, url in enumerate(urls) if url]
+
+
+def compile_fetch_plan(subscriptions):
+    """購読を取得するページごとにまとめる（同じページは1回の実行で1回だけ取得する）
+
+    各ページの監視する色は購読の和集合（1つでもすべての色を監視する購読があればNone）、
+    間隔は最も短いもの、優先度は最も高いものになる。優先度の高いページから順に並べる
+    """
+    fetches = {}
+    for subscription in subscriptions:
+        fetch = fetches.get(subscription["page"])
+        if fetch is None:
+            fetch = fetches[subscription["page"]] = {
+                "url": subscription["page"],
+                "colors": [],
+                "priority": subscription["priority"],
+                "interval": subscription["interval"],
+                "subscriptions": [],
+            }
+        fetch["subscriptions"].append(subscription)
+        fetch["priority"] = max(fetch["priority"], subscription["priority"])
+        if fetch["interval"] is None or subscription["interval"] is None:
+            fetch["interval"] = None
+        else:
+            fetch["interval"] = min(fetch["interval"], subscription["interval"])
+        if fetch["colors"] is not None:
+            if subscription["colors"]:
+                fetch["colors"].extend(color for color in subscription["colors"] if color not in fetch["colors"])
+            else:
+                fetch["colors"] = None
+    return sorted(fetches.values(), key=lambda fetch: -fetch["priority"])
+
+
+def due_fetches(plan, last_checked, now=None):
+    """間隔が指定されたページのうち、前回のチェックから間隔が経っていないものを除く
+
+    last_checkedは購読のURLから最後にチェックした時刻を引く関数
+    """
+    if now is None:
+        now = time.time()
+    due = []
+    for fetch in plan:
+        checked_at = latest_time(fetch, last_checked) if fetch["interval"] else None
+        if checked_at is not None and now - checked_at < fetch["interval"]:
+            logger.debug("チェック間隔（%.0f秒）が経っていないためスキップします: %s", fetch["interval"], fetch["url"])
+            continue
+        due.append(fetch)
+    return due
+
+
+def subscription_result(result, subscription):
+    """ページのチェック結果から購読の結果を作る（監視する色だけに絞る）"""
+    result = dict(result, url=subscription["url"])
+    if subscription["name"]:
+        result["product_name"] = subscription["name"]
+    if subscription["colors"] and not result.get("error"):
+        details = [detail for detail in result["details"] if color_matches(detail["color"], subscription["colors"])]
+        missing = [
+            color for color in subscription["colors"]
+            if not any(color_matches(detail["color"], [color]) for detail in details)
+        ]
+        if missing:
+            logger.warning("監視する色がページにありません: %s (%s)", subscription["url"], ", ".join(missing))
+        result["details"] = details
+        result["in_stock"] = any(detail["status"] == IN_STOCK for detail in details)
+    return result
+
+
+def fan_out(plan, page_results):
+    """ページのチェック結果をそれぞれの購読に配り、購読の結果を優先度の高い順に返す"""
+    by_page = {result["url"]: result for result in page_results}
+    results = []
+    for fetch in plan:
+        page_result = by_page.get(fetch["url"])
+        if page_result is None:
+            continue
+        for subscription in fetch["subscriptions"]:
+            results.append(subscription_result(page_result, subscription))
+    return results
+
+
+def subscription_urls(plan):
+    """購読のURLを結果と同じ順番（優先度の高い順）で返す"""
+    return [subscription["url"] for fetch in plan for subscription in fetch["subscriptions"]]
+
+
+def latest_time(fetch, lookup):
+    """ページの購読のうち最も新しい時刻（lookupは購読のURLから時刻を引く関数、なければNone）"""
+    times = [lookup(subscription["url"]) for subscription in fetch["subscriptions"]]
+    times = [value for value in times if value is not None]
+    return max(times) if times else None
+
+
+def fetch_colors(plan):
+    """ページごとの監視する色（すべての色ならNone）"""
+    return {fetch["url"]: fetch["colors"] for fetch in plan}